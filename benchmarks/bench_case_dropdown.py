@@ -0,0 +1,79 @@
+"""
+bench_case_dropdown.py - Compare building the case selection dropdown from
+full cases with building it from stored case summaries.
+
+The Redis hashes are simulated with dicts of the bytes that UsCaseList
+stores, so this measures deserialization and formatting, not the network.
+
+Usage:
+```
+python benchmarks/bench_case_dropdown.py --cases 1000
+```
+
+Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import argparse
+import json
+import timeit
+
+from docassemble.base.legal import Case
+from docassemble.us_tx_family.objects import RepresentedPartyList
+from docassemble.us_tx_family.us_case_list import case_summary, \
+    deserialize, selection_text, serialize
+
+
+def make_cases(count: int) -> tuple:
+    """
+    Build *count* synthetic cases, serialized as UsCaseList stores them.
+    """
+    cases = {}
+    summaries = {}
+    for n in range(count):
+        case = Case(f'case{n}')
+        case.initializeAttribute('client', RepresentedPartyList)
+        client = case.client.appendObject()
+        client.name.first = f'First{n}'
+        client.name.last = f'Last{n}'
+        case.description = f'In the Matter of the Marriage of Last{n}'
+        case.county = 'Collin'
+        case.case_id = f'{n:03}-{n:05}-2020'
+        case.key = f'key{n}'
+        cases[case.key] = serialize(case)
+        summaries[case.key] = json.dumps(case_summary(case))
+    return cases, summaries
+
+
+def from_cases(cases: dict) -> list:
+    case_list = [(key, selection_text(case))
+                 for key, case in ((k, deserialize(v)) for k, v in cases.items())
+                 if hasattr(case, 'case_id')]
+    case_list.sort(key=lambda x: x[1])
+    return case_list
+
+
+def from_summaries(summaries: dict) -> list:
+    case_list = [(key, summary['text'])
+                 for key, summary in ((k, json.loads(v)) for k, v in summaries.items())
+                 if 'cause_number' in summary]
+    case_list.sort(key=lambda x: x[1])
+    return case_list
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--cases', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    cases, summaries = make_cases(args.cases)
+    assert from_cases(cases) == from_summaries(summaries)
+    print(f"{args.cases} cases: {sum(map(len, cases.values())) / 1024:.0f} KiB of cases, "
+          f"{sum(map(len, summaries.values())) / 1024:.0f} KiB of summaries")
+    for name, func, data in (('full cases', from_cases, cases),
+                             ('summaries ', from_summaries, summaries)):
+        best = min(timeit.Timer(lambda: func(data)).repeat(repeat=args.repeat, number=1))
+        print(f"{name}: {best * 1000:9.2f} ms (best of {args.repeat})")
+
+
+if __name__ == '__main__':
+    main()
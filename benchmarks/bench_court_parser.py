@@ -0,0 +1,66 @@
+"""
+bench_court_parser.py - Compare the per-court and single-pass parsers
+for Chapter 24 of the Texas Government Code.
+
+Usage:
+```
+curl -o GV.24.htm https://statutes.capitol.texas.gov/Docs/GV/htm/GV.24.htm
+python benchmarks/bench_court_parser.py GV.24.htm
+```
+
+Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import argparse
+import timeit
+
+from docassemble.us_tx_family.ml_stripper import MLStripper
+from docassemble.us_tx_family.us_tx_courts import MAX_COURT_NUMBER, \
+    find_court, find_courts
+
+
+def old_parse(text: str, max_court: int) -> list:
+    """
+    The original parse: one full scan of *text* per court number.
+    """
+    result = []
+    for court_number in range(max_court):
+        court_text = find_court(court_number, text)
+        if court_text is not None:
+            result.append((court_number, court_text))
+    return result
+
+
+def new_parse(text: str, max_court: int) -> list:
+    """
+    The single-pass parse.
+    """
+    return find_courts(text, max_court)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('path', help="Saved copy of GV.24.htm")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-court', type=int, default=MAX_COURT_NUMBER)
+    args = parser.parse_args()
+
+    with open(args.path, encoding='utf-8', errors='replace') as page:
+        stripper = MLStripper()
+        stripper.feed(page.read())
+        text = stripper.get_data()
+
+    old = old_parse(text, args.max_court)
+    new = new_parse(text, args.max_court)
+    if old != new:
+        raise SystemExit("Parsers disagree: old found {}, new found {} courts"
+                         .format(len(old), len(new)))
+    print(f"{len(text):,} characters, {len(new)} courts, results identical")
+
+    for name, func in (('old', old_parse), ('new', new_parse)):
+        timer = timeit.Timer(lambda: func(text, args.max_court))
+        best = min(timer.repeat(repeat=args.repeat, number=1))
+        print(f"{name}: {best * 1000:10.2f} ms (best of {args.repeat})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+bench_directory_ingest.py - Compare peak memory and wall time of the
+original and streaming court personnel ingest on a synthetic export.
+
+Each parser runs in its own child process so that its peak RSS is not
+polluted by the other's.
+
+Usage:
+```
+python benchmarks/bench_directory_ingest.py --rows 50000
+```
+
+Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import argparse
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+HEADERS = ['County', 'Court', 'Title', 'First Name', 'Middle Name',
+           'Last Name', 'Suffix', 'Address', 'City', 'Zip Code', 'Phone',
+           'Email']
+
+COURT_TYPES = ['District Court', 'District Clerk Office']
+
+
+def make_export(path: str, rows: int):
+    """
+    Write a synthetic export resembling ExcelExportPublic.aspx.
+    """
+    rand = random.Random(rows)
+    with open(path, 'w', encoding='utf-8', newline='') as export:
+        export.write('\t'.join(HEADERS) + '\r\n')
+        for row in range(rows):
+            county = f'County{rand.randint(1, 254)}'
+            if rand.random() < 0.9:
+                court = f'{rand.randint(1, 500)}th District Court'
+            else:
+                court = 'District Clerk Office'
+            cols = [county, court, 'Court Coordinator', f'First{row}', 'Q',
+                    f'Last{row}', '', f'{row} Main Street', 'Austin',
+                    '78701', '(512) 555-0100', f'person{row}@example.com']
+            if rand.random() < 0.001:
+                cols = cols[:-1]  # malformed
+            export.write('\t'.join(cols) + '\r\n')
+
+
+def old_ingest(path: str):
+    """
+    The original tsv2dict(): the whole export in memory, split into lines.
+    """
+    from docassemble.us_tx_family.us_tx_court_directory import \
+        county_index, court_index
+
+    with open(path, encoding='utf-8', newline='') as export:
+        tsv = export.read()
+
+    courts = {}
+    clerks = {}
+    lines = [l.replace('\r', '') for l in tsv.split('\n') if len(l) > 10]
+    header = lines[0]
+    headers = [h.lower().strip()
+               for h in header.split('\t') if h.strip() != '']
+    len_headers = len(headers)
+    for line in lines[1:]:
+        cols = [c.strip() for c in line.split('\t')]
+        if len(cols) != len_headers:
+            continue
+        person = {}
+        for idx, header_text in enumerate(headers):
+            person[header_text] = cols[idx]
+        court_idx = court_index(person['court'])
+        if court_idx:
+            if court_idx not in courts:
+                courts[court_idx] = []
+            courts[court_idx].append(person)
+        elif person['court'].lower().strip() == 'district clerk office':
+            county_idx = county_index(person['county'])
+            if county_idx not in clerks:
+                clerks[county_idx] = []
+            clerks[county_idx].append(person)
+    return courts, clerks
+
+
+def new_ingest(path: str):
+    """
+    The streaming ingest used by UsTxCourtDirectory.retrieve().
+    """
+    from docassemble.us_tx_family.us_tx_court_directory import \
+        UsTxCourtDirectory
+
+    directory = UsTxCourtDirectory.__new__(UsTxCourtDirectory)
+    with open(path, 'rb') as export:
+        lines = (line.decode('utf-8').rstrip('\n') for line in export)
+        courts, clerks, rejects = directory.lines2dict(lines)
+    return courts, clerks
+
+
+def child(impl: str, path: str):
+    # Import everything first so only the parse shows up in the RSS delta.
+    import docassemble.us_tx_family.us_tx_court_directory  # noqa: F401
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    courts, clerks = {'old': old_ingest, 'new': new_ingest}[impl](path)
+    elapsed = time.perf_counter() - started
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    people = sum(len(p) for p in courts.values()) + sum(len(p) for p in clerks.values())
+    print(f"{impl}: {elapsed * 1000:9.1f} ms  peak RSS +{(after - before) / 1024:7.1f} MiB"
+          f"  ({people} people)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--child', choices=['old', 'new'], help=argparse.SUPPRESS)
+    parser.add_argument('--path', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.path)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'export.tsv')
+        make_export(path, args.rows)
+        print(f"{args.rows:,} rows, {os.path.getsize(path) / 1024 / 1024:.1f} MiB export")
+        for impl in ('old', 'new'):
+            subprocess.run([sys.executable, __file__, '--child', impl, '--path', path],
+                           check=True)
+
+
+if __name__ == '__main__':
+    main()
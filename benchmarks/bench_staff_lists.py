@@ -0,0 +1,70 @@
+"""
+bench_staff_lists.py - Count the allocations made by each court staff
+lookup before and after staff DALists were cached.
+
+"Before" builds a fresh DAList of Individuals on every call, as
+*dalist_of_individuals()* always did. "After" is *get_court()*, which builds
+the list once and hands out deep copies of it.
+
+Usage:
+```
+python benchmarks/bench_staff_lists.py --people 12 --calls 4
+```
+
+Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import argparse
+import time
+import tracemalloc
+
+from docassemble.us_tx_family.us_tx_court_directory import UsTxCourtDirectory
+
+
+def make_directory(people: int) -> UsTxCourtDirectory:
+    """
+    Create a directory holding one court without touching Redis.
+    """
+    directory = UsTxCourtDirectory.__new__(UsTxCourtDirectory)
+    staff = [{'court': '416th District Court', 'county': 'Collin',
+              'title': 'Court Coordinator', 'first name': f'First{n}',
+              'middle name': '', 'last name': f'Last{n}', 'suffix': '',
+              'address': '2100 Bloomdale Rd', 'city': 'McKinney',
+              'zip code': '75071', 'phone': '(972) 548-4570',
+              'email': f'person{n}@example.com'} for n in range(people)]
+    directory.use({'refresh_key': 'benchmark'}, courts={'416': staff})
+    return directory
+
+
+def measure(label: str, func, calls: int):
+    func()  # warm up: the first cached call builds the list
+    tracemalloc.start()
+    snapshot = tracemalloc.take_snapshot()
+    started = time.perf_counter()
+    for _ in range(calls):
+        func()
+    elapsed = time.perf_counter() - started
+    stats = tracemalloc.take_snapshot().compare_to(snapshot, 'filename')
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in stats if stat.count_diff > 0)
+    print(f"{label}: {elapsed / calls * 1e6:9.1f} us/call, "
+          f"{peak / calls / 1024:8.1f} KiB peak/call, "
+          f"{blocks / calls:8.1f} blocks retained/call")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--people', type=int, default=12)
+    parser.add_argument('--calls', type=int, default=4)
+    args = parser.parse_args()
+
+    directory = make_directory(args.people)
+    results = []
+    measure('before', lambda: results.append(
+        directory.dalist_of_individuals(directory.courts['416'])), args.calls)
+    results.clear()
+    measure('after ', lambda: results.append(directory.get_court('416')), args.calls)
+
+
+if __name__ == '__main__':
+    main()
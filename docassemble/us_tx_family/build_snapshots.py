@@ -0,0 +1,103 @@
+"""
+build_snapshots.py - Retrieve and parse the reference data and write the
+snapshots that ship with the package.
+
+Building the package runs this (see setup.py), writing the snapshots into
+the build. It can also be run by hand, e.g. before building a container
+image, on a machine that can reach txcourts.gov, capitol.texas.gov and FRED
+(set 'fred api key' or the fredapikey environment variable):
+
+```
+python -m docassemble.us_tx_family.build_snapshots
+python -m docassemble.us_tx_family.build_snapshots us_tx_courts us_fred_mortgage
+python -m docassemble.us_tx_family.build_snapshots --output /tmp/snapshots
+```
+
+Nothing is read from or written to Redis.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import argparse
+import json
+import sys
+
+from .snapshots import write_snapshot
+
+
+def counties() -> tuple:
+    from . import us_tx_counties
+    # __new__ skips __init__, which would load the list through Redis.
+    source = us_tx_counties.UsTxCounties.__new__(us_tx_counties.UsTxCounties)
+    data = {'counties': source.fetch()}
+    return data, us_tx_counties.URL, f"{len(data['counties'])} counties"
+
+
+def courts() -> tuple:
+    from . import us_tx_courts
+    source = us_tx_courts.UsTxCourts.__new__(us_tx_courts.UsTxCourts)
+    court_list = source.retrieve()
+    data = {'courts': court_list, 'by_county': source.county_list(court_list)}
+    return data, us_tx_courts.URL, \
+        f"{len(data['courts'])} courts in {len(data['by_county'])} counties"
+
+
+def court_directory() -> tuple:
+    from . import us_tx_court_directory
+    source = us_tx_court_directory.UsTxCourtDirectory.__new__(
+        us_tx_court_directory.UsTxCourtDirectory)
+    court_staff, clerks, _ = source.retrieve()
+    data = {'courts': court_staff, 'clerks': clerks}
+    return data, us_tx_court_directory.URL, \
+        f"{len(court_staff)} courts and {len(clerks)} clerk's offices"
+
+
+def fred_mortgage() -> tuple:
+    from . import us_fred_data
+    fred = us_fred_data.Fred()
+    data = {'series': {}}
+    for series in us_fred_data.HISTORY_SERIES:
+        result = json.loads(fred.series_observations(series, file_type="json"))
+        history = us_fred_data.RateHistory()
+        history.extend(result["observations"])
+        data['series'][series] = {'dates': history.dates.tolist(),
+                                  'rates': history.rates.tolist()}
+    observations = sum(len(record['dates']) for record in data['series'].values())
+    return data, us_fred_data.BASEURL["SERIES_OBSERVATIONS"].rstrip('?'), \
+        f"{observations} observations"
+
+
+# Builders indexed by snapshot name. Each returns the snapshot's data, its
+# source and a description of what was retrieved.
+BUILDERS = {
+    'us_tx_counties': counties,
+    'us_tx_courts': courts,
+    'us_tx_court_directory': court_directory,
+    'us_fred_mortgage': fred_mortgage
+}
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Build the packaged reference data snapshots.")
+    parser.add_argument('--output', help="Directory to write snapshots to, instead of the package")
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help=f"Snapshots to build, of {', '.join(BUILDERS)}; all if omitted")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.names if name not in BUILDERS]
+    if unknown:
+        parser.error(f"unknown snapshot: {', '.join(unknown)}")
+
+    failures = 0
+    for name in args.names or BUILDERS:
+        try:
+            data, source, description = BUILDERS[name]()
+            path = write_snapshot(name, data, source, args.output)
+        except Exception as e:
+            print(f"{name}: failed: {str(e)}", file=sys.stderr)
+            failures += 1
+            continue
+        print(f"{name}: {description} written to {path}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
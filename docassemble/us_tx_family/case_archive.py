@@ -0,0 +1,146 @@
+"""
+case_archive.py - Cold storage for cases that are closed or inactive.
+
+Archived cases are kept in a SQLite database, in the envelope they were
+stored in Redis in, so they stay compressed. UsCaseList moves cases here and
+brings them back when they are asked for.
+
+A case archived by one server has to be restorable by every other, so the
+archive directory must be on storage that every server shares. The first
+server to open the archive records its id in Redis; a server that finds a
+different archive in its directory refuses to use it.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import os
+import sqlite3
+import time
+import uuid
+
+from .local_config import local_config
+
+# Name of the database file within the 'case archive directory'.
+ARCHIVE_FILE = 'us_case_archive.sqlite3'
+
+# Name of the file within the 'case archive directory' holding the archive's
+# id, and the Redis key holding the id of the archive every server must use.
+ARCHIVE_ID_FILE = 'us_case_archive.id'
+ARCHIVE_ID_KEY = 'us_case_archive:id'
+
+# Cases not modified for this many months are archived unless configured
+# otherwise. Closed cases are archived regardless of age.
+DEFAULT_ARCHIVE_MONTHS = 12
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archived_cases (
+    user_id TEXT NOT NULL,
+    case_key TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    summary TEXT,
+    data BLOB NOT NULL,
+    archived REAL NOT NULL,
+    PRIMARY KEY (user_id, case_key)
+)
+"""
+
+
+class ArchiveNotSharedError(RuntimeError):
+    """
+    Raised when this server's archive is not the one other servers use.
+    """
+    pass
+
+
+class CaseArchive(object):
+    """
+    Archived cases, indexed by user id and case key.
+    """
+    def __init__(self, directory: str):
+        """
+        Open the archive in *directory*, creating it if need be.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, ARCHIVE_FILE)
+        self.connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        self.connection.execute(SCHEMA)
+
+    @classmethod
+    def configured(cls, the_redis=None):
+        """
+        Return the archive in the 'case archive directory', or None if no
+        directory is configured, in which case archiving is turned off.
+
+        Raises:
+            ArchiveNotSharedError: The directory is not the one other
+            servers use, as checked in *the_redis*.
+        """
+        directory = local_config('case archive directory', None)
+        if not directory:
+            return None
+        archive = cls(directory)
+        if the_redis is not None:
+            archive.check_shared(the_redis)
+        return archive
+
+    def check_shared(self, the_redis):
+        """
+        Make sure this is the archive every server uses. The first server to
+        open an archive writes a random id into its directory and registers
+        it in Redis. A server whose directory holds another id, or none, has
+        a directory of its own, where cases archived by other servers cannot
+        be found.
+        """
+        id_path = os.path.join(self.directory, ARCHIVE_ID_FILE)
+        try:
+            with open(id_path, 'x') as f:
+                f.write(str(uuid.uuid4()))
+        except FileExistsError:
+            pass
+        with open(id_path) as f:
+            archive_id = f.read().strip()
+        the_redis.set(ARCHIVE_ID_KEY, archive_id, nx=True)
+        registered = the_redis.get(ARCHIVE_ID_KEY)
+        if isinstance(registered, bytes):
+            registered = registered.decode()
+        if registered != archive_id:
+            raise ArchiveNotSharedError(
+                f"The case archive in {self.directory} is not the one other servers use. " +
+                "Set 'case archive directory' to a directory that every server shares.")
+
+    def put(self, user_id: str, key: str, version: int, summary: str, data: bytes):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO archived_cases VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, key, version, summary, data, time.time()))
+
+    def get(self, user_id: str, key: str) -> tuple:
+        """
+        Return the version, summary and data of an archived case, or None.
+        """
+        return self.connection.execute(
+            "SELECT version, summary, data FROM archived_cases "
+            "WHERE user_id = ? AND case_key = ?", (user_id, key)).fetchone()
+
+    def delete(self, user_id: str, key: str = None):
+        """
+        Delete one archived case, or all of a user's archived cases.
+        """
+        if key is None:
+            self.connection.execute(
+                "DELETE FROM archived_cases WHERE user_id = ?", (user_id,))
+        else:
+            self.connection.execute(
+                "DELETE FROM archived_cases WHERE user_id = ? AND case_key = ?",
+                (user_id, key))
+
+    def count(self, user_id: str) -> int:
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM archived_cases WHERE user_id = ?",
+            (user_id,)).fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+def archive_months() -> int:
+    return int(local_config('case archive months', DEFAULT_ARCHIVE_MONTHS))
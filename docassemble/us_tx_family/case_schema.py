@@ -0,0 +1,121 @@
+"""
+case_schema.py - Versions of the shape of a stored case, and the functions
+that upgrade a case from each version to the next.
+
+A case is stamped with the version of its shape. Cases saved before the
+stamp existed are version 0. UsCaseList upgrades a case the first time it is
+read and writes it back, so code that reads cases can assume the current
+shape instead of checking for every shape a case has ever had.
+
+To change the shape of a case, bump CURRENT_SCHEMA and register a function
+that upgrades a case from the previous version:
+
+```python
+@upgrade(1)
+def rename_widget(case):
+    case.gadget = case.widget
+    del case.widget
+```
+
+Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+from docassemble.base.util import DAList, Name
+
+from .objects import RepresentedPartyList
+
+# The case attribute holding the version of the case's shape.
+SCHEMA_ATTRIBUTE = 'us_schema_version'
+
+# The version of the shape that the code expects.
+CURRENT_SCHEMA = 4
+
+# Upgrade functions indexed by the version they upgrade from.
+UPGRADES = {}
+
+
+def upgrade(from_version: int):
+    """
+    Register a function that upgrades a case from *from_version* to the
+    next version.
+    """
+    def register(func):
+        UPGRADES[from_version] = func
+        return func
+    return register
+
+
+def schema_version(case) -> int:
+    return vars(case).get(SCHEMA_ATTRIBUTE, 0)
+
+
+def upgrade_case(case) -> bool:
+    """
+    Upgrade a case to the current version.
+
+    Returns:
+        (bool): Whether the case was changed.
+    """
+    version = schema_version(case)
+    if version >= CURRENT_SCHEMA:
+        return False
+    while version < CURRENT_SCHEMA:
+        UPGRADES[version](case)
+        version += 1
+    setattr(case, SCHEMA_ATTRIBUTE, version)
+    return True
+
+
+def stamp(case):
+    """
+    Mark a new case as having the current shape.
+    """
+    setattr(case, SCHEMA_ATTRIBUTE, CURRENT_SCHEMA)
+
+
+@upgrade(0)
+def footer_to_description(case):
+    """
+    The oldest cases have only a footer where newer cases have a
+    description.
+    """
+    attributes = vars(case)
+    if 'description' not in attributes and 'footer' in attributes:
+        case.description = case.footer
+
+
+@upgrade(1)
+def client_to_list(case):
+    """
+    Old cases have a client that is a name, or a single person, where
+    newer cases have a list of represented parties.
+    """
+    client = vars(case).get('client')
+    if client is None or isinstance(client, DAList):
+        return
+    del case.client
+    case.initializeAttribute('client', RepresentedPartyList)
+    if isinstance(client, str):
+        party = case.client.appendObject()
+        party.name = Name(party.instanceName + '.name', text=client)
+    else:
+        case.client.append(client, set_instance_name=True)
+    case.client.gathered = True
+
+
+@upgrade(2)
+def add_case_id(case):
+    """
+    Old cases may have no cause number at all; newer ones have None until
+    the case is filed.
+    """
+    if 'case_id' not in vars(case):
+        case.case_id = None
+
+
+@upgrade(3)
+def add_closed(case):
+    """
+    Cases saved before cases could be closed are open.
+    """
+    if 'closed' not in vars(case):
+        case.closed = False
@@ -0,0 +1,117 @@
+"""
+case_transfer.py - Read and write streams of users' cases, for moving case
+lists between servers and backing them up.
+
+A stream is a sequence of records, each a dict with these keys:
+
+* type: 'profile' (a user's attorney profile) or 'case'
+* user: The user id.
+* key: The case key (cases only).
+* version: The case version (cases only).
+* summary: The case summary, as JSON text (cases only).
+* data: The value stored in Redis: the pickled profile, or the case envelope.
+  It is written as bytes; text, as read through a client that decodes
+  responses, is encoded as UTF-8.
+
+Records are written and read one at a time, so a stream of any size is
+handled in constant memory.
+
+Two formats are supported: *jsonl*, one JSON object per line with *data*
+base64 encoded, and *binary*, a magic header followed by length-prefixed
+fields.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import base64
+import json
+import struct
+
+FORMATS = ['jsonl', 'binary']
+
+BINARY_MAGIC = b'USCASES1'
+RECORD_TYPES = {'profile': 1, 'case': 2}
+RECORD_FIELDS = ['user', 'key', 'version', 'summary', 'data']
+LENGTH = struct.Struct('>I')
+
+
+def writer(stream, file_format: str):
+    """
+    Return a function that writes one record to a binary *stream*.
+    """
+    if file_format == 'jsonl':
+        return lambda record: stream.write(jsonl_record(record))
+    if file_format == 'binary':
+        stream.write(BINARY_MAGIC)
+        return lambda record: stream.write(binary_record(record))
+    raise ValueError(f"Unknown case stream format '{file_format}'")
+
+
+def reader(stream, file_format: str = None):
+    """
+    Yield the records in a binary *stream*. If *file_format* is omitted, it
+    is worked out from the stream's first bytes.
+    """
+    if file_format is None:
+        file_format = 'binary' if stream.peek(len(BINARY_MAGIC)).startswith(BINARY_MAGIC) \
+            else 'jsonl'
+    if file_format == 'jsonl':
+        return read_jsonl(stream)
+    if file_format == 'binary':
+        return read_binary(stream)
+    raise ValueError(f"Unknown case stream format '{file_format}'")
+
+
+def jsonl_record(record: dict) -> bytes:
+    data = record['data']
+    if isinstance(data, str):
+        data = data.encode()
+    record = dict(record, data=base64.b64encode(data).decode())
+    return json.dumps(record, separators=(',', ':')).encode() + b'\n'
+
+
+def read_jsonl(stream):
+    for line_number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            record['data'] = base64.b64decode(record['data'])
+        except (ValueError, KeyError) as e:
+            raise ValueError(f"Line {line_number}: {str(e)}")
+        yield record
+
+
+def binary_record(record: dict) -> bytes:
+    parts = [bytes([RECORD_TYPES[record['type']]])]
+    for field in RECORD_FIELDS:
+        value = record.get(field)
+        if value is None:
+            value = b''
+        elif not isinstance(value, bytes):
+            value = str(value).encode()
+        parts.append(LENGTH.pack(len(value)))
+        parts.append(value)
+    return b''.join(parts)
+
+
+def read_binary(stream):
+    if stream.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+        raise ValueError("Not a binary case stream")
+    types = {code: name for name, code in RECORD_TYPES.items()}
+    while True:
+        record_type = stream.read(1)
+        if not record_type:
+            return
+        record = {'type': types[record_type[0]]}
+        for field in RECORD_FIELDS:
+            length = LENGTH.unpack(read_exactly(stream, LENGTH.size))[0]
+            value = read_exactly(stream, length)
+            record[field] = value if field == 'data' else (value.decode() or None)
+        yield record
+
+
+def read_exactly(stream, size: int) -> bytes:
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError("Truncated binary case stream")
+    return data
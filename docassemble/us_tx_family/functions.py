@@ -7,20 +7,27 @@ from datetime import datetime
 from decimal import Decimal
 import json
 import os
+from . import metrics
+from .reference_cache import reference_data
 from .us_fred_data import FredUtil
+from . import us_tx_counties, us_tx_courts, us_tx_court_directory
 from .us_tx_counties import UsTxCounties
 from .us_tx_courts import UsTxCourts
 from .us_tx_court_directory import UsTxCourtDirectory
 from .us_tx_jails import UsTxJails
-from .us_case_list import UsCaseList
+from .case_schema import stamp
+from .us_case_list import PROFILE_KEY_TEMPLATE, UsCaseList
 
-from docassemble.base.functions import get_user_info
+from docassemble.base.functions import get_user_info, user_info
 from docassemble.base.legal import Case
 from docassemble.base.logger import logmessage
 from docassemble.base.util import ChildList, DAList, DARedis
 from .objects import Attorney, AttorneyList, RepresentedPartyList
 
-ME_KEY = '{}:me'
+ME_KEY = PROFILE_KEY_TEMPLATE
+
+# Number of cases listed on each page of the case picker.
+CASE_PAGE_SIZE = 20
 
 
 def avg_us_mortgage_rate(year: int, month: int, term_in_years: int = 30) -> Decimal:
@@ -35,12 +42,13 @@ def avg_us_mortgage_rate(year: int, month: int, term_in_years: int = 30) -> Deci
 def counties():
     # Run us_tx_counties.py to get a new list if Texas ever
     # adds/removes counties.
-    county_db = UsTxCounties()
+    county_db = reference_data(us_tx_counties.STORE, UsTxCounties)
     return county_db.get_counties()
 
 
 def courts(county: str, not_filed=True):
-    court_db = UsTxCourts()
+    court_db = reference_data(us_tx_courts.STORE, UsTxCourts,
+                              us_tx_courts.refresh_key())
     court_list = court_db.get_courts(county)
     if not_filed:
         court_list.insert(0, (None, "(NOT FILED)"))
@@ -48,17 +56,31 @@ def courts(county: str, not_filed=True):
 
 
 def court_staff(court: str):
-    directory = UsTxCourtDirectory()
+    directory = court_directory()
     staff_list = directory.get_court(court)
     return staff_list
 
 
 def clerk_staff(county: str):
-    directory = UsTxCourtDirectory()
+    directory = court_directory()
     staff_list = directory.get_clerk(county)
     return staff_list
 
 
+def find_court_staff(query: str, limit: int = 10):
+    """
+    Search court and clerk personnel by name, email, title, court or county.
+    """
+    directory = court_directory()
+    people = directory.search(query, limit)
+    return directory.dalist_of_individuals(people)
+
+
+def court_directory() -> UsTxCourtDirectory:
+    return reference_data(us_tx_court_directory.STORE, UsTxCourtDirectory,
+                          us_tx_court_directory.refresh_key())
+
+
 def estimate_loan_balance(p: int, year: int, month: int, term: int, interest_rate: Decimal):
     """
     Estimate the remaining balance due on a loan.
@@ -166,6 +188,26 @@ def my_cases(allow_add: bool = True):
     return cases
 
 
+def my_cases_page(query: str, page: int, allow_add: bool = True,
+                  page_size: int = CASE_PAGE_SIZE) -> list:
+    """
+    Return one page of the user's cases that match *query*, for a case
+    picker. Besides cases, the list has entries for adding a case (first
+    page only), for the previous and next pages, and for a new search.
+    """
+    case_db = UsCaseList(__user_id())
+    total, cases = case_db.search_cases(query, page * page_size, page_size)
+    if allow_add and page == 0:
+        cases.insert(0, ('*ADD*', "(ADD NEW CASE)"))
+    if page > 0:
+        cases.append(('*PREVIOUS*', "(PREVIOUS PAGE)"))
+    if (page + 1) * page_size < total:
+        last = min((page + 2) * page_size, total)
+        cases.append(('*NEXT*', f"(NEXT PAGE - {(page + 1) * page_size + 1} to {last} of {total})"))
+    cases.append(('*SEARCH*', "(NEW SEARCH)"))
+    return cases
+
+
 def initialize_case(case):
     # Set up a basic family law case.
     case.state = "TEXAS"
@@ -186,6 +228,8 @@ def initialize_case(case):
     case.initializeAttribute('liability', DAList)
     case.initializeAttribute('attorney', AttorneyList)
     case.initializeAttribute('me', Attorney)
+    case.closed = False
+    stamp(case)
     case.firstParty = case.petitioner
     case.secondParty = case.respondent
     case.me = me()
@@ -217,9 +261,25 @@ def del_cases(confirm: bool = False):
     case_db.del_cases()
 
 
-def save_case(case):
+def save_case(case, force: bool = False):
+    """
+    Save a case unless it is unchanged since it was last saved. Changes
+    saved by another interview since *case* was loaded are merged into it.
+
+    The result is true unless both interviews changed the same part of the
+    case, in which case nothing is saved unless *force* is True. Its
+    *written* attribute tells whether a write happened.
+    """
     case_db = UsCaseList(__user_id())
-    return case_db.save(case)
+    result = case_db.save(case, force=force)
+    if result.conflict:
+        outcome = 'conflicts'
+    elif result.written:
+        outcome = 'writes performed'
+    else:
+        outcome = 'writes skipped'
+    metrics.incr('save_case', f'{__interview()} {outcome}')
+    return result
 
 
 def save_me(about_me):
@@ -270,3 +330,14 @@ def __user_id() -> str:
     user_info = get_user_info()
     user_id = user_info['id']
     return str(user_id)
+
+
+def __interview() -> str:
+    """
+    Return the file name of the current interview, for counting things
+    per interview.
+    """
+    try:
+        return user_info().filename
+    except Exception:
+        return '(unknown interview)'
@@ -0,0 +1,209 @@
+"""
+http_client.py - The one place this package fetches anything over HTTP.
+
+Every fetch goes through a single pooled requests Session, so connections to
+a host are kept alive and reused, and is subject to:
+
+* Per-host connect and read timeouts, so a slow server cannot hold a worker
+  indefinitely.
+* A bounded number of retries, with jittered exponential backoff, for
+  connection errors, timeouts and 429/5xx responses.
+* A per-host circuit breaker: after repeated failures, requests to that host
+  fail immediately for a while, so callers fall back to cached data at once
+  instead of waiting out every timeout.
+
+Latency, retries, errors and rejected requests are counted per host in
+metrics, under the group "http {host}".
+
+Usage:
+```python
+from . import http_client
+page = http_client.get(URL)
+page.raise_for_status()
+```
+
+Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+from .local_config import local_config
+
+__all__ = ['CircuitOpenError', 'breaker_states', 'get', 'session']
+
+# Timeouts, in seconds, and retries for hosts not configured otherwise.
+CONNECT_SECONDS = 3.05
+READ_SECONDS = 30
+RETRIES = 2
+
+# Base of the exponential backoff between retries, in seconds.
+BACKOFF_SECONDS = 0.5
+
+# Responses worth retrying; anything else is returned to the caller.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Consecutive failed requests after which a host's circuit opens, and how
+# long it stays open before one trial request is let through.
+CIRCUIT_FAILURES = 5
+CIRCUIT_OPEN_SECONDS = 60
+
+# Connections kept alive per host.
+POOL_SIZE = 10
+
+_session = None
+_session_lock = threading.Lock()
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """
+    Raised, without making a request, while a host's circuit is open.
+    """
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Tracks consecutive failures for one host in this process.
+    """
+    def __init__(self, host: str):
+        self.host = host
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def check(self):
+        """
+        Raise CircuitOpenError if requests to the host should not be made.
+        Once the circuit has been open long enough, one caller is let
+        through to try the host again; the others keep failing fast until
+        that trial succeeds.
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return
+            open_seconds = host_setting(self.host, 'circuit open seconds', CIRCUIT_OPEN_SECONDS)
+            if time.monotonic() - self.opened_at < float(open_seconds):
+                metrics.incr(f'http {self.host}', 'rejected')
+                raise CircuitOpenError(f"Circuit open for {self.host}")
+            # Let this request through, but hold everyone else off for
+            # another period while it runs.
+            self.opened_at = time.monotonic()
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            threshold = int(host_setting(self.host, 'circuit failures', CIRCUIT_FAILURES))
+            if self.failures >= threshold and self.opened_at is None:
+                metrics.incr(f'http {self.host}', 'circuit opened')
+            if self.failures >= threshold:
+                self.opened_at = time.monotonic()
+
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        return 'open'
+
+
+def session() -> requests.Session:
+    """
+    Return the Session shared by this process, creating it if need be.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    """
+    GET *url* through the shared session.
+
+    Args:
+        url (str): URL to fetch.
+        kwargs: Passed to requests, e.g. headers or stream. A *timeout*
+        overrides the host's configured timeouts.
+    Returns:
+        (Response): The response, which may be an error other than 429/5xx.
+    Raises:
+        CircuitOpenError: The host has been failing; no request was made.
+        RequestException: The request failed after every retry.
+    """
+    host = urlsplit(url).hostname or ''
+    group = f'http {host}'
+    breaker = breaker_for(host)
+    breaker.check()
+
+    timeout = kwargs.pop('timeout', None) or (
+        float(host_setting(host, 'connect seconds', CONNECT_SECONDS)),
+        float(host_setting(host, 'read seconds', READ_SECONDS)))
+    retries = int(host_setting(host, 'retries', RETRIES))
+
+    for attempt in range(retries + 1):
+        if attempt:
+            metrics.incr(group, 'retries')
+            time.sleep(random.uniform(0, BACKOFF_SECONDS * 2 ** attempt))
+        started = time.monotonic()
+        try:
+            response = session().get(url, timeout=timeout, **kwargs)
+        except requests.exceptions.RequestException as e:
+            metrics.incr(group, 'errors')
+            error = e
+            continue
+        metrics.observe(group, 'latency', time.monotonic() - started)
+        if response.status_code not in RETRY_STATUSES:
+            breaker.succeeded()
+            return response
+        metrics.incr(group, 'errors')
+        error = requests.exceptions.HTTPError(
+            f"{response.status_code} from {host}", response=response)
+    breaker.failed()
+    raise error
+
+
+def breaker_for(host: str) -> CircuitBreaker:
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host)
+        return _breakers[host]
+
+
+def breaker_states() -> dict:
+    """
+    The state of each host's circuit in this process, for diagnostics.
+
+    Returns:
+        (dict): {'state': 'open' or 'closed', 'failures': n} indexed by host.
+    """
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.host: {'state': breaker.state(), 'failures': breaker.failures}
+            for breaker in breakers}
+
+
+def host_setting(host: str, name: str, default):
+    """
+    Look up an HTTP setting for *host*: first in the 'http hosts' setting,
+    a dict of settings indexed by host name, then in 'http {name}'.
+    """
+    hosts = local_config('http hosts', None) or {}
+    value = (hosts.get(host) or {}).get(name)
+    if value is None:
+        value = local_config(f'http {name}', default)
+    return value
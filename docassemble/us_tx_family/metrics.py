@@ -0,0 +1,151 @@
+"""
+metrics.py - Lightweight counters for the us-tx-family package.
+
+Counters are accumulated in process memory and periodically flushed into a
+single Redis hash so that operators can see totals across every uwsgi worker
+without paying a Redis round trip for each event.
+
+Usage:
+```python
+from . import metrics
+metrics.incr('us_tx_courts.json', 'rebuilds suppressed')
+metrics.observe('us_tx_courts.json', 'waiter blocked', elapsed_seconds)
+print(metrics.counters())
+```
+
+Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import threading
+import time
+
+try:
+    from docassemble.base.util import DARedis
+    from docassemble.base.logger import logmessage
+except ModuleNotFoundError:
+    def logmessage(message: str):
+        print(message)
+
+from .local_config import local_config
+
+__all__ = ['counters', 'flush', 'incr', 'local_counters', 'observe']
+
+# The redis key of the hash that holds the flushed counters.
+METRICS_KEY = 'us_tx_family:metrics'
+
+# How often, in seconds, to push accumulated counters to Redis.
+FLUSH_SECONDS = 60
+
+_lock = threading.Lock()
+_pending = {}  # Counter deltas not yet flushed to Redis
+_totals = {}   # Counters for this process since it started
+_last_flush = time.monotonic()
+
+
+def incr(group: str, name: str, amount: float = 1):
+    """
+    Increment a counter.
+
+    Args:
+        group (str): What is being measured, usually a STORE name.
+        name (str): Name of the counter within *group*.
+        amount (float): Amount to add to the counter.
+    Returns:
+        None
+    """
+    field = f'{group}:{name}'
+    with _lock:
+        _pending[field] = _pending.get(field, 0) + amount
+        _totals[field] = _totals.get(field, 0) + amount
+    _maybe_flush()
+
+
+def observe(group: str, name: str, seconds: float):
+    """
+    Record a duration. Two counters are kept for each duration: the number
+    of observations (*name* count) and their sum (*name* seconds), from which
+    an average can be computed.
+
+    Args:
+        group (str): What is being measured, usually a STORE name.
+        name (str): Name of the duration within *group*.
+        seconds (float): Duration being recorded.
+    Returns:
+        None
+    """
+    incr(group, f'{name} count')
+    incr(group, f'{name} seconds', seconds)
+
+
+def local_counters() -> dict:
+    """
+    Counters recorded by this process since it started.
+    """
+    with _lock:
+        return dict(_totals)
+
+
+def flush(the_redis=None) -> bool:
+    """
+    Push accumulated counters to Redis.
+
+    Args:
+        the_redis (DARedis): Connection to use. One is created if omitted.
+    Returns:
+        (bool): True if successful, otherwise False.
+    """
+    global _last_flush
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush = time.monotonic()
+    if not pending:
+        return True
+    try:
+        the_redis = the_redis or DARedis()
+        pipe = the_redis.pipeline(transaction=False)
+        for field, amount in pending.items():
+            pipe.hincrbyfloat(METRICS_KEY, field, amount)
+        pipe.execute()
+        return True
+    except Exception as e:
+        # Put the deltas back so they are not lost.
+        with _lock:
+            for field, amount in pending.items():
+                _pending[field] = _pending.get(field, 0) + amount
+        logmessage(f"Unable to flush metrics: {str(e)}")
+    return False
+
+
+def counters(the_redis=None) -> dict:
+    """
+    Counters for every process, as flushed to Redis. This process's pending
+    counters are flushed first.
+
+    Args:
+        the_redis (DARedis): Connection to use. One is created if omitted.
+    Returns:
+        (dict): Counter values indexed by "group:name".
+    """
+    try:
+        the_redis = the_redis or DARedis()
+        flush(the_redis)
+        values = the_redis.hgetall(METRICS_KEY) or {}
+    except Exception as e:
+        logmessage(f"Unable to read metrics: {str(e)}")
+        return local_counters()
+    return {_text(field): float(value) for field, value in values.items()}
+
+
+def _maybe_flush():
+    """
+    Flush to Redis if it has been a while since the last flush.
+    """
+    interval = local_config('metrics flush seconds', FLUSH_SECONDS)
+    if time.monotonic() - _last_flush >= float(interval):
+        flush()
+
+
+def _text(value) -> str:
+    if isinstance(value, bytes):
+        return value.decode()
+    return str(value)
@@ -0,0 +1,246 @@
+"""
+partitioned_store.py - Store a dataset in Redis as hashes with one field
+per record, so that a lookup only transfers the record it needs.
+
+A dataset named *store* is laid out as:
+
+* ``{store}:manifest`` - a small pickled dict, e.g. the refresh key.
+* ``{store}:{partition}`` - a hash per partition, one pickled value per field.
+* ``{store}:version`` - the version stamp used by reference_cache.
+* ``{store}:digests`` - a hash of each record's digest, used to find the
+  records that changed between rebuilds.
+* ``{store}:changes`` - a capped list of JSON change summaries, newest first.
+
+Writes happen in a single MULTI/EXEC transaction, so readers see either the
+old dataset or the new one, never a mixture.
+
+Pickles are stored base64 encoded, as DARedis.set_data() stores them,
+because DARedis decodes every value it reads as UTF-8.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import base64
+import binascii
+import hashlib
+import json
+import pickle
+
+try:
+    from docassemble.base.util import DARedis
+except ModuleNotFoundError:
+    pass
+
+from .reference_cache import version_key
+
+__all__ = ['PartitionedStore']
+
+# How many change summaries to keep.
+CHANGE_LOG_LENGTH = 90
+
+
+class PartitionedStore(object):
+    """
+    A dataset stored as Redis hashes.
+    """
+    def __init__(self, store: str, the_redis=None):
+        """
+        Initialize an instance.
+
+        Args:
+            store (str): Name of the dataset, e.g. 'us_tx_courts.json'.
+            the_redis (DARedis): Connection to use. One is created if omitted.
+        """
+        self.store = store
+        self.manifest_key = f'{store}:manifest'
+        self.digests_key = f'{store}:digests'
+        self.changes_key = f'{store}:changes'
+        self.the_redis = the_redis
+
+    def partition_key(self, partition: str) -> str:
+        return f'{self.store}:{partition}'
+
+    def read_manifest(self) -> dict:
+        """
+        Returns the dataset's manifest or None if the dataset does not exist.
+        """
+        return loads(self.redis().get(self.manifest_key))
+
+    def get(self, partition: str, field: str):
+        """
+        Returns a single record, or None if it does not exist.
+        """
+        return loads(self.redis().hget(self.partition_key(partition), field))
+
+    def get_many(self, partition: str, fields: list) -> list:
+        """
+        Returns a list of records in the same order as *fields*. Missing
+        records are None.
+        """
+        if not fields:
+            return []
+        values = self.redis().hmget(self.partition_key(partition), fields)
+        return [loads(value) for value in values]
+
+    def get_all(self, partition: str) -> dict:
+        """
+        Returns every record in a partition, indexed by field.
+        """
+        values = self.redis().hgetall(self.partition_key(partition)) or {}
+        return {text(field): loads(value) for field, value in values.items()}
+
+    def fields(self, partition: str) -> list:
+        """
+        Returns the names of every field in a partition.
+        """
+        return [text(field) for field in self.redis().hkeys(self.partition_key(partition))]
+
+    def write(self, partitions: dict, manifest: dict):
+        """
+        Replace the whole dataset.
+
+        Args:
+            partitions (dict): Dicts of records indexed by partition name.
+            manifest (dict): The dataset's new manifest.
+        Returns:
+            None
+        """
+        pipe = self.redis().pipeline(transaction=True)
+        # Remove the monolithic value we used to store under *store*.
+        pipe.delete(self.store)
+        pipe.delete(self.digests_key)
+        for partition, records in partitions.items():
+            key = self.partition_key(partition)
+            pipe.delete(key)
+            if records:
+                values = {field: dumps(value) for field, value in records.items()}
+                pipe.hset(key, mapping=values)
+                pipe.hset(self.digests_key, mapping={
+                    digest_field(partition, field): digest(value)
+                    for field, value in values.items()})
+        pipe.set(self.manifest_key, dumps(manifest))
+        pipe.incr(version_key(self.store))
+        pipe.execute()
+
+    def diff(self, partitions: dict) -> dict:
+        """
+        Compare a complete new dataset with the stored one, record by record,
+        using the stored digests.
+
+        Args:
+            partitions (dict): Dicts of records indexed by partition name.
+        Returns:
+            (dict): For each partition, 'changed' maps each added or modified
+            field to its new serialized value, and 'removed' lists the
+            fields that no longer exist. None if nothing is stored yet.
+        """
+        stored = self.redis().hgetall(self.digests_key) or {}
+        if not stored:
+            return None
+        stored = {text(field): text(value) for field, value in stored.items()}
+        delta = {}
+        for partition, records in partitions.items():
+            prefix = digest_field(partition, '')
+            old_fields = {field[len(prefix):]: value
+                          for field, value in stored.items()
+                          if field.startswith(prefix)}
+            changed = {}
+            for field, record in records.items():
+                value = dumps(record)
+                if old_fields.get(field) != digest(value):
+                    changed[field] = value
+            removed = [field for field in old_fields if field not in records]
+            delta[partition] = {'changed': changed, 'removed': removed}
+        return delta
+
+    def apply(self, delta: dict, manifest: dict, change: dict = None):
+        """
+        Write only the records in *delta*, as returned by *diff()*.
+
+        Args:
+            delta (dict): Changed and removed records for each partition.
+            manifest (dict): The dataset's new manifest.
+            change (dict): Summary of the change to add to the change log.
+        Returns:
+            None
+        """
+        pipe = self.redis().pipeline(transaction=True)
+        changed_any = False
+        for partition, records in delta.items():
+            key = self.partition_key(partition)
+            if records['changed']:
+                changed_any = True
+                pipe.hset(key, mapping=records['changed'])
+                pipe.hset(self.digests_key, mapping={
+                    digest_field(partition, field): digest(value)
+                    for field, value in records['changed'].items()})
+            if records['removed']:
+                changed_any = True
+                pipe.hdel(key, *records['removed'])
+                pipe.hdel(self.digests_key, *[digest_field(partition, field)
+                                              for field in records['removed']])
+        pipe.set(self.manifest_key, dumps(manifest))
+        if changed_any:
+            pipe.incr(version_key(self.store))
+        if change is not None:
+            pipe.lpush(self.changes_key, json.dumps(change))
+            pipe.ltrim(self.changes_key, 0, CHANGE_LOG_LENGTH - 1)
+        pipe.execute()
+
+    def changes(self, limit: int = 10) -> list:
+        """
+        Returns the most recent change summaries, newest first.
+        """
+        entries = self.redis().lrange(self.changes_key, 0, limit - 1) or []
+        return [json.loads(text(entry)) for entry in entries]
+
+    def write_manifest(self, manifest: dict, bump: bool = True):
+        """
+        Replace the manifest without touching the records.
+
+        Args:
+            manifest (dict): The dataset's new manifest.
+            bump (bool): Whether to change the version stamp. There is no
+            need to when the records are known to be unchanged.
+        Returns:
+            None
+        """
+        pipe = self.redis().pipeline(transaction=True)
+        pipe.set(self.manifest_key, dumps(manifest))
+        if bump:
+            pipe.incr(version_key(self.store))
+        pipe.execute()
+
+    def redis(self):
+        if self.the_redis is None:
+            self.the_redis = DARedis()
+        return self.the_redis
+
+
+def dumps(value) -> str:
+    return base64.b64encode(pickle.dumps(value)).decode()
+
+
+def loads(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.encode()
+    try:
+        value = base64.b64decode(value, validate=True)
+    except binascii.Error:
+        pass  # Written as a raw pickle, before values were encoded
+    return pickle.loads(value)
+
+
+def digest(value: str) -> str:
+    return hashlib.blake2b(value.encode(), digest_size=16).hexdigest()
+
+
+def digest_field(partition: str, field: str) -> str:
+    return f'{partition}:{field}'
+
+
+def text(value) -> str:
+    if isinstance(value, bytes):
+        return value.decode()
+    return str(value)
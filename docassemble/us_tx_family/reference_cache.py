@@ -0,0 +1,107 @@
+"""
+reference_cache.py - Process-local cache of reference datasets (counties,
+courts, court personnel).
+
+Each dataset is loaded from Redis at most once per process for as long as
+its refresh key is unchanged and nobody has saved a new copy. Whenever a
+dataset is saved, its version stamp (a small integer key next to the
+dataset) is incremented, which is how other processes learn that their
+copy is out of date without re-reading the dataset itself.
+
+Usage:
+```python
+court_db = reference_data(STORE, UsTxCourts, refresh_key())
+```
+
+Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import threading
+
+try:
+    from docassemble.base.util import DARedis
+    from docassemble.base.logger import logmessage
+except ModuleNotFoundError:
+    def logmessage(message: str):
+        print(message)
+
+from . import metrics
+
+__all__ = ['bump_version', 'clear', 'reference_data', 'version_stamp']
+
+# Name of the metrics group for cache hits and misses.
+METRICS_GROUP = 'reference_cache'
+
+_lock = threading.Lock()
+_entries = {}  # Indexed by store name: (refresh_key, version, instance)
+
+
+def reference_data(store: str, factory, key: str = ''):
+    """
+    Return the cached instance of a reference dataset, creating a new one
+    if the cached instance is missing or out of date.
+
+    The instance is shared by every caller in the process, so its methods
+    must hand out copies of anything a caller might change.
+
+    Args:
+        store (str): Redis key of the dataset, e.g. 'us_tx_courts.json'.
+        factory (callable): Creates and loads a new instance.
+        key (str): The dataset's current refresh key.
+    Returns:
+        The instance created by *factory*.
+    """
+    version = version_stamp(store)
+    with _lock:
+        entry = _entries.get(store)
+    if entry is not None and entry[0] == key and entry[1] == version:
+        metrics.incr(METRICS_GROUP, f'{store} hits')
+        return entry[2]
+
+    metrics.incr(METRICS_GROUP, f'{store} misses')
+    instance = factory()
+    # Cache the instance under the stamp read before loading. Reading it
+    # again here could pick up a save made by another process after we
+    # loaded, and keep our stale copy forever. If loading saved the dataset
+    # itself, the next call is one extra miss.
+    with _lock:
+        _entries[store] = (key, version, instance)
+    return instance
+
+
+def clear(store: str = None):
+    """
+    Forget one cached dataset, or all of them if *store* is omitted.
+    """
+    with _lock:
+        if store is None:
+            _entries.clear()
+        else:
+            _entries.pop(store, None)
+
+
+def version_stamp(store: str, the_redis=None) -> str:
+    """
+    Returns the version stamp of a dataset, or None if it has none or
+    Redis is unavailable.
+    """
+    try:
+        the_redis = the_redis or DARedis()
+        version = the_redis.get(version_key(store))
+    except Exception as e:
+        logmessage(f"Unable to read version of {store}: {str(e)}")
+        return None
+    if isinstance(version, bytes):
+        version = version.decode()
+    return version
+
+
+def bump_version(store: str, the_redis=None):
+    """
+    Mark a dataset as changed. Call this whenever the dataset is saved.
+    """
+    the_redis = the_redis or DARedis()
+    the_redis.incr(version_key(store))
+
+
+def version_key(store: str) -> str:
+    return f'{store}:version'
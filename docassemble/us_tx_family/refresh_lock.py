@@ -0,0 +1,130 @@
+"""
+refresh_lock.py - A Redis-backed single-flight lock for rebuilding cached
+reference data.
+
+When a cached dataset expires, every worker that notices would otherwise
+rebuild it at the same time. Whoever acquires the lock rebuilds; everyone
+else keeps serving what they already have or, if there is nothing to serve,
+waits for the winner to finish.
+
+Usage:
+```python
+lock = RefreshLock(STORE)
+if lock.acquire():
+    try:
+        rebuild()
+    finally:
+        lock.release()
+```
+
+Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import time
+import uuid
+
+try:
+    from docassemble.base.util import DARedis
+    from docassemble.base.logger import logmessage
+except ModuleNotFoundError:
+    def logmessage(message: str):
+        print(message)
+
+# Only delete the lock if it still holds our token. Otherwise a slow
+# rebuild could release a lock that has since expired and been taken
+# by another process.
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Seconds after which an abandoned lock expires.
+LOCK_SECONDS = 300
+
+# Seconds between checks while waiting for another process's rebuild.
+POLL_SECONDS = 0.25
+
+
+class RefreshLock(object):
+    """
+    A lock, held by at most one process, guarding the rebuild of *name*.
+    """
+    def __init__(self, name: str, ttl: int = LOCK_SECONDS, the_redis=None):
+        """
+        Initialize an instance.
+
+        Args:
+            name (str): Name of the dataset being rebuilt, usually a STORE.
+            ttl (int): Seconds after which an unreleased lock expires.
+            the_redis (DARedis): Connection to use. One is created if omitted.
+        """
+        self.name = name
+        self.key = f'{name}:refresh_lock'
+        self.ttl = int(ttl)
+        self.token = None
+        self.the_redis = the_redis
+
+    def acquire(self) -> bool:
+        """
+        Try to acquire the lock without blocking.
+
+        Returns:
+            (bool): True if this process now holds the lock. If Redis is
+            unavailable, True, so that callers fall back to rebuilding.
+        """
+        token = uuid.uuid4().hex
+        try:
+            acquired = self.redis().set(self.key, token, nx=True, ex=self.ttl)
+        except Exception as e:
+            logmessage(f"Unable to acquire refresh lock for {self.name}: {str(e)}")
+            return True
+        if acquired:
+            self.token = token
+            return True
+        return False
+
+    def release(self):
+        """
+        Release the lock if this process holds it.
+        """
+        if self.token is None:
+            return
+        try:
+            self.redis().eval(RELEASE_SCRIPT, 1, self.key, self.token)
+        except Exception as e:
+            logmessage(f"Unable to release refresh lock for {self.name}: {str(e)}")
+        self.token = None
+
+    def held(self) -> bool:
+        """
+        Returns True if any process holds the lock.
+        """
+        try:
+            return bool(self.redis().exists(self.key))
+        except Exception:
+            return False
+
+    def wait(self, ready, timeout: float) -> bool:
+        """
+        Block until *ready()* returns True, the lock is released or *timeout*
+        seconds have elapsed.
+
+        Args:
+            ready (callable): Returns True once the rebuild is visible.
+            timeout (float): Maximum number of seconds to wait.
+        Returns:
+            (bool): The last value returned by *ready()*.
+        """
+        deadline = time.monotonic() + float(timeout)
+        while True:
+            if ready():
+                return True
+            if not self.held() or time.monotonic() >= deadline:
+                return ready()
+            time.sleep(POLL_SECONDS)
+
+    def redis(self):
+        if self.the_redis is None:
+            self.the_redis = DARedis()
+        return self.the_redis
@@ -0,0 +1,100 @@
+"""
+snapshots.py - Read and write the snapshots of reference data that ship
+with the package.
+
+A snapshot is a gzipped JSON record holding a dataset as it was when the
+package was built, so that loaders have something to serve at once when
+Redis is empty, e.g. in a fresh container, instead of scraping three
+websites inside the first user's request. Snapshots are written by
+build_snapshots.py.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+from datetime import datetime, timezone
+import gzip
+import json
+import os
+import threading
+
+try:
+    from docassemble.base.logger import logmessage
+except ModuleNotFoundError:
+    def logmessage(message: str):
+        print(message)
+
+__all__ = ['read_snapshot', 'write_snapshot']
+
+# Where snapshots are kept within the package.
+SNAPSHOT_DIR = os.path.join(os.path.dirname(__file__), 'data', 'sources')
+
+# Change this when the layout of the snapshot record changes. Snapshots in
+# any other format are ignored.
+SNAPSHOT_FORMAT = 1
+
+_snapshots = {}  # Snapshots already read by this process, by name
+_snapshots_lock = threading.Lock()
+
+
+def snapshot_path(name: str, directory: str = None) -> str:
+    return os.path.join(directory or SNAPSHOT_DIR, f'{name}.snapshot.json.gz')
+
+
+def read_snapshot(name: str) -> dict:
+    """
+    Return the data in the packaged snapshot of *name*, or None if there is
+    no usable snapshot. Each snapshot is read at most once per process.
+
+    Args:
+        name (str): Name of the dataset, e.g. 'us_tx_counties'.
+    Returns:
+        (dict): The dataset, plus its 'generated' timestamp.
+    """
+    with _snapshots_lock:
+        if name in _snapshots:
+            return _snapshots[name]
+    path = snapshot_path(name)
+    snapshot = None
+    if os.path.exists(path):
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                record = json.load(f)
+            if record.get('format') == SNAPSHOT_FORMAT:
+                snapshot = dict(record['data'], generated=record['generated'])
+            else:
+                logmessage(f"Ignoring snapshot {path} in format {record.get('format')}")
+        except Exception as e:
+            logmessage(f"Unable to read snapshot {path}: {str(e)}")
+    with _snapshots_lock:
+        _snapshots[name] = snapshot
+    return snapshot
+
+
+def write_snapshot(name: str, data: dict, source: str, directory: str = None) -> str:
+    """
+    Write a snapshot of *name*.
+
+    Args:
+        name (str): Name of the dataset.
+        data (dict): The dataset. Must be JSON serializable.
+        source (str): Where the dataset came from.
+        directory (str): Where to write it. Defaults to the package's
+        data/sources directory.
+    Returns:
+        (str): Path of the snapshot written.
+    """
+    record = {
+        'format': SNAPSHOT_FORMAT,
+        'name': name,
+        'source': source,
+        'generated': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'data': data
+    }
+    path = snapshot_path(name, directory)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so a failed build never leaves a
+    # truncated snapshot behind. mtime=0 keeps rebuilds of unchanged data
+    # byte-for-byte identical apart from the 'generated' stamp.
+    with gzip.GzipFile(path + '.tmp', 'wb', mtime=0) as f:
+        f.write(json.dumps(record, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+    os.replace(path + '.tmp', path)
+    return path
@@ -0,0 +1,115 @@
+"""
+token_index.py - An in-memory inverted index with prefix matching.
+
+Usage:
+```python
+index = TokenIndex(people, {'last name': 3, 'first name': 2, 'email': 3})
+index.search('smi jo', limit=10)
+```
+
+Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+from bisect import bisect_left
+import heapq
+import re
+
+__all__ = ['TokenIndex', 'tokenize']
+
+TOKEN = re.compile(r'[a-z0-9]+')
+
+
+def tokenize(*values) -> list:
+    """
+    Break values into lowercase alphanumeric tokens. An email address is
+    also kept whole so that it can be matched exactly.
+
+    Args:
+        values: Strings (or anything that can be made into one) to tokenize.
+    Returns:
+        (list): Unique tokens in the order they were found.
+    """
+    tokens = []
+    for value in values:
+        if value is None:
+            continue
+        text = str(value).lower()
+        if '@' in text:
+            tokens.extend(part for part in text.split() if '@' in part)
+        tokens.extend(TOKEN.findall(text))
+    return list(dict.fromkeys(tokens))
+
+
+class TokenIndex(object):
+    """
+    Maps every token in selected fields of a list of dicts back to the dicts
+    that contain it.
+    """
+    def __init__(self, items: list, weights: dict):
+        """
+        Build the index.
+
+        Args:
+            items (list): The dicts to index. Ties in search results are
+            returned in this order.
+            weights (dict): How much a match on each field counts, indexed
+            by field name. Fields not listed are not indexed.
+        """
+        postings = {}
+        for position, item in enumerate(items):
+            for field, weight in weights.items():
+                for token in tokenize(item.get(field)):
+                    token_postings = postings.setdefault(token, {})
+                    if weight > token_postings.get(position, 0):
+                        token_postings[position] = weight
+        self.items = items
+        self.tokens = sorted(postings)
+        self.postings = [tuple(postings[token].items()) for token in self.tokens]
+
+    def search(self, query: str, limit: int = 10) -> list:
+        """
+        Find the items that match every term in *query*, where a term
+        matches any token it is a prefix of.
+
+        Items are ranked by the sum, over the query's terms, of the weight of
+        the best field each term matched. A term that matches a whole token
+        counts double.
+
+        Args:
+            query (str): Search terms.
+            limit (int): Maximum number of items to return.
+        Returns:
+            (list): Matching items, best first.
+        """
+        terms = tokenize(query)
+        # An email address already matches as a whole, so its pieces
+        # would only slow the search down.
+        emails = [term for term in terms if '@' in term]
+        terms = [term for term in terms
+                 if '@' in term or not any(term in email for email in emails)]
+
+        scores = None
+        for term in terms:
+            term_scores = {}
+            idx = bisect_left(self.tokens, term)
+            while idx < len(self.tokens) and self.tokens[idx].startswith(term):
+                bonus = 2 if self.tokens[idx] == term else 1
+                for position, weight in self.postings[idx]:
+                    if weight * bonus > term_scores.get(position, 0):
+                        term_scores[position] = weight * bonus
+                idx += 1
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {position: score + term_scores[position]
+                          for position, score in scores.items()
+                          if position in term_scores}
+            if not scores:
+                return []
+        if not scores:
+            return []
+        best = heapq.nsmallest(int(limit), scores.items(),
+                               key=lambda item: (-item[1], item[0]))
+        return [self.items[position] for position, score in best]
+
+    def __len__(self):
+        return len(self.items)
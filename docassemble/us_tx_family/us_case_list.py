@@ -3,67 +3,388 @@ us_case_list.py - CRUD-provider fro a user's case list
 
 Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
 """
+import base64
+import copy
 from datetime import date
+import hashlib
+import io
 import json
 import pickle
 import sys
+import time
 import uuid
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    # zstd is optional; zlib is always available.
+    zstandard = None
 
 from docassemble.base.core import DAList
+from docassemble.base.functions import fix_pickle_obj
 from docassemble.base.util import DARedis, Individual, IndividualName,\
     Address
 from docassemble.base.logger import logmessage
+from redis.exceptions import WatchError
+
+from .case_archive import CaseArchive, archive_months
+from .case_schema import upgrade_case
+from .local_config import local_config
+from .objects import Attorney
+from .refresh_lock import RefreshLock
+from .token_index import tokenize
 
+# Where all of a user's cases used to be stored as a single pickled dict.
 CASES_KEY_TEMPLATE = '{}:us_case_list'
 
+# Where a user's cases are stored: a hash with one field per case key.
+CASE_HASH_TEMPLATE = '{}:us_cases'
+
+# Where the summary of each case, used to populate dropdowns, is stored:
+# a hash with one JSON field per case key.
+SUMMARY_HASH_TEMPLATE = '{}:us_case_summaries'
+
+# Summaries in an older format are rebuilt from their cases when read.
+SUMMARY_FORMAT = 3
+
+# Where the case search index is stored: a sorted set, all scores 0, whose
+# members are "token NUL case key", so that ZRANGEBYLEX finds every case
+# having a token that starts with a search term.
+TOKEN_INDEX_TEMPLATE = '{}:us_case_tokens'
+
+# Where the cases are kept in dropdown order: a sorted set, all scores 0,
+# whose members are "dropdown text NUL case key".
+ORDER_INDEX_TEMPLATE = '{}:us_case_order'
+
+# Where the format of a user's search index is stored. The index is rebuilt
+# from the case summaries if this is missing or out of date.
+INDEX_FORMAT_KEY_TEMPLATE = '{}:us_case_index_format'
+INDEX_FORMAT = 2
+
+# Where the fingerprint of each case as last written is stored: a hash with
+# one field per case key.
+FINGERPRINT_HASH_TEMPLATE = '{}:us_case_fingerprints'
+
+# Where the version number of each case is stored: a hash with one field
+# per case key. The version is bumped every time the case is written.
+VERSION_HASH_TEMPLATE = '{}:us_case_versions'
+
+# Where digests of each attribute of recent versions of each case are
+# stored: a hash with one JSON field per "case key:version". These are the
+# common ancestors used to merge concurrent saves.
+HISTORY_HASH_TEMPLATE = '{}:us_case_history'
+
+# How many versions of each case to keep attribute digests for.
+HISTORY_LENGTH = 20
+
+# How many times to retry a save that raced with another save.
+SAVE_RETRIES = 5
+
+# The case attribute holding the version the case was loaded at.
+VERSION_ATTRIBUTE = 'us_case_version'
+
+# Stored cases are wrapped in a text envelope, because DARedis decodes every
+# value it reads as UTF-8: *ENVELOPE_MAGIC*, a format digit, a codec digit,
+# and then the (possibly compressed) pickled case, base64 encoded.
+ENVELOPE_MAGIC = 'US:'
+ENVELOPE_FORMAT = 2
+CODECS = {'none': 0, 'zlib': 1, 'zstd': 2}
+
+# Cases stored by a client that did not decode responses may instead be in
+# the first, binary envelope: *BINARY_ENVELOPE_MAGIC*, a format byte (1), a
+# codec byte and the payload. Older cases are bare pickles, which never
+# start with a NUL byte.
+BINARY_ENVELOPE_MAGIC = b'\x00US'
+BINARY_ENVELOPE_FORMAT = 1
+
+# Codec used to compress cases unless configured otherwise.
+DEFAULT_CODEC = 'zlib'
+
+# Where a user's legacy case list is kept after it has been migrated.
+MIGRATED_KEY_TEMPLATE = '{}:us_case_list:migrated'
+
+# Seconds after which an abandoned migration lock expires, and the longest
+# another process waits for a migration to finish.
+MIGRATION_LOCK_SECONDS = 120
+
+# Where the keys of a user's archived cases are stored: a set. The cases
+# themselves are in the CaseArchive.
+ARCHIVED_SET_TEMPLATE = '{}:us_case_archived'
+
+# Where a user's attorney profile is stored, by functions.save_me().
+PROFILE_KEY_TEMPLATE = '{}:me'
+
+# Stored cases refer to the user's attorney profile by this persistent id
+# rather than embedding a copy of it.
+PROFILE_REF = 'us_attorney_profile'
+
+# Marks the attorney profile as not yet read; None means there is none.
+NOT_READ = object()
+
 
 class UsCaseList(object):
     """
     Persists  users' case information between sessions and interviews
     """
-    def __init__(self, user_id: str):
+    def __init__(self, user_id: str, the_redis=None):
         """
         Initialize and instance.
+
+        Args:
+            user_id (str): The user whose cases these are.
+            the_redis: Redis connection to use. A DARedis is created if
+            omitted; command line tools pass a plain redis client.
         """
-        self.cases = {}
         self.user_id = user_id
         self.user_cases_key = CASES_KEY_TEMPLATE.format(self.user_id)
+        self.cases_key = CASE_HASH_TEMPLATE.format(self.user_id)
+        self.summaries_key = SUMMARY_HASH_TEMPLATE.format(self.user_id)
+        self.fingerprints_key = FINGERPRINT_HASH_TEMPLATE.format(self.user_id)
+        self.versions_key = VERSION_HASH_TEMPLATE.format(self.user_id)
+        self.history_key = HISTORY_HASH_TEMPLATE.format(self.user_id)
+        self.profile_key = PROFILE_KEY_TEMPLATE.format(self.user_id)
+        self.tokens_key = TOKEN_INDEX_TEMPLATE.format(self.user_id)
+        self.order_key = ORDER_INDEX_TEMPLATE.format(self.user_id)
+        self.index_format_key = INDEX_FORMAT_KEY_TEMPLATE.format(self.user_id)
+        self.archived_key = ARCHIVED_SET_TEMPLATE.format(self.user_id)
+        self.the_redis = the_redis or DARedis()
+        self.migrated = 0
+        self.upgraded = 0
+        self._profile = NOT_READ
+        self._archive = NOT_READ
         self.load()
 
     def load(self):
         """
-        Load cases from persistant storage.
+        Prepare the user's cases for use. Cases are read one at a time as
+        they are needed, so all this does is migrate a legacy case list.
+        """
+        if self.the_redis.exists(self.user_cases_key):
+            self.migrated = self.migrate()
+
+    def migrate(self) -> int:
+        """
+        Move cases from the legacy single-value case list into per-case hash
+        fields. This is safe to run more than once and to resume after a
+        failure: a case that already has a hash field is never overwritten,
+        and the legacy value is only renamed out of the way once every case
+        has been copied.
+
+        Only one process migrates a user's cases at a time. Others wait for
+        it, rather than copying cases again, which would bring back a case
+        deleted in the meantime.
+
+        Returns:
+            (int): Number of cases copied.
+        """
+        lock = RefreshLock(self.user_cases_key, ttl=MIGRATION_LOCK_SECONDS,
+                           the_redis=self.the_redis)
+        if not lock.acquire():
+            lock.wait(lambda: not self.the_redis.exists(self.user_cases_key),
+                      MIGRATION_LOCK_SECONDS)
+            return 0
+        try:
+            return self.migrate_locked()
+        finally:
+            lock.release()
+
+    def migrate_locked(self) -> int:
+        cases = self.read_legacy()
+        if cases is None:
+            return 0
+        copied = 0
+        for key, case in cases.items():
+            upgrade_case(case)
+            if self.the_redis.hsetnx(self.cases_key, key, encode(self.dumps(case))):
+                previous = self.the_redis.hget(self.summaries_key, key)
+                modified = json.loads(previous).get('modified') if previous is not None else None
+                self.the_redis.hset(self.summaries_key, key,
+                                    json.dumps(case_summary(case, modified)))
+                copied += 1
+        try:
+            self.the_redis.rename(self.user_cases_key,
+                                  MIGRATED_KEY_TEMPLATE.format(self.user_id))
+        except Exception as e:
+            # Another process finished the migration first.
+            logmessage(f"migrate(): {str(e)}")
+        # Index the copied cases next time someone searches.
+        self.the_redis.delete(self.index_format_key)
+        logmessage(f"migrate(): Copied {copied} of {len(cases)} cases " +
+                   f"for user = {self.user_id}")
+        return copied
+
+    def read_legacy(self) -> dict:
+        """
+        Read the legacy case list, which was written by DARedis.set_data(),
+        the way DARedis.get_data() reads it.
+        """
+        if hasattr(self.the_redis, 'get_data'):
+            return self.the_redis.get_data(self.user_cases_key)
+        data = self.the_redis.get(self.user_cases_key)
+        return fix_pickle_obj(data) if data is not None else None
+
+    def keys(self) -> list:
+        """
+        Return the keys of all of the user's cases.
         """
-        the_redis = DARedis()
-        cases = the_redis.get_data(self.user_cases_key) or {}
-        self.cases = cases
+        return [text(key) for key in self.the_redis.hkeys(self.cases_key)]
 
     def get_cases(self) -> list:
         """
         Return a list of cases sorted by the text that appears in
-        a dropdown.
+        a dropdown. Only the cases' summaries are read.
 
         Args:
             None
         Returns:
-            (list): Of Cases
+            (list): Of (key, selection text) tuples
         """
-        case_list = [(key, selection_text(case))
-                     for key, case in self.cases.items()
-                     if hasattr(case, 'case_id')]
+        summaries = self.get_summaries()
+        case_list = [(key, summary['text'])
+                     for key, summary in summaries.items()
+                     if 'cause_number' in summary]
         case_list.sort(key=lambda x: x[1])
         return case_list
 
+    def get_summaries(self) -> dict:
+        """
+        Return the summary of every case, indexed by case key. Summaries
+        that are missing, e.g. for cases saved before summaries existed,
+        are built from the case and stored. A rebuilt summary keeps the
+        modified time of the summary it replaces, so rebuilding does not
+        count as activity on the case.
+
+        Returns:
+            (dict): Summary dicts indexed by case key.
+        """
+        stored = self.the_redis.hgetall(self.summaries_key) or {}
+        stored = {text(key): json.loads(value) for key, value in stored.items()}
+        summaries = {key: summary for key, summary in stored.items()
+                     if summary.get('format') == SUMMARY_FORMAT}
+        if len(summaries) != self.the_redis.hlen(self.cases_key):
+            for key in self.keys():
+                if key in summaries:
+                    continue
+                case = self.get_case(key)
+                if case is None:
+                    continue
+                summaries[key] = case_summary(case, stored.get(key, {}).get('modified'))
+                self.the_redis.hset(self.summaries_key, key, json.dumps(summaries[key]))
+        return summaries
+
+    def search_cases(self, query: str, offset: int = 0, limit: int = 20) -> tuple:
+        """
+        Find the cases matching every term in *query*, where a term matches
+        a word in a client's or party's name, the cause number, county, OAG
+        case number or description that it is a prefix of. Only the search
+        index and the summaries of matching cases are read.
+
+        Cases are ranked by how many terms matched a whole word, then by
+        dropdown text. An empty query returns all cases in dropdown order.
+
+        Args:
+            query (str): Search terms.
+            offset (int): Number of matching cases to skip.
+            limit (int): Maximum number of cases to return.
+        Returns:
+            (tuple): Number of matching cases, and a list of (key, selection
+            text) tuples for the requested page of them.
+        """
+        self.build_index()
+        terms = tokenize(query)
+        if not terms:
+            total = self.the_redis.zcard(self.order_key)
+            members = self.the_redis.zrange(self.order_key, offset, offset + limit - 1)
+            page = [tuple(reversed(text(member).split('\0'))) for member in members]
+            return total, page
+
+        scores = None
+        for term in terms:
+            term_scores = {}
+            members = self.the_redis.zrangebylex(
+                self.tokens_key, b'[' + term.encode(), b'[' + term.encode() + b'\xff')
+            for member in members:
+                token, key = text(member).split('\0')
+                bonus = 1 if token == term else 0
+                term_scores[key] = max(term_scores.get(key, 0), bonus)
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {key: score + term_scores[key]
+                          for key, score in scores.items() if key in term_scores}
+            if not scores:
+                return 0, []
+
+        keys = list(scores)
+        summaries = self.the_redis.hmget(self.summaries_key, keys)
+        matches = [(-scores[key], json.loads(summary)['text'], key)
+                   for key, summary in zip(keys, summaries) if summary is not None]
+        matches.sort()
+        page = [(key, selection) for _, selection, key in matches[offset:offset + limit]]
+        return len(matches), page
+
+    def build_index(self):
+        """
+        Build the search index from the case summaries, unless it is already
+        built. After that, saves and deletes keep it up to date.
+        """
+        if text(self.the_redis.get(self.index_format_key)) == str(INDEX_FORMAT):
+            return
+        for _ in range(SAVE_RETRIES):
+            with self.the_redis.pipeline(transaction=True) as pipe:
+                try:
+                    pipe.watch(self.versions_key)
+                    summaries = self.get_summaries()
+                    pipe.multi()
+                    pipe.delete(self.tokens_key, self.order_key)
+                    for key, summary in summaries.items():
+                        self.index(pipe, key, None, summary)
+                    pipe.set(self.index_format_key, INDEX_FORMAT)
+                    pipe.execute()
+                    logmessage(f"build_index(): Indexed {len(summaries)} cases " +
+                               f"for user = {self.user_id}")
+                    return
+                except WatchError:
+                    # A case was saved while we read the summaries.
+                    continue
+        raise RuntimeError(f"build_index(): Gave up indexing cases for user = {self.user_id}")
+
+    def index(self, pipe, key: str, old: dict, new: dict):
+        """
+        Queue the changes to the search index for a case whose summary has
+        changed from *old* to *new*. Either can be None.
+        """
+        old_tokens, old_order = index_members(key, old)
+        new_tokens, new_order = index_members(key, new)
+        if old_tokens - new_tokens:
+            pipe.zrem(self.tokens_key, *(old_tokens - new_tokens))
+        if new_tokens - old_tokens:
+            pipe.zadd(self.tokens_key, dict.fromkeys(new_tokens - old_tokens, 0))
+        if old_order - new_order:
+            pipe.zrem(self.order_key, *(old_order - new_order))
+        if new_order - old_order:
+            pipe.zadd(self.order_key, dict.fromkeys(new_order - old_order, 0))
+
     def get_case(self, key: str):
         """
-        Return a single case based on the case key provided.
+        Return a single case based on the case key provided. An archived case
+        is restored first.
 
         Args:
             key (str): Case.key value
         Returns:
-            (Case): Case instance referred to by *key*
+            (Case): Case instance referred to by *key*, or None if there is
+            none or it is archived where this server cannot restore it.
         """
-        case = self.cases.get(key)
+        data = self.the_redis.hget(self.cases_key, key)
+        if data is None and self.the_redis.sismember(self.archived_key, key):
+            data = self.restore_case(key)
+        case = self.loads(data) if data is not None else None
+        if case is not None and upgrade_case(case):
+            # Write the upgraded case back so it is only upgraded once.
+            if self.save(case, touch=False):
+                self.upgraded += 1
         if not hasattr(case, 'case_id'):
             message = "get_case(): Case key {} does not have a case_id"
             logmessage(message.format(key))
@@ -72,37 +393,417 @@ class UsCaseList(object):
         return case
 
     def del_case(self, key: str):
-        if key in self.cases:
-            del self.cases[key]
-            self.save(None)
-        else:
-            logmessage(f"del_case(): Could not find case having key={key}")
+        if self.the_redis.sismember(self.archived_key, key):
+            # Open the archive first: if this server cannot, the case must
+            # stay listed as archived.
+            archive = self.case_archive()
+            if archive is not None:
+                archive.delete(self.user_id, key)
+            self.the_redis.srem(self.archived_key, key)
+            return
+        summary = self.the_redis.hget(self.summaries_key, key)
+        pipe = self.the_redis.pipeline(transaction=True)
+        pipe.hdel(self.cases_key, key)
+        pipe.hdel(self.summaries_key, key)
+        pipe.hdel(self.fingerprints_key, key)
+        pipe.hdel(self.versions_key, key)
+        history = [field for field, _ in
+                   self.the_redis.hscan_iter(self.history_key, match=f'{key}:*')]
+        if history:
+            pipe.hdel(self.history_key, *history)
+        if summary is not None:
+            self.index(pipe, key, json.loads(summary), None)
+        deleted = pipe.execute()[0]
+        if deleted:
+            return
+        logmessage(f"del_case(): Could not find case having key={key}")
 
     def del_cases(self):
         logmessage(f"del_cases(): " +
-                   "Deleting all cases for user = {self.user_id}")
-        the_redis = DARedis()
-        the_redis.set_data(self.user_cases_key, None)
+                   f"Deleting all cases for user = {self.user_id}")
+        archive = self.case_archive()
+        self.the_redis.delete(self.cases_key, self.summaries_key,
+                              self.fingerprints_key, self.versions_key,
+                              self.history_key, self.user_cases_key,
+                              self.tokens_key, self.order_key, self.index_format_key,
+                              self.archived_key)
+        if archive is not None:
+            archive.delete(self.user_id)
         return
 
-    def save(self, case) -> bool:
+    def case_archive(self):
+        """
+        Return the configured CaseArchive, opening it at most once, or None
+        if archiving is turned off. Raises ArchiveNotSharedError if this
+        server cannot see the archive other servers use.
+        """
+        if self._archive is NOT_READ:
+            self._archive = CaseArchive.configured(self.the_redis)
+        return self._archive
+
+    def archive_candidates(self, months: int = None) -> list:
+        """
+        Return the keys of cases that are closed or have not been saved for
+        *months* months, or the configured 'case archive months'.
+        """
+        months = archive_months() if months is None else months
+        cutoff = time.time() - months * 365.25 / 12 * 24 * 60 * 60
+        return [key for key, summary in self.get_summaries().items()
+                if summary.get('closed') or summary.get('modified', 0) < cutoff]
+
+    def archive_case(self, key: str) -> bool:
+        """
+        Move a case from Redis to the CaseArchive. Its key is remembered, so
+        get_case() can restore it.
+
+        Returns:
+            (bool): Whether the case was archived. It is not if archiving is
+            turned off, the case does not exist, or it kept being saved while
+            we were archiving it.
+        """
+        archive = self.case_archive()
+        if archive is None:
+            return False
+        for _ in range(SAVE_RETRIES):
+            with self.the_redis.pipeline(transaction=True) as pipe:
+                try:
+                    pipe.watch(self.versions_key)
+                    data = pipe.hget(self.cases_key, key)
+                    if data is None:
+                        pipe.unwatch()
+                        return False
+                    version = int(pipe.hget(self.versions_key, key) or 0)
+                    summary = pipe.hget(self.summaries_key, key)
+                    history = [field for field, _ in
+                               pipe.hscan_iter(self.history_key, match=f'{key}:*')]
+                    # Write the archive first, so a failure loses nothing.
+                    archive.put(self.user_id, key, version, text(summary), data)
+                    pipe.multi()
+                    for hash_key in (self.cases_key, self.summaries_key,
+                                     self.fingerprints_key, self.versions_key):
+                        pipe.hdel(hash_key, key)
+                    if history:
+                        pipe.hdel(self.history_key, *history)
+                    if summary is not None:
+                        self.index(pipe, key, json.loads(summary), None)
+                    pipe.sadd(self.archived_key, key)
+                    pipe.execute()
+                    return True
+                except WatchError:
+                    # Someone saved a case; look at it again.
+                    continue
+        archive.delete(self.user_id, key)
+        logmessage(f"archive_case(): Gave up archiving case {key} for user = {self.user_id}")
+        return False
+
+    def restore_case(self, key: str) -> bytes:
+        """
+        Move a case from the CaseArchive back to Redis.
+
+        Returns:
+            (bytes): The case as stored, or None if it is not in the archive
+            or this server has no archive.
+        """
+        archive = self.case_archive()
+        if archive is None:
+            logmessage(f"restore_case(): Case {key} is archived, but " +
+                       "'case archive directory' is not set on this server")
+            return None
+        row = archive.get(self.user_id, key)
+        if row is None:
+            # Deleted from the archive, e.g. by del_case() on another server.
+            logmessage(f"restore_case(): Case {key} is not in the archive")
+            self.the_redis.srem(self.archived_key, key)
+            return None
+        version, summary, data = row
+        for _ in range(SAVE_RETRIES):
+            with self.the_redis.pipeline(transaction=True) as pipe:
+                try:
+                    pipe.watch(self.versions_key)
+                    if pipe.hexists(self.cases_key, key):
+                        # Someone else restored it first.
+                        pipe.unwatch()
+                        return pipe.hget(self.cases_key, key)
+                    pipe.multi()
+                    pipe.hset(self.cases_key, key, data)
+                    if summary is not None:
+                        pipe.hset(self.summaries_key, key, summary)
+                        self.index(pipe, key, None, json.loads(summary))
+                    pipe.hset(self.fingerprints_key, key, fingerprint(decode(data)))
+                    pipe.hset(self.versions_key, key, version)
+                    pipe.srem(self.archived_key, key)
+                    pipe.execute()
+                    break
+                except WatchError:
+                    continue
+        else:
+            raise RuntimeError(f"restore_case(): Gave up restoring case {key} " +
+                               f"for user = {self.user_id}")
+        archive.delete(self.user_id, key)
+        logmessage(f"restore_case(): Restored case {key} for user = {self.user_id}")
+        return data
+
+    def save(self, case, force: bool = False, touch: bool = True) -> 'SaveResult':
+        """
+        Save a case. Only this case is written; the user's other cases are
+        not read or rewritten. If the case is exactly as it was last written,
+        nothing is written at all.
+
+        Saves are optimistic: if someone else saved the case after it was
+        loaded, e.g. in another tab, the attributes they changed are merged
+        into *case* as long as we did not change the same attributes. If we
+        did, nothing is written and a conflict is returned, unless *force*
+        is True, in which case our version wins.
+
+        A case in an older shape, e.g. one built from a legacy value, is
+        upgraded (see case_schema) before it is written.
+
+        Args:
+            case (Case): Case to save
+            force (bool): Overwrite someone else's conflicting changes.
+            touch (bool): Record the save as activity on the case. It is
+            False for maintenance, e.g. upgrades, so that an inactive case
+            still looks inactive to archive_candidates().
+        Returns:
+            (SaveResult): Its *written* attribute tells whether the case had
+            changed and was written, and its *conflicts* attribute lists the
+            attributes that prevented a write. It is false only if there was
+            a conflict.
+        """
+        if not case:
+            return SaveResult(None, None, False)
+        upgrade_case(case)
+        key = case_key(case)
+        case.key = key
+        expected = int(getattr(case, VERSION_ATTRIBUTE, 0) or 0)
+        merged = []
+
+        for _ in range(SAVE_RETRIES):
+            with self.the_redis.pipeline(transaction=True) as pipe:
+                try:
+                    pipe.watch(self.versions_key)
+                    current = int(pipe.hget(self.versions_key, key) or 0)
+                    if current != expected and not force:
+                        conflicts, merged = self.merge(pipe, case, key, expected, current)
+                        if conflicts:
+                            pipe.unwatch()
+                            logmessage(f"save(): Case {key} conflicts on {conflicts}")
+                            return SaveResult(key, None, False, conflicts=conflicts)
+                    else:
+                        setattr(case, VERSION_ATTRIBUTE, current)
+                        case_fingerprint = fingerprint(self.dumps(case))
+                        if text(pipe.hget(self.fingerprints_key, key)) == case_fingerprint:
+                            pipe.unwatch()
+                            return SaveResult(key, case_fingerprint, False, version=current)
+
+                    seed = self.seed_history(pipe, key, current)
+                    version = current + 1
+                    setattr(case, VERSION_ATTRIBUTE, version)
+                    pickled = self.dumps(case)
+                    case_fingerprint = fingerprint(pickled)
+                    old_summary = pipe.hget(self.summaries_key, key)
+                    old_summary = json.loads(old_summary) if old_summary is not None else None
+                    summary = case_summary(case)
+                    if not touch and old_summary and 'modified' in old_summary:
+                        summary['modified'] = old_summary['modified']
+                    pipe.multi()
+                    if seed is not None:
+                        pipe.hset(self.history_key, f'{key}:{current}', seed)
+                    self.index(pipe, key, old_summary, summary)
+                    pipe.hset(self.cases_key, key, encode(pickled))
+                    pipe.hset(self.summaries_key, key, json.dumps(summary))
+                    pipe.hset(self.fingerprints_key, key, case_fingerprint)
+                    pipe.hset(self.versions_key, key, version)
+                    pipe.hset(self.history_key, f'{key}:{version}',
+                              json.dumps(attribute_digests(case, self.dumps)))
+                    pipe.hdel(self.history_key, f'{key}:{version - HISTORY_LENGTH}')
+                    pipe.execute()
+                    return SaveResult(key, case_fingerprint, True,
+                                      version=version, merged=merged)
+                except WatchError:
+                    # Someone saved a case while we were; try again.
+                    setattr(case, VERSION_ATTRIBUTE, expected)
+                    continue
+        raise RuntimeError(f"save(): Gave up saving case {key} after {SAVE_RETRIES} attempts")
+
+    def seed_history(self, pipe, key: str, current: int) -> str:
+        """
+        Return the attribute digests of the stored version of a case that
+        has none in the history, e.g. one saved before versioned saves, so
+        that they can be stored as the common ancestor for sessions that
+        loaded that version.
+
+        Returns:
+            (str): JSON digests, or None if they are in the history already
+            or the case is not stored.
+        """
+        if pipe.hexists(self.history_key, f'{key}:{current}'):
+            return None
+        data = pipe.hget(self.cases_key, key)
+        if data is None:
+            return None
+        stored = self.loads(data)
+        upgrade_case(stored)
+        return json.dumps(attribute_digests(stored, self.dumps))
+
+    def merge(self, pipe, case, key: str, expected: int, current: int):
         """
-        Save the revised case list. If a case is provided, then add it to the
-        case list before saving. If no case is provided, then save the case list
-        without doing anything else. (This is probably called by a delete operation.)
+        Merge someone else's changes into *case*.
+
+        Compares the attributes of our case and of the stored case with
+        those of the version we both started from, *expected*. Attributes
+        that only they changed are copied into *case*. Without that version,
+        e.g. if it is older than the HISTORY_LENGTH versions kept, the
+        cases are compared whole: every attribute on which they differ is
+        a conflict.
 
         Args:
-            case (Case): Case to add to list or None
+            pipe: Pipeline in immediate mode, watching the version hash.
+            case (Case): Our case.
+            key (str): Case key.
+            expected (int): Version our case was loaded at.
+            current (int): Version now stored.
         Returns:
-            (bool): True is successful save, otherwise raises exception.
+            (tuple): Attributes we both changed differently, and attributes
+            merged into *case*.
+        """
+        data = pipe.hget(self.cases_key, key)
+        theirs = self.loads(data) if data is not None else None
+        if theirs is None:
+            # They deleted it; saving ours brings it back.
+            setattr(case, VERSION_ATTRIBUTE, current)
+            return [], []
+        # Ours was upgraded before saving, so compare theirs in the same shape.
+        upgrade_case(theirs)
+        ours = attribute_digests(case, self.dumps)
+        their_digests = attribute_digests(theirs, self.dumps)
+        base = pipe.hget(self.history_key, f'{key}:{expected}')
+        if base is None:
+            logmessage(f"merge(): No version {expected} of case {key}; comparing whole cases")
+            conflicts = sorted(name for name in set(ours) | set(their_digests)
+                               if ours.get(name) != their_digests.get(name))
+            if conflicts:
+                return conflicts, []
+            setattr(case, VERSION_ATTRIBUTE, current)
+            return [], []
+        base = json.loads(base)
+
+        names = set(base) | set(ours) | set(their_digests)
+        we_changed = {name for name in names if ours.get(name) != base.get(name)}
+        they_changed = {name for name in names if their_digests.get(name) != base.get(name)}
+        conflicts = sorted(name for name in we_changed & they_changed
+                           if ours.get(name) != their_digests.get(name))
+        if conflicts:
+            return conflicts, []
+
+        merged = sorted(they_changed - we_changed)
+        for name in merged:
+            if name in their_digests:
+                setattr(case, name, getattr(theirs, name))
+            else:
+                delattr(case, name)
+        setattr(case, VERSION_ATTRIBUTE, current)
+        return [], merged
+
+    def profile(self):
+        """
+        Return the user's attorney profile, reading it at most once.
         """
-        if case:
-            key = case_key(case)
-            case.key = key
-            self.cases[key] = case
-        the_redis = DARedis()
-        the_redis.set_data(self.user_cases_key, self.cases)
-        return True
+        if self._profile is NOT_READ:
+            if hasattr(self.the_redis, 'get_data'):
+                self._profile = self.the_redis.get_data(self.profile_key)
+            else:
+                data = self.the_redis.get(self.profile_key)
+                self._profile = fix_pickle_obj(data) if data is not None else None
+        return self._profile
+
+    def dumps(self, case) -> bytes:
+        """
+        Pickle a case, storing a reference in place of every copy of the
+        user's attorney profile in it, e.g. *case.me* and the user's entry
+        in *case.attorney*.
+        """
+        buffer = io.BytesIO()
+        CasePickler(buffer, self.profile()).dump(case)
+        return buffer.getvalue()
+
+    def loads(self, data: bytes):
+        """
+        Unpickle a stored case, replacing references to the user's attorney
+        profile with copies of the profile as it is now.
+        """
+        return CaseUnpickler(io.BytesIO(decode(data)), self.profile()).load()
+
+
+class CasePickler(pickle.Pickler):
+    """
+    Pickles a case without the attorney profile, which is stored once per
+    user rather than in every case. An attorney is taken to be the profile
+    if it has the profile's bar number.
+    """
+    def __init__(self, file, profile):
+        super().__init__(file)
+        self.bar_number = vars(profile).get('bar_number') if profile is not None else None
+
+    def persistent_id(self, obj):
+        if self.bar_number and isinstance(obj, Attorney) and \
+                vars(obj).get('bar_number') == self.bar_number:
+            return (PROFILE_REF, obj.instanceName)
+        return None
+
+
+class CaseUnpickler(pickle.Unpickler):
+    """
+    Unpickles a case pickled by CasePickler. Each profile reference becomes
+    a copy of the profile with the instance name of the attorney it
+    replaced; references that replaced the same attorney share one copy.
+    """
+    def __init__(self, file, profile):
+        super().__init__(file)
+        self.profile = profile
+        self.copies = {}
+
+    def persistent_load(self, pid):
+        tag, instance_name = pid
+        if tag != PROFILE_REF:
+            raise pickle.UnpicklingError(f"Unknown persistent id {tag}")
+        if instance_name not in self.copies:
+            if self.profile is not None:
+                attorney = copy.deepcopy(self.profile)
+                attorney._set_instance_name_recursively(instance_name)
+            else:
+                # The profile is gone; the interview will ask for it again.
+                logmessage(f"persistent_load(): No attorney profile for {instance_name}")
+                attorney = Attorney(instance_name)
+            self.copies[instance_name] = attorney
+        return self.copies[instance_name]
+
+
+class SaveResult(object):
+    """
+    The outcome of UsCaseList.save(). It is true unless the save was refused
+    because of a conflict, so interviews can keep writing
+    `% if save_case(case):`.
+    """
+    def __init__(self, key: str, fingerprint: str, written: bool,
+                 version: int = None, merged: list = None, conflicts: list = None):
+        self.key = key                    # Key of the case saved
+        self.fingerprint = fingerprint    # Fingerprint of the case as saved
+        self.written = written            # False if unchanged or in conflict
+        self.version = version            # Version of the case now stored
+        self.merged = merged or []        # Attributes merged from another save
+        self.conflicts = conflicts or []  # Attributes both saves changed
+
+    @property
+    def conflict(self) -> bool:
+        return bool(self.conflicts)
+
+    def __bool__(self):
+        return not self.conflict
+
+    def __repr__(self):
+        return f"SaveResult(key={self.key!r}, written={self.written}, " + \
+            f"version={self.version}, merged={self.merged}, conflicts={self.conflicts})"
 
 
 def case_key(case):
@@ -115,39 +816,205 @@ def case_key(case):
     return key
 
 
+def serialize(case) -> str:
+    """
+    Convert a case into the text we store.
+    """
+    return encode(pickle.dumps(case))
+
+
+def deserialize(data):
+    """
+    Convert a stored case, in any format we have ever stored in the case hash,
+    back into a case. Cases that refer to an attorney profile must be read
+    with UsCaseList.loads() instead, and the legacy case list with
+    UsCaseList.read_legacy().
+    """
+    if data is None:
+        return None
+    return pickle.loads(decode(data))
+
+
+def encode(pickled: bytes, codec: str = None) -> str:
+    """
+    Wrap a pickled case in an envelope, compressing it with *codec* or the
+    configured 'case compression' codec.
+    """
+    codec = codec or local_config('case compression', DEFAULT_CODEC)
+    if codec == 'zstd' and zstandard is None:
+        codec = 'zlib'
+    if codec == 'zlib':
+        payload = zlib.compress(pickled, 6)
+    elif codec == 'zstd':
+        payload = zstandard.ZstdCompressor(level=6).compress(pickled)
+    elif codec == 'none':
+        payload = pickled
+    else:
+        raise ValueError(f"Unknown case compression codec '{codec}'")
+    return f'{ENVELOPE_MAGIC}{ENVELOPE_FORMAT}{CODECS[codec]}' + \
+        base64.b64encode(payload).decode()
+
+
+def decode(data) -> bytes:
+    """
+    Unwrap a stored case, returning the pickled case. *data* is text, as
+    read through DARedis, or bytes, as read by a client that does not decode
+    responses.
+    """
+    envelope = envelope_of(data)
+    if envelope is None:
+        return data  # A legacy, uncompressed pickle
+    envelope_format, codec = envelope
+    if envelope_format == BINARY_ENVELOPE_FORMAT:
+        payload = data[len(BINARY_ENVELOPE_MAGIC) + 2:]
+    else:
+        payload = base64.b64decode(data[len(ENVELOPE_MAGIC) + 2:])
+    if codec == CODECS['none']:
+        return payload
+    if codec == CODECS['zlib']:
+        return zlib.decompress(payload)
+    if codec == CODECS['zstd']:
+        if zstandard is None:
+            raise ValueError("Case is compressed with zstd but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    raise ValueError(f"Unknown case compression codec {codec}")
+
+
+def envelope_of(data) -> tuple:
+    """
+    Return the envelope format and codec number of a stored case, or None if
+    it is a bare pickle.
+    """
+    if isinstance(data, bytes):
+        if data.startswith(BINARY_ENVELOPE_MAGIC):
+            header = len(BINARY_ENVELOPE_MAGIC)
+            envelope_format, codec = data[header], data[header + 1]
+            if envelope_format != BINARY_ENVELOPE_FORMAT:
+                raise ValueError(f"Unknown case envelope format {envelope_format}")
+            return envelope_format, codec
+        if not data.startswith(ENVELOPE_MAGIC.encode()):
+            return None
+        data = data.decode()
+    if not data.startswith(ENVELOPE_MAGIC):
+        raise ValueError("Stored case is not in a case envelope")
+    header = len(ENVELOPE_MAGIC)
+    envelope_format, codec = int(data[header]), int(data[header + 1])
+    if envelope_format != ENVELOPE_FORMAT:
+        raise ValueError(f"Unknown case envelope format {envelope_format}")
+    return envelope_format, codec
+
+
+def attribute_digests(case, dumps=pickle.dumps) -> dict:
+    """
+    Digest each attribute of a case separately, so that two versions of
+    the case can be compared attribute by attribute.
+    """
+    return {name: fingerprint(dumps(value))
+            for name, value in vars(case).items()
+            if name != VERSION_ATTRIBUTE}
+
+
+def fingerprint(data: bytes) -> str:
+    """
+    A cheap fingerprint of a serialized case, used to skip rewriting a case
+    that has not changed.
+    """
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def text(value) -> str:
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        return value.decode()
+    return str(value)
+
+
+def index_members(key: str, summary: dict) -> tuple:
+    """
+    Return the members a case contributes to the token and order indexes.
+    Only cases that appear in the dropdown are indexed.
+    """
+    if not summary or 'cause_number' not in summary:
+        return set(), set()
+    values = [summary.get('client'), summary.get('cause_number'),
+              summary.get('county'), summary.get('oag_number'),
+              summary.get('description')] + summary.get('parties', [])
+    tokens = tokenize(*(value for value in values if value not in (None, 'None')))
+    return {f'{token}\0{key}' for token in tokens}, {f"{summary['text']}\0{key}"}
+
+
+def party_names(case) -> list:
+    """
+    Return the names of the parties to a case, skipping any that cannot be
+    formatted.
+    """
+    names = []
+    for role in ('petitioner', 'respondent', 'intervenor'):
+        parties = vars(case).get(role)
+        if not isinstance(parties, DAList):
+            continue
+        for party in parties.elements:
+            try:
+                names.append(str(party.name))
+            except Exception:
+                continue
+    return names
+
+
 def selection_text(case) -> str:
     """
     Create text that is used to populate a dropdown for case selection.
-    There is a lot of type, etc., checking here because the representation of
-    a 'case' has changed significantly over time and this needs to work for
-    all legacy formats so we can delete them during testing.
 
     Args:
         case (Case): The case to process
     Returns:
         (str): The text to display.
     """
-    if hasattr(case, 'client'):
-        if isinstance(case.client, DAList) and case.client.number() > 0:
-            if hasattr(case.client[0].name, 'last'):
-                lname = case.client[0].name.last
-                fname = case.client[0].name.first
-                client = f"{lname}, {fname}"
-            else:
-                client = case.client[0].name
-        else:
-            client = "*{}-{}".format(case.client.number(), str(case.client))
-    else:
-        client = "(NO CLIENT)"
+    return case_summary(case)['text']
 
-    if hasattr(case, 'description'):
-        description = case.description
-    else:
-        description = case.footer
 
-    if hasattr(case, 'case_id') and case.case_id:
-        case_id = "{}: {}".format(case.county, case.case_id)
+def case_summary(case, modified: float = None) -> dict:
+    """
+    Summarize a case: just enough to list it in a dropdown without loading
+    the whole case. Stored cases are upgraded to the current shape (see
+    case_schema) before they are summarized, so the client is always a
+    list and every stored case has a case_id. Attributes are looked up
+    directly only because a case still being built in an interview may not
+    have them yet; such a case is left out of the dropdown until it has a
+    case_id.
+
+    Args:
+        case (Case): The case to process
+        modified (float): When the case was last saved. Now, if omitted.
+    Returns:
+        (dict): client, description, county, cause_number (only present once
+        the case has a case_id attribute), parties, oag_number, closed, modified
+        time, the dropdown text and the summary format.
+    """
+    attributes = vars(case)
+    clients = attributes.get('client')
+    if clients is None:
+        client = "(NO CLIENT)"
+    elif clients.number() > 0:
+        name = clients[0].name
+        client = f"{name.last}, {name.first}" if hasattr(name, 'last') else name
     else:
-        case_id = "(NOT FILED)"
+        client = "*{}-{}".format(clients.number(), str(clients))
+    description = attributes.get('description')
+    county = attributes.get('county')
 
-    return f"{client} - {description} - ({case.county})"
+    summary = {
+        'client': str(client),
+        'description': str(description),
+        'county': str(county),
+        'parties': party_names(case),
+        'closed': bool(attributes.get('closed')),
+        'oag_number': str(case.oag_case_id) if attributes.get('oag_case_id') else None,
+        'modified': time.time() if modified is None else modified,
+        'text': f"{client} - {description} - ({county})",
+        'format': SUMMARY_FORMAT
+    }
+    if 'case_id' in attributes:
+        summary['cause_number'] = str(case.case_id) if case.case_id else None
+    return summary
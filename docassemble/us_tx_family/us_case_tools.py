@@ -0,0 +1,399 @@
+"""
+us_case_tools.py - Command line maintenance of users' case lists.
+
+Usage:
+```
+python -m docassemble.us_tx_family.us_case_tools migrate
+python -m docassemble.us_tx_family.us_case_tools --redis redis://localhost:6379/1 migrate
+python -m docassemble.us_tx_family.us_case_tools report --codec zstd
+python -m docassemble.us_tx_family.us_case_tools compress
+python -m docassemble.us_tx_family.us_case_tools export --format binary cases.bin
+python -m docassemble.us_tx_family.us_case_tools import cases.bin
+python -m docassemble.us_tx_family.us_case_tools archive --months 18
+python -m docassemble.us_tx_family.us_case_tools upgrade
+```
+
+Without --redis, the Redis database that docassemble uses for DARedis is
+located from the docassemble configuration file.
+
+Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import argparse
+from contextlib import nullcontext
+import sys
+
+from redis.exceptions import WatchError
+
+from . import case_transfer
+from .local_config import local_config
+from .us_case_list import ARCHIVED_SET_TEMPLATE, CASE_HASH_TEMPLATE, \
+    CASES_KEY_TEMPLATE, CODECS, DEFAULT_CODEC, ENVELOPE_FORMAT, \
+    FINGERPRINT_HASH_TEMPLATE, INDEX_FORMAT_KEY_TEMPLATE, PROFILE_KEY_TEMPLATE, \
+    SUMMARY_HASH_TEMPLATE, VERSION_HASH_TEMPLATE, UsCaseList, decode, encode, \
+    envelope_of, fingerprint, text
+
+# Writes one imported case, unless it exists and ARGV[6] is '0'.
+# KEYS: cases, summaries, versions, fingerprints hashes.
+# ARGV: case key, case data, summary, version, fingerprint, replace.
+IMPORT_CASE = """
+if ARGV[6] == '0' and redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+if ARGV[3] == '' then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+else
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+end
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[4])
+redis.call('HSET', KEYS[4], ARGV[1], ARGV[5])
+return 1
+"""
+
+
+def cli_redis(url: str = None):
+    """
+    Connect to the Redis database that holds users' cases. The commands
+    work with clients that decode responses, like the one DARedis uses,
+    and with ones that do not.
+
+    Args:
+        url (str): redis:// URL. If omitted, docassemble's configuration is
+        used to find the database that DARedis uses.
+    Returns:
+        A redis client.
+    """
+    if url:
+        import redis
+        return redis.Redis.from_url(url)
+    import docassemble.base.config
+    docassemble.base.config.load()
+    from docassemble.webapp.daredis import r_user
+    return r_user
+
+
+def scan_users(the_redis, template: str):
+    """
+    Yield the id of every user having a key that matches *template*, using
+    SCAN so that Redis is never blocked the way KEYS would block it.
+
+    Args:
+        the_redis: Redis client.
+        template (str): Key template such as CASES_KEY_TEMPLATE.
+    Yields:
+        (str): User ids.
+    """
+    prefix, suffix = template.split('{}')
+    for key in the_redis.scan_iter(match=template.format('*'), count=500):
+        if isinstance(key, bytes):
+            key = key.decode()
+        yield key[len(prefix):len(key) - len(suffix)]
+
+
+def scan_case_users(the_redis):
+    """
+    Yield the id of every user having cases: in the case hash, in a legacy
+    case list not yet migrated, or only in the archive. Each user is
+    yielded once, without remembering the users already seen, by skipping
+    in each later scan the users an earlier scan found.
+    """
+    yield from scan_users(the_redis, CASE_HASH_TEMPLATE)
+    for user_id in scan_users(the_redis, CASES_KEY_TEMPLATE):
+        if not the_redis.exists(CASE_HASH_TEMPLATE.format(user_id)):
+            yield user_id
+    for user_id in scan_users(the_redis, ARCHIVED_SET_TEMPLATE):
+        if not the_redis.exists(CASE_HASH_TEMPLATE.format(user_id),
+                                CASES_KEY_TEMPLATE.format(user_id)):
+            yield user_id
+
+
+def migrate(the_redis, args) -> int:
+    """
+    Migrate every user's legacy case list to per-case storage.
+    """
+    users = [args.user] if args.user else scan_users(the_redis, CASES_KEY_TEMPLATE)
+    for user_id in users:
+        # Constructing the case list migrates it.
+        case_db = UsCaseList(user_id, the_redis)
+        print(f"{user_id}: copied {case_db.migrated} cases")
+    return 0
+
+
+def report(the_redis, args) -> int:
+    """
+    Show how many bytes each user's cases take now and would take if they
+    were all stored with *args.codec*.
+    """
+    codec = args.codec or local_config('case compression', DEFAULT_CODEC)
+    users = [args.user] if args.user else scan_case_users(the_redis)
+    print(f"{'user':>12} {'cases':>7} {'legacy':>7} {'stored':>12} {'pickled':>12} {codec:>12} {'saving':>7}")
+    totals = [0, 0, 0, 0, 0]
+    for user_id in users:
+        counts = [0, 0, 0, 0, 0]
+        cases_key = CASE_HASH_TEMPLATE.format(user_id)
+        for _, data in the_redis.hscan_iter(cases_key, count=100):
+            pickled = decode(data)
+            counts[0] += 1
+            counts[1] += 1 if envelope_of(data) is None else 0
+            counts[2] += len(data)
+            counts[3] += len(pickled)
+            counts[4] += len(encode(pickled, codec))
+        totals = [t + c for t, c in zip(totals, counts)]
+        print_report_line(user_id, counts)
+    print_report_line('TOTAL', totals)
+    return 0
+
+
+def print_report_line(label: str, counts: list):
+    cases, legacy, stored, pickled, compressed = counts
+    saving = 1 - compressed / stored if stored else 0
+    print(f"{label:>12} {cases:>7} {legacy:>7} {stored:>12,} {pickled:>12,} {compressed:>12,} {saving:>7.0%}")
+
+
+def compress(the_redis, args) -> int:
+    """
+    Rewrite stored cases with *args.codec*. Cases are only ever written when
+    they change, so without this an old case stays in its original format.
+    """
+    codec = args.codec or local_config('case compression', DEFAULT_CODEC)
+    users = [args.user] if args.user else scan_case_users(the_redis)
+    for user_id in users:
+        case_db = UsCaseList(user_id, the_redis)
+        rewritten = 0
+        for key in case_db.keys():
+            if rewrite_case(the_redis, case_db, key, codec):
+                rewritten += 1
+        print(f"{user_id}: rewrote {rewritten} cases")
+    return 0
+
+
+def rewrite_case(the_redis, case_db: UsCaseList, key: str, codec: str) -> bool:
+    """
+    Re-encode one stored case with *codec*, unless someone saves it first.
+    """
+    with the_redis.pipeline(transaction=True) as pipe:
+        try:
+            pipe.watch(case_db.versions_key)
+            data = pipe.hget(case_db.cases_key, key)
+            if data is None:
+                return False
+            if envelope_of(data) == (ENVELOPE_FORMAT, CODECS[codec]):
+                return False
+            pipe.multi()
+            pipe.hset(case_db.cases_key, key, encode(decode(data), codec))
+            pipe.execute()
+            return True
+        except WatchError:
+            # The case was saved while we worked, in the current format.
+            return False
+
+
+def export(the_redis, args) -> int:
+    """
+    Stream users' attorney profiles and cases to a file, one at a time.
+    """
+    users = [args.user] if args.user else scan_case_users(the_redis)
+    with open_stream(args.file, 'wb', sys.stdout.buffer) as stream:
+        write = case_transfer.writer(stream, args.format)
+        for user_id in users:
+            exported = export_user(the_redis, user_id, write, args.batch)
+            print(f"{user_id}: exported {exported} cases", file=sys.stderr)
+    return 0
+
+
+def export_user(the_redis, user_id: str, write, batch_size: int) -> int:
+    """
+    Write one user's profile and cases, reading *batch_size* cases at a time.
+    """
+    # Constructing the case list migrates a legacy one, so it is exported too.
+    case_db = UsCaseList(user_id, the_redis)
+    profile = the_redis.get(case_db.profile_key)
+    if profile is not None:
+        write({'type': 'profile', 'user': user_id, 'data': profile})
+    exported = 0
+    batch = []
+    for key, data in the_redis.hscan_iter(case_db.cases_key, count=batch_size):
+        batch.append((text(key), data))
+        if len(batch) >= batch_size:
+            exported += export_batch(the_redis, case_db, batch, write)
+            batch = []
+    if batch:
+        exported += export_batch(the_redis, case_db, batch, write)
+    archive = case_db.case_archive()
+    if archive is not None:
+        for key in the_redis.sscan_iter(case_db.archived_key, count=batch_size):
+            row = archive.get(user_id, text(key))
+            if row is None:
+                continue
+            version, summary, data = row
+            write({'type': 'case', 'user': user_id, 'key': text(key),
+                   'version': version, 'summary': summary, 'data': data})
+            exported += 1
+    return exported
+
+
+def export_batch(the_redis, case_db: UsCaseList, batch: list, write) -> int:
+    keys = [key for key, _ in batch]
+    pipe = the_redis.pipeline(transaction=False)
+    pipe.hmget(case_db.summaries_key, keys)
+    pipe.hmget(case_db.versions_key, keys)
+    summaries, versions = pipe.execute()
+    for (key, data), summary, version in zip(batch, summaries, versions):
+        write({'type': 'case', 'user': case_db.user_id, 'key': key,
+               'version': int(version or 0), 'summary': text(summary), 'data': data})
+    return len(batch)
+
+
+def import_cases(the_redis, args) -> int:
+    """
+    Load profiles and cases from a file written by *export*, pipelining the
+    writes *args.batch* records at a time. Existing cases and profiles are
+    kept unless *args.replace* is set.
+    """
+    import_case = the_redis.register_script(IMPORT_CASE)
+    imported = skipped = 0
+    user_id = None
+    with open_stream(args.file, 'rb', sys.stdin.buffer) as stream:
+        pipe = the_redis.pipeline(transaction=False)
+        queued = []
+        for record in case_transfer.reader(stream, args.format):
+            if record['user'] != user_id:
+                user_id = record['user']
+                # Rebuild the user's search index on their next search.
+                pipe.delete(INDEX_FORMAT_KEY_TEMPLATE.format(user_id))
+                queued.append('index')
+            if record['type'] == 'profile':
+                pipe.set(PROFILE_KEY_TEMPLATE.format(user_id), record['data'],
+                         nx=not args.replace)
+            else:
+                data = record['data']
+                envelope = envelope_of(data)
+                if envelope is None or envelope[0] != ENVELOPE_FORMAT:
+                    # Exported by a server that stored cases as binary,
+                    # which DARedis cannot read.
+                    data = encode(decode(data))
+                import_case(keys=[CASE_HASH_TEMPLATE.format(user_id),
+                                  SUMMARY_HASH_TEMPLATE.format(user_id),
+                                  VERSION_HASH_TEMPLATE.format(user_id),
+                                  FINGERPRINT_HASH_TEMPLATE.format(user_id)],
+                            args=[record['key'], data, record['summary'] or '',
+                                  int(record['version'] or 0),
+                                  fingerprint(decode(data)),
+                                  1 if args.replace else 0],
+                            client=pipe)
+            queued.append(record['type'])
+            if len(queued) >= args.batch:
+                done, kept = import_batch(pipe, queued)
+                imported, skipped, queued = imported + done, skipped + kept, []
+        if queued:
+            done, kept = import_batch(pipe, queued)
+            imported, skipped = imported + done, skipped + kept
+    print(f"Imported {imported} cases; kept {skipped} existing cases")
+    return 0
+
+
+def import_batch(pipe, queued: list) -> tuple:
+    results = pipe.execute()
+    cases = [result for kind, result in zip(queued, results) if kind == 'case']
+    return sum(1 for result in cases if result), sum(1 for result in cases if not result)
+
+
+def archive(the_redis, args) -> int:
+    """
+    Move closed and inactive cases to the case archive.
+    """
+    users = [args.user] if args.user else scan_case_users(the_redis)
+    for user_id in users:
+        case_db = UsCaseList(user_id, the_redis)
+        if case_db.case_archive() is None:
+            print("Set 'case archive directory' in the us-tx-family configuration first.",
+                  file=sys.stderr)
+            return 1
+        keys = case_db.archive_candidates(args.months)
+        if args.dry_run:
+            print(f"{user_id}: would archive {len(keys)} cases")
+            continue
+        archived = sum(1 for key in keys if case_db.archive_case(key))
+        print(f"{user_id}: archived {archived} of {len(keys)} cases")
+    return 0
+
+
+def upgrade(the_redis, args) -> int:
+    """
+    Upgrade every stored case to the current shape ahead of time, rather
+    than the first time each case is read. Archived cases are upgraded when
+    they are restored.
+    """
+    users = [args.user] if args.user else scan_case_users(the_redis)
+    for user_id in users:
+        case_db = UsCaseList(user_id, the_redis)
+        keys = case_db.keys()
+        for key in keys:
+            # Reading a case upgrades it and writes it back.
+            case_db.get_case(key)
+        print(f"{user_id}: upgraded {case_db.upgraded} of {len(keys)} cases")
+    return 0
+
+
+def open_stream(path: str, mode: str, standard):
+    """
+    Open *path*, or use *standard* (stdin or stdout) if it is '-'.
+    """
+    if path == '-':
+        return nullcontext(standard)
+    return open(path, mode)
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Maintain users' case lists.")
+    parser.add_argument('--redis', help="redis:// URL of the database holding cases")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('migrate', help="Move legacy case lists to per-case storage")
+    command.add_argument('--user', help="Only migrate this user's cases")
+    command.set_defaults(func=migrate)
+
+    command = commands.add_parser('report', help="Show per-user storage and compression savings")
+    command.add_argument('--user', help="Only report on this user's cases")
+    command.add_argument('--codec', choices=sorted(CODECS), help="Codec to estimate savings for")
+    command.set_defaults(func=report)
+
+    command = commands.add_parser('compress', help="Rewrite stored cases with a codec")
+    command.add_argument('--user', help="Only rewrite this user's cases")
+    command.add_argument('--codec', choices=sorted(CODECS), help="Codec to rewrite cases with")
+    command.set_defaults(func=compress)
+
+    command = commands.add_parser('export', help="Write users' profiles and cases to a file")
+    command.add_argument('--user', help="Only export this user's cases")
+    command.add_argument('--format', choices=case_transfer.FORMATS, default='jsonl')
+    command.add_argument('--batch', type=int, default=500, help="Cases read per round trip")
+    command.add_argument('file', nargs='?', default='-', help="Output file, or - for stdout")
+    command.set_defaults(func=export)
+
+    command = commands.add_parser('import', help="Load profiles and cases written by export")
+    command.add_argument('--format', choices=case_transfer.FORMATS,
+                         help="Input format; worked out from the file if omitted")
+    command.add_argument('--batch', type=int, default=500, help="Records written per round trip")
+    command.add_argument('--replace', action='store_true',
+                         help="Overwrite existing cases and profiles")
+    command.add_argument('file', nargs='?', default='-', help="Input file, or - for stdin")
+    command.set_defaults(func=import_cases)
+
+    command = commands.add_parser('archive', help="Move closed and inactive cases to the archive")
+    command.add_argument('--user', help="Only archive this user's cases")
+    command.add_argument('--months', type=int,
+                         help="Archive cases not saved for this many months")
+    command.add_argument('--dry-run', action='store_true',
+                         help="Count the cases that would be archived")
+    command.set_defaults(func=archive)
+
+    command = commands.add_parser('upgrade', help="Upgrade stored cases to the current shape")
+    command.add_argument('--user', help="Only upgrade this user's cases")
+    command.set_defaults(func=upgrade)
+
+    args = parser.parse_args(argv)
+    return args.func(cli_redis(args.redis), args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,197 @@
+"""
+us_fred_async.py - An asyncio interface into the St. Louis Federal Reserve
+Bank's FRED API, for batch jobs that need many series or periods at once.
+
+Requests are made through the same pooled, guarded HTTP client as the
+synchronous Fred class, from a small thread pool, with at most
+*concurrency* requests in flight at a time.
+
+Usage:
+```python
+async with AsyncFred() as fred:
+    categories = await fred.category_children(0)
+    async for series in fred.iter_series_search('mortgage rate'):
+        print(series['id'])
+
+rates = average_fixed_mortgages([(2018, 0, 30), (2019, 2, 15)])
+```
+
+API documented at:
+https://research.stlouisfed.org/docs/api/
+
+Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+import functools
+import json
+
+from . import http_client
+from .us_fred_data import Fred, FredUtil
+
+__all__ = ['AsyncFred', 'average_fixed_mortgages']
+
+# Requests in flight at once. FRED allows 120 requests a minute per API
+# key, and each in-flight request holds one pooled connection.
+CONCURRENCY = 8
+
+# Items requested per page when paginating. FRED allows at most 1000 for
+# series lists and 100000 for observations.
+PAGE_SIZE = 1000
+
+
+class AsyncFred(object):
+    """
+    Asynchronous counterpart of Fred. Every method returns the decoded JSON
+    response.
+    """
+    def __init__(self, concurrency: int = CONCURRENCY, fred: Fred = None):
+        """
+        Initialize an instance.
+
+        Args:
+            concurrency (int): Most requests in flight at once. It is capped
+            at the HTTP client's connection pool size.
+            fred (Fred): Synchronous client to make requests with. One is
+            created if omitted.
+        """
+        self.fred = fred or Fred()
+        self.concurrency = max(1, min(int(concurrency), http_client.POOL_SIZE))
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency,
+                                           thread_name_prefix='us_fred_async')
+        self.semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run a blocking call in the thread pool, holding one of the
+        *concurrency* slots while it runs.
+        """
+        if self.semaphore is None:
+            # Created here so that it belongs to the running event loop.
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self.executor, functools.partial(func, *args, **kwargs))
+
+    async def retrieve(self, url_name: str, **params) -> dict:
+        params.setdefault("file_type", "json")
+        return json.loads(await self.run(self.fred.retrieve, url_name, **params))
+
+    async def series_observations(self, series_id: str, **kwargs) -> dict:
+        kwargs["series_id"] = series_id.upper()
+        return await self.retrieve("SERIES_OBSERVATIONS", **kwargs)
+
+    async def category(self, category_id: int = 0, **kwargs) -> dict:
+        kwargs["category_id"] = str(category_id)
+        return await self.retrieve("CATEGORY", **kwargs)
+
+    async def category_children(self, category_id: int = 0, **kwargs) -> dict:
+        kwargs["category_id"] = str(category_id)
+        return await self.retrieve("CATEGORY_CHILDREN", **kwargs)
+
+    async def category_series(self, category_id: int = 0, **kwargs) -> dict:
+        kwargs["category_id"] = str(category_id)
+        return await self.retrieve("CATEGORY_SERIES", **kwargs)
+
+    async def series_search(self, search_text: str, **kwargs) -> dict:
+        kwargs["search_text"] = str(search_text)
+        return await self.retrieve("SERIES_SEARCH", **kwargs)
+
+    async def paginate(self, url_name: str, items_key: str,
+                       page_size: int = PAGE_SIZE, **params):
+        """
+        Yield every item of a paged FRED response, fetching the next page
+        only when the previous one has been consumed.
+
+        Args:
+            url_name (str): Key of BASEURL to query.
+            items_key (str): Name of the list in each response, e.g. "seriess".
+            page_size (int): Items to request per page.
+            params: Query parameters.
+        """
+        offset = int(params.pop("offset", 0))
+        while True:
+            page = await self.retrieve(url_name, offset=offset, limit=page_size, **params)
+            items = page.get(items_key) or []
+            for item in items:
+                yield item
+            offset += len(items)
+            if not items or offset >= int(page.get("count", 0)):
+                return
+
+    def iter_category_series(self, category_id: int = 0, **kwargs):
+        kwargs["category_id"] = str(category_id)
+        return self.paginate("CATEGORY_SERIES", "seriess", **kwargs)
+
+    def iter_series_search(self, search_text: str, **kwargs):
+        kwargs["search_text"] = str(search_text)
+        return self.paginate("SERIES_SEARCH", "seriess", **kwargs)
+
+    def iter_series_observations(self, series_id: str, **kwargs):
+        kwargs["series_id"] = series_id.upper()
+        return self.paginate("SERIES_OBSERVATIONS", "observations", **kwargs)
+
+    async def many_series_observations(self, requests: dict) -> dict:
+        """
+        Fetch observations for many series, or many periods of a series,
+        concurrently.
+
+        Args:
+            requests (dict): (series id, params dict) tuples indexed by any
+            name the caller chooses.
+        Returns:
+            (dict): Responses indexed by the same names.
+        """
+        names = list(requests)
+        responses = await asyncio.gather(
+            *(self.series_observations(series_id, **dict(params))
+              for series_id, params in (requests[name] for name in names)))
+        return dict(zip(names, responses))
+
+    async def average_fixed_mortgages(self, periods: list) -> list:
+        """
+        Average mortgage rates for many periods concurrently. Each is
+        computed as FredUtil.average_fixed_mortgage() does, so the shared
+        rate history and cache are used and FRED is only asked about
+        periods they cannot answer.
+
+        Args:
+            periods (list): (year, month, duration) tuples; month 0 means
+            the whole year.
+        Returns:
+            (list): Decimal rates, or the exception raised for a period,
+            in the order of *periods*.
+        """
+        futil = FredUtil()
+        futil.fred = self.fred
+        return await asyncio.gather(
+            *(self.run(futil.average_fixed_mortgage, *period) for period in periods),
+            return_exceptions=True)
+
+
+def average_fixed_mortgages(periods: list, concurrency: int = CONCURRENCY) -> list:
+    """
+    Synchronous entry point for batch jobs: average mortgage rates for many
+    (year, month, duration) periods in one round of concurrent requests.
+    """
+    async def run():
+        async with AsyncFred(concurrency) as fred:
+            return await fred.average_fixed_mortgages(periods)
+    return asyncio.run(run())
+
+
+if __name__ == "__main__":
+    periods = [(2017, 11, 30), (2018, 0, 30), (2018, 2, 5), (2018, 2, 15)]
+    for period, rate in zip(periods, average_fixed_mortgages(periods)):
+        print(period, rate if isinstance(rate, (Decimal, type(None))) else f"error: {rate}")
@@ -8,11 +8,21 @@ https://api.stlouisfed.org/fred/series/observations?series_id=MORTGAGE30US&api_k
 
 Copyright (c) 2019 by Thomas J. Daley. All Rights Reserved.
 """
-from decimal import Decimal
+from array import array
+import base64
+import binascii
+from bisect import bisect_left, bisect_right
+from datetime import date, timedelta
+from decimal import Decimal, ROUND_HALF_UP
 import json
-import requests
+import threading
+import time
+from urllib.parse import urlencode
 
+from . import http_client, metrics
 from .local_config import local_config
+from .refresh_lock import RefreshLock
+from .snapshots import read_snapshot
 
 try:
     from docassemble.base.logger import logmessage
@@ -20,6 +30,12 @@ except Exception:
     def logmessage(s):
         print(s)
 
+try:
+    from docassemble.base.util import DARedis
+except Exception:
+    # Without docassemble, rates are not cached.
+    DARedis = None
+
 BASEURL = {}
 BASEURL["SERIES_SEARCH"] = "https://api.stlouisfed.org/fred/series/search?"
 BASEURL["SERIES_OBSERVATIONS"] = "https://api.stlouisfed.org/fred/series/observations?"
@@ -29,6 +45,44 @@ BASEURL["CATEGORY_SERIES"] = "https://api.stlouisfed.org/fred/category/series?"
 
 SOURCE = "FRED"
 
+# Where an average rate is cached, e.g. us_fred:MORTGAGE30US:m:2018-02.
+CACHE_KEY_TEMPLATE = "us_fred:{series}:{frequency}:{period}"
+
+# A period's average is final, and cached forever, once the period has been
+# over this long. FRED publishes weekly rates a few days after the week ends.
+CLOSE_GRACE_DAYS = 7
+
+# How long to cache the average for a period that is not over yet, unless
+# configured otherwise.
+DEFAULT_CACHE_SECONDS = 3600
+
+# Where the whole weekly history of a series is stored: a hash holding the
+# observation dates and rates as base64 encoded packed arrays, and the date
+# it was last brought up to date. The arrays are encoded because DARedis
+# decodes every value it reads as UTF-8.
+HISTORY_KEY_TEMPLATE = "us_fred:{series}:history"
+
+# Series whose history is prefetched, rather than asking FRED to average
+# each period separately.
+HISTORY_SERIES = ["MORTGAGE5US", "MORTGAGE15US", "MORTGAGE30US"]
+
+# Rates are stored as integers in units of 1/RATE_SCALE percent.
+RATE_SCALE = 10000
+
+# Averages are rounded to this many places, in percent, as FRED rounds them.
+AVERAGE_PLACES = Decimal("0.0001")
+
+# While a history is out of date but someone else is updating it, how often
+# to look for their update.
+HISTORY_CHECK_SECONDS = 300
+
+# Name of the packaged snapshot of the HISTORY_SERIES histories.
+SNAPSHOT = "us_fred_mortgage"
+
+_histories = {}  # RateHistory for each series, shared by this process
+_histories_lock = threading.Lock()
+_refreshing = set()  # Series this process is refreshing in the background
+
 
 class Fred(object):
     """
@@ -53,23 +107,17 @@ class Fred(object):
         """
         Construct a URL for querying the FRED servers.
         """
-        url = BASEURL[url_name]
-        args = []
-        for arg, value in params.items():
-            args.append("{}={}".format(arg, value))
-        url = url + "&".join(args)
-
         # Allow caller to override our API key.
-        if "api_key" not in args:
-            url += "&api_key=" + self.api_key
-
-        return url
+        if "api_key" not in params:
+            params = dict(params, api_key=self.api_key)
+        return BASEURL[url_name] + urlencode(params)
 
     def retrieve(self, url_name: str, **params: dict):
         """
         Retrieve data from FRED servers.
         """
-        response = requests.get(self.make_url(url_name, **params))
+        response = http_client.get(self.make_url(url_name, **params))
+        response.raise_for_status()
         result = response.content.decode()
         return result
 
@@ -93,34 +141,142 @@ class Fred(object):
     def category(self, category_id: int = 0, **kwargs):
         """
         Get a category description.
+
+        See: https://research.stlouisfed.org/docs/api/fred/category.html
         """
         kwargs["category_id"] = str(category_id)
-        url = self.make_url("CATEGORY", **kwargs)
-        print(url)
+        kwargs.setdefault("file_type", "json")
+        return self.retrieve("CATEGORY", **kwargs)
 
     def category_children(self, category_id: int = 0, **kwargs):
         """
         Get a list of child categories.
+
+        See: https://research.stlouisfed.org/docs/api/fred/category_children.html
         """
         kwargs["category_id"] = str(category_id)
-        url = self.make_url("CATEGORY_CHILDREN", **kwargs)
-        print(url)
+        kwargs.setdefault("file_type", "json")
+        return self.retrieve("CATEGORY_CHILDREN", **kwargs)
 
     def category_series(self, category_id: int = 0, **kwargs):
         """
         Get a list of series for a category.
+
+        See: https://research.stlouisfed.org/docs/api/fred/category_series.html
         """
         kwargs["category_id"] = str(category_id)
-        url = self.make_url("CATEGORY_SERIES", **kwargs)
-        print(url)
+        kwargs.setdefault("file_type", "json")
+        return self.retrieve("CATEGORY_SERIES", **kwargs)
 
     def series_search(self, search_text: str, **kwargs):
         """
-        Get a list of series for a category.
+        Get a list of series that match search text.
+
+        See: https://research.stlouisfed.org/docs/api/fred/series_search.html
         """
         kwargs["search_text"] = str(search_text)
-        url = self.make_url("SERIES_SEARCH", **kwargs)
-        print(url)
+        kwargs.setdefault("file_type", "json")
+        return self.retrieve("SERIES_SEARCH", **kwargs)
+
+
+class RateHistory(object):
+    """
+    Every observation of a weekly rate series, as two parallel packed arrays
+    sorted by date, so that averaging any period is a pair of binary
+    searches and a sum over a slice.
+    """
+    def __init__(self, dates: array = None, rates: array = None, refreshed: date = None):
+        self.dates = dates if dates is not None else array('i')  # date.toordinal()
+        self.rates = rates if rates is not None else array('i')  # percent * RATE_SCALE
+        self.refreshed = refreshed or date.min                   # when last brought up to date
+
+    def extend(self, observations: list) -> int:
+        """
+        Append FRED observations newer than the last one we have. FRED
+        reports missing observations as ".", which are skipped.
+
+        Returns:
+            (int): Number of observations added.
+        """
+        added = 0
+        last = self.dates[-1] if self.dates else 0
+        for observation in observations:
+            if observation["value"] == ".":
+                continue
+            ordinal = date.fromisoformat(observation["date"]).toordinal()
+            if ordinal <= last:
+                continue
+            self.dates.append(ordinal)
+            self.rates.append(int(Decimal(observation["value"]) * RATE_SCALE))
+            last = ordinal
+            added += 1
+        return added
+
+    def last_date(self) -> date:
+        return date.fromordinal(self.dates[-1]) if self.dates else None
+
+    def average(self, start: date, end: date) -> Decimal:
+        """
+        Average the observations from *start* through *end*, inclusive.
+
+        Returns:
+            (Decimal): The average rate in percent, or None if there are no
+            observations in the period.
+        """
+        low = bisect_left(self.dates, start.toordinal())
+        high = bisect_right(self.dates, end.toordinal())
+        if high <= low:
+            return None
+        total = Decimal(sum(self.rates[low:high]))
+        average = total / (high - low) / RATE_SCALE
+        return average.quantize(AVERAGE_PLACES, rounding=ROUND_HALF_UP)
+
+    def to_redis(self) -> dict:
+        return {"dates": pack(self.dates), "rates": pack(self.rates),
+                "refreshed": self.refreshed.isoformat()}
+
+    @classmethod
+    def from_redis(cls, fields: dict):
+        fields = {(key.decode() if isinstance(key, bytes) else key): value
+                  for key, value in fields.items()}
+        if "dates" not in fields:
+            return None
+        dates, rates = unpack(fields["dates"]), unpack(fields["rates"])
+        refreshed = fields["refreshed"]
+        refreshed = refreshed.decode() if isinstance(refreshed, bytes) else refreshed
+        return cls(dates, rates, date.fromisoformat(refreshed))
+
+    def __len__(self):
+        return len(self.dates)
+
+
+def pack(values: array) -> str:
+    return base64.b64encode(values.tobytes()).decode()
+
+
+def unpack(value) -> array:
+    if isinstance(value, str):
+        value = value.encode()
+    try:
+        value = base64.b64decode(value, validate=True)
+    except binascii.Error:
+        pass  # Stored as raw bytes, before arrays were encoded
+    values = array('i')
+    values.frombytes(value)
+    return values
+
+
+def snapshot_history(series: str) -> RateHistory:
+    """
+    Return the history of *series* in the packaged snapshot, or None.
+    """
+    snapshot = read_snapshot(SNAPSHOT)
+    if snapshot is None or series not in snapshot["series"]:
+        return None
+    metrics.incr('us_fred_data', 'snapshot reads')
+    record = snapshot["series"][series]
+    return RateHistory(array('i', record["dates"]), array('i', record["rates"]),
+                       date.fromisoformat(snapshot["generated"][:10]))
 
 
 class FredUtil(object):
@@ -128,13 +284,20 @@ class FredUtil(object):
     Higher-level interface into Fred that computes frequently used values.
     """
 
-    def __init__(self):
+    def __init__(self, the_redis=None):
         self.fred = Fred()
+        self.the_redis = the_redis or (DARedis() if DARedis else None)
 
     def average_fixed_mortgage(self, year: int, month: int = 0, duration: int = 30) -> Decimal:
         """
         Get the average mortage interest rate for the requested period.
 
+        The average is computed from the series' weekly history, which is
+        fetched from FRED once and topped up daily. If that is unavailable,
+        FRED averages the period and the average is cached in Redis: forever
+        once the period is over, and for the 'fred cache seconds' setting
+        until then.
+
         Args:
             year (int): Year being queried. [REQUIRED]
             month (int): Month being queried. If omitted, the average is for
@@ -177,6 +340,24 @@ class FredUtil(object):
             observation_end = f"{year}-{padded_month}-{padded_day}"
             frequency = "m"  # Monthly
 
+        series = f"MORTGAGE{i_duration}US"
+        history = self.history(series)
+        if history is not None:
+            rate = history.average(date.fromisoformat(observation_start),
+                                   date.fromisoformat(observation_end))
+            if rate is not None:
+                metrics.incr('us_fred_data', 'local averages')
+                return Decimal(rate/100)
+
+        # No history, or no observations for the period in it: ask FRED.
+        period = f"{i_year}" if i_month == 0 else f"{i_year}-{i_month:02}"
+        cache_key = CACHE_KEY_TEMPLATE.format(series=series, frequency=frequency, period=period)
+        rate = self.cache_get(cache_key)
+        if rate is not None:
+            metrics.incr('us_fred_data', 'cache hits')
+            return rate
+        metrics.incr('us_fred_data', 'cache misses')
+
         params = {
             "observation_start": observation_start,
             "observation_end": observation_end,
@@ -191,8 +372,164 @@ class FredUtil(object):
         result = json.loads(result)
         rate = result["observations"][0]["value"]
         rate = Decimal(Decimal(rate)/100)
+        self.cache_put(cache_key, rate, date.fromisoformat(observation_end))
         return rate
 
+    def history(self, series: str) -> RateHistory:
+        """
+        Return the whole history of *series*, bringing it up to date once a
+        day. An out of date history is served as it is while the update is
+        fetched in the background, and only one process fetches from FRED.
+        Until a history has been stored, the packaged snapshot is served in
+        the same way. Only when there is neither is FRED asked while the
+        caller waits.
+
+        Returns:
+            (RateHistory): The history, or None if it cannot be had.
+        """
+        if series not in HISTORY_SERIES:
+            return None
+        today = date.today()
+        with _histories_lock:
+            history, checked = _histories.get(series, (None, 0))
+        if history is not None and (history.refreshed >= today or
+                                    time.monotonic() - checked < HISTORY_CHECK_SECONDS):
+            return history
+
+        history = self.load_history(series) or history
+        if history is None:
+            history = snapshot_history(series)
+            if history is not None:
+                self.refresh_in_background(series, history)
+            else:
+                history = self.locked_refresh(series)
+        elif history.refreshed < today:
+            self.refresh_in_background(series, history)
+        if history is not None:
+            with _histories_lock:
+                _histories[series] = (history, time.monotonic())
+        return history
+
+    def locked_refresh(self, series: str, history: RateHistory = None) -> RateHistory:
+        """
+        Refresh *history* unless another process is already doing so.
+        """
+        lock = RefreshLock(HISTORY_KEY_TEMPLATE.format(series=series), the_redis=self.the_redis)
+        if not lock.acquire():
+            return history
+        try:
+            return self.refresh_history(series, history)
+        finally:
+            lock.release()
+
+    def refresh_in_background(self, series: str, history: RateHistory):
+        """
+        Refresh *history* in a daemon thread, unless this process is already
+        doing so.
+        """
+        with _histories_lock:
+            if series in _refreshing:
+                return
+            _refreshing.add(series)
+
+        def run():
+            try:
+                refreshed = self.locked_refresh(series, history)
+                # Serve the refreshed history from now on, rather than the
+                # out of date one, until it is next checked.
+                if refreshed is not None and refreshed is not history:
+                    with _histories_lock:
+                        _histories[series] = (refreshed, time.monotonic())
+            except Exception as e:
+                logmessage(f"refresh_in_background(): {series}: {str(e)}")
+            finally:
+                with _histories_lock:
+                    _refreshing.discard(series)
+
+        threading.Thread(target=run, name=f"us_fred_data {series} refresh",
+                         daemon=True).start()
+
+    def load_history(self, series: str) -> RateHistory:
+        if self.the_redis is None:
+            return None
+        try:
+            return RateHistory.from_redis(
+                self.the_redis.hgetall(HISTORY_KEY_TEMPLATE.format(series=series)) or {})
+        except Exception as e:
+            logmessage(f"load_history(): {str(e)}")
+            return None
+
+    def refresh_history(self, series: str, history: RateHistory = None) -> RateHistory:
+        """
+        Fetch the observations of *series* that are newer than *history*,
+        or all of them if there is no history yet, and store the result.
+
+        Returns:
+            (RateHistory): The updated history, or *history* if FRED could not
+            be reached.
+        """
+        params = {"file_type": "json"}
+        if history is not None and len(history):
+            params["observation_start"] = (history.last_date() + timedelta(days=1)).isoformat()
+        try:
+            result = json.loads(self.fred.series_observations(series, **params))
+            observations = result["observations"]
+        except Exception as e:
+            logmessage(f"refresh_history(): Unable to retrieve {series}: {str(e)}")
+            metrics.incr('us_fred_data', 'history refresh failures')
+            return history
+
+        # Extend a copy: other threads may be averaging the original.
+        history = RateHistory(array('i', history.dates), array('i', history.rates)) \
+            if history is not None else RateHistory()
+        added = history.extend(observations)
+        history.refreshed = date.today()
+        metrics.incr('us_fred_data', 'history refreshes')
+        logmessage(f"refresh_history(): Added {added} observations to {series}")
+
+        if self.the_redis is not None:
+            try:
+                key = HISTORY_KEY_TEMPLATE.format(series=series)
+                pipe = self.the_redis.pipeline(transaction=True)
+                for field, value in history.to_redis().items():
+                    pipe.hset(key, field, value)
+                pipe.execute()
+            except Exception as e:
+                logmessage(f"refresh_history(): Unable to store {series}: {str(e)}")
+        return history
+
+    def cache_get(self, cache_key: str) -> Decimal:
+        """
+        Return a cached rate, or None. The cache is an optimization, so
+        failing to read it is not an error.
+        """
+        if self.the_redis is None:
+            return None
+        try:
+            cached = self.the_redis.get(cache_key)
+        except Exception as e:
+            logmessage(f"cache_get(): {str(e)}")
+            return None
+        if cached is None:
+            return None
+        return Decimal(cached.decode() if isinstance(cached, bytes) else cached)
+
+    def cache_put(self, cache_key: str, rate: Decimal, period_end: date):
+        """
+        Cache a rate: forever if its period is over, otherwise briefly,
+        because the average changes as the period's observations come in.
+        """
+        if self.the_redis is None:
+            return
+        try:
+            if period_end + timedelta(days=CLOSE_GRACE_DAYS) < date.today():
+                self.the_redis.set(cache_key, str(rate))
+            else:
+                seconds = int(local_config('fred cache seconds', DEFAULT_CACHE_SECONDS))
+                self.the_redis.set(cache_key, str(rate), ex=seconds)
+        except Exception as e:
+            logmessage(f"cache_put(): {str(e)}")
+
 
 if __name__ == "__main__":
     futil = FredUtil()
@@ -11,17 +11,32 @@ as an ASP and for both of these reasons, the list may be a little
 fragile. Because of the potential fagility, we don't go checking this
 list on a regular basis.
 
+Until the list has been cached, the snapshot packaged with this module is
+served while the list is retrieved in the background.
+
 Copyright (c) 2019 by Thomas J. Daley, J.D. All Rights Reserved.
 """
 from lxml import html
-import requests
 import json
+import threading
 
 from docassemble.base.util import DARedis
+from docassemble.base.logger import logmessage
+
+from . import http_client, metrics
+from .reference_cache import bump_version
+from .refresh_lock import RefreshLock
+from .snapshots import read_snapshot
 
 URL = 'https://card.txcourts.gov/DirectorySearch.aspx'
 STORE = 'us_tx_counties.json'
 
+# Name of the packaged snapshot of the county list.
+SNAPSHOT = 'us_tx_counties'
+
+# Set while this process is retrieving the county list in the background.
+_retrieving = threading.Event()
+
 
 class UsTxCounties(object):
     """
@@ -36,10 +51,17 @@ class UsTxCounties(object):
     def load(self) -> list:
         """
         Load courts from a local store. If the local store does not exist,
-        then load from the original web source.
+        then serve the packaged snapshot while the list is retrieved from
+        the original web source in the background, or, if there is no
+        snapshot, retrieve it now.
         """
         counties = self.read()
         if counties is None:
+            snapshot = read_snapshot(SNAPSHOT)
+            if snapshot is not None:
+                metrics.incr(STORE, 'snapshot reads')
+                self.retrieve_in_background()
+                return snapshot['counties']
             counties = self.retrieve()
         return counties
 
@@ -50,20 +72,54 @@ class UsTxCounties(object):
         Args:
             None.
         Returns:
-            (list): List of counties in Texas.
+            (list): List of counties in Texas. It is the caller's own
+            copy: this instance is shared by every interview in the process.
         """
-        return self.counties
+        return list(self.counties)
 
     def retrieve(self):
         """
         Retrieve a list of counties from the state's search screen and save
         them to file storage.
         """
-        page = requests.get(URL)
-        counties = self.html2list(page.content)
+        counties = self.fetch()
         self.save(counties)
         return counties
 
+    def retrieve_in_background(self):
+        """
+        Retrieve and save the list of counties in a daemon thread, unless
+        this process or another one is already doing so.
+        """
+        if _retrieving.is_set():
+            return
+        _retrieving.set()
+
+        def run():
+            lock = RefreshLock(STORE)
+            try:
+                if not lock.acquire():
+                    return
+                try:
+                    self.counties = self.retrieve()
+                finally:
+                    lock.release()
+            except Exception as e:
+                logmessage(f"Background county list retrieval failed: {str(e)}")
+            finally:
+                _retrieving.clear()
+
+        threading.Thread(target=run, name='us_tx_counties retrieve',
+                         daemon=True).start()
+
+    def fetch(self) -> list:
+        """
+        Retrieve a list of counties from the state's search screen.
+        """
+        page = http_client.get(URL)
+        page.raise_for_status()
+        return self.html2list(page.content)
+
     def html2list(self, page_html: str) -> list:
         """
         Convert the html we retrieve from *URL* to a list of counties.
@@ -95,6 +151,7 @@ class UsTxCounties(object):
         """
         the_redis = DARedis()
         the_redis.set_data(STORE, counties)
+        bump_version(STORE, the_redis)
 
 
 def main():
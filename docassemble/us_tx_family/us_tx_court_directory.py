@@ -3,22 +3,69 @@ us_tx_court_directory.py - Retrieve a list of court personel in Texas.
 
 Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
 """
+import copy
+import csv
 from datetime import date
+import hashlib
 import re
-import requests
+import tempfile
 import json
+import threading
+import time
 
+from . import http_client, metrics
 from .local_config import local_config
+from .partitioned_store import PartitionedStore
+from .refresh_lock import RefreshLock
+from .snapshots import read_snapshot
+from .token_index import TokenIndex
 
 from docassemble.base.core import DAList
 from docassemble.base.util import DARedis, Individual, IndividualName, \
     Address
+from docassemble.base.logger import logmessage
 
 URL = 'https://card.txcourts.gov/ExcelExportPublic.aspx?type=P&export=E&CommitteeID=0&Court=&SortBy=tblCounty.Sort_ID,%20Last_Name&Active_Flg=true&Last_Name=&First_Name=&Court_Type_CD=55&Court_Sub_Type_CD=0&County_ID=0&City_CD=0&Address_Type_CD=0&Annual_Report_CD=0&PersonnelType1=&PersonnelType2=&DistrictPrimaryLocOnly=1&AdminJudicialRegion=0&COADistrictId=0'
+# The name of the redis dataset where we store the directory. Court
+# personnel are stored one court per field of the *STORE*:courts hash and
+# clerk personnel one county per field of the *STORE*:clerks hash. The
+# search index over everyone is the 'index' field of *STORE*:search.
 STORE = 'us_tx_court_directory.json'
 
-# Change *VERSION* to force the cached *STORE* file to be refreshed.
-VERSION = 'A'
+# Change *VERSION* to force the cached *STORE* file to be refreshed and the
+# export to be parsed again, e.g. when the parser or the partitions change.
+VERSION = 'B'
+
+# Name of the packaged snapshot of the directory.
+SNAPSHOT = 'us_tx_court_directory'
+
+# Serve a cached directory while it is refreshed in the background, unless
+# it was retrieved more than this many days ago.
+MAX_STALE_DAYS = 7
+
+# Seconds after which an abandoned refresh lock expires.
+LOCK_SECONDS = 300
+
+# Seconds to wait for another process's refresh when there is no cached
+# directory to serve in the meantime.
+WAIT_SECONDS = 120
+
+# How much a search term matching each field counts when ranking people.
+SEARCH_WEIGHTS = {
+    'last name': 3,
+    'email': 3,
+    'first name': 2,
+    'title': 1,
+    'court': 1,
+    'county': 1
+}
+
+# Exports larger than this many bytes are spooled to disk while they
+# are downloaded rather than held in memory.
+SPOOL_BYTES = 8 * 1024 * 1024
+
+# Set while this process is refreshing the directory in the background.
+_refreshing = threading.Event()
 
 
 class UsTxCourtDirectory(object):
@@ -30,24 +77,167 @@ class UsTxCourtDirectory(object):
         """
         Initialize and instance.
         """
+        self.storage = PartitionedStore(STORE)
+        self.manifest = None
+        # Records we have already fetched, including None for ones that
+        # do not exist.
         self.courts = {}  # Indexed by judicial district number
         self.clerks = {}  # Indexed by uppercased county name
+        self.staff_lists = {}  # DALists already built, by (partition, field)
+        self.search_index = None
         self.load()
 
     def load(self):
         """
         Load courts from a local store.
+
+        An out-of-date directory is served immediately while a background
+        thread retrieves the new one. Only a directory older than the
+        configured maximum staleness, or no directory at all, makes the
+        caller wait for the retrieval, unless there is a packaged snapshot
+        to serve in the meantime.
         """
         directory_info = self.read()
-        if directory_info is None \
-                or directory_info['refresh_key'] != refresh_key():
-            courts, clerks = self.retrieve()
-            self.courts = courts
-            self.clerks = clerks
-            self.save(courts, clerks)
-        else:
-            self.courts = directory_info['courts']
-            self.clerks = directory_info['clerks']
+        if directory_info is not None:
+            self.use(directory_info)
+            if directory_info['refresh_key'] == refresh_key():
+                return
+            if background_refresh() and not too_stale(directory_info):
+                self.refresh_in_background()
+                return
+        elif self.use_snapshot():
+            self.refresh_in_background()
+            return
+
+        if self.refresh() or directory_info is not None:
+            return
+
+        # Someone else is retrieving the directory and we have nothing to
+        # serve until they are done.
+        lock = RefreshLock(STORE)
+        started = time.monotonic()
+        lock.wait(lambda: self.read() is not None,
+                  local_config('court staff wait seconds', WAIT_SECONDS))
+        metrics.observe(STORE, 'waiter blocked', time.monotonic() - started)
+        directory_info = self.read()
+        if directory_info is None:
+            logmessage("Timed out waiting for the court directory to be retrieved")
+            metrics.incr(STORE, 'waiter timeouts')
+            raise RuntimeError("The court directory is not available")
+        self.use(directory_info)
+
+    def refresh(self) -> bool:
+        """
+        Retrieve the directory and, if that succeeds, save it and start
+        serving it. If the retrieval fails, the directory being served is
+        left alone, or the error is raised if there is none.
+
+        Returns:
+            (bool): True if this instance is now serving a current directory.
+        """
+        lock = RefreshLock(STORE, ttl=local_config('court staff lock seconds', LOCK_SECONDS))
+        if not lock.acquire():
+            metrics.incr(STORE, 'rebuilds suppressed')
+            return False
+        try:
+            # Another process may have finished a refresh between our
+            # read and acquiring the lock.
+            directory_info = self.read()
+            if directory_info is not None \
+                    and directory_info['refresh_key'] == refresh_key():
+                self.use(directory_info)
+                return True
+            started = time.monotonic()
+            try:
+                retrieved = self.retrieve(directory_info)
+            except Exception as e:
+                logmessage(f"Unable to retrieve court directory: {str(e)}")
+                metrics.incr(STORE, 'refresh failures')
+                if self.manifest is None:
+                    raise
+                return False
+            if retrieved is None:
+                # Nothing changed since the last retrieval, so there is no
+                # need to parse or rewrite the directory.
+                manifest = cache_record(validators(directory_info))
+                self.storage.write_manifest(manifest, bump=False)
+                self.manifest = manifest
+                metrics.incr(STORE, 'unchanged refreshes')
+                return True
+            courts, clerks, headers = retrieved
+            self.save(courts, clerks, headers)
+            self.use(cache_record(headers), courts, clerks)
+            metrics.observe(STORE, 'rebuild', time.monotonic() - started)
+            return True
+        finally:
+            lock.release()
+
+    def refresh_in_background(self):
+        """
+        Refresh the directory in a daemon thread, unless this process is
+        already doing so.
+        """
+        if _refreshing.is_set():
+            return
+        _refreshing.set()
+
+        def run():
+            try:
+                self.refresh()
+            except Exception as e:
+                logmessage(f"Background court directory refresh failed: {str(e)}")
+            finally:
+                _refreshing.clear()
+
+        metrics.incr(STORE, 'stale reads')
+        threading.Thread(target=run, name='us_tx_court_directory refresh',
+                         daemon=True).start()
+
+    def use_snapshot(self) -> bool:
+        """
+        Serve personnel from the packaged snapshot, if there is one.
+
+        Returns:
+            (bool): True if there is a snapshot to serve.
+        """
+        snapshot = read_snapshot(SNAPSHOT)
+        if snapshot is None:
+            return False
+        metrics.incr(STORE, 'snapshot reads')
+        self.use({'refresh_key': None, 'snapshot': snapshot['generated']},
+                 snapshot['courts'], snapshot['clerks'])
+        return True
+
+    def use(self, directory_info: dict, courts: dict = None, clerks: dict = None):
+        """
+        Serve personnel from a cached dataset.
+
+        Args:
+            directory_info (dict): The dataset's manifest.
+            courts (dict): Every court's personnel, if we already have them.
+            clerks (dict): Every clerk's office, if we already have them.
+        """
+        self.manifest = directory_info
+        self.courts = dict(courts or {})
+        self.clerks = dict(clerks or {})
+        self.staff_lists = {}
+        self.search_index = None
+
+    def fetch(self, partition: str, records: dict, field: str):
+        """
+        Fetch a record we have not seen yet from the store.
+
+        Args:
+            partition (str): 'courts' or 'clerks'.
+            records (dict): Where to put the record we fetch.
+            field (str): Court number or county name to fetch.
+        Returns:
+            None
+        """
+        try:
+            records[field] = self.storage.get(partition, field)
+        except Exception as e:
+            logmessage(f"Unable to read cached {partition} from {STORE}: {str(e)}")
 
     def get_court(self, court_number: str) -> list:
         """
@@ -59,9 +249,11 @@ class UsTxCourtDirectory(object):
             (str): Fields for this court or None if not found.
         """
         court_idx = court_index(court_number)
-        if court_idx in self.courts:
-            return self.dalist_of_individuals(self.courts[court_idx])
-        return None
+        if court_idx is None:
+            return None
+        if court_idx not in self.courts:
+            self.fetch('courts', self.courts, court_idx)
+        return self.staff_list('courts', self.courts, court_idx)
 
     def get_clerk(self, county: str) -> list:
         """
@@ -73,9 +265,63 @@ class UsTxCourtDirectory(object):
             (list): List of district clerk personnel (probably only one)
         """
         county_idx = county_index(county)
-        if county_idx in self.clerks:
-            return self.dalist_of_individuals(self.clerks[county_idx])
-        return None
+        if county_idx not in self.clerks:
+            self.fetch('clerks', self.clerks, county_idx)
+        return self.staff_list('clerks', self.clerks, county_idx)
+
+    def search(self, query: str, limit: int = 10) -> list:
+        """
+        Find court and clerk personnel by name, email, title, court or
+        county. Each word of *query* matches any word that starts with it,
+        e.g. "smi coll" finds a Smith in Collin County.
+
+        Args:
+            query (str): Search terms.
+            limit (int): Maximum number of people to return.
+        Returns:
+            (list): Person dicts, best match first.
+        """
+        if self.search_index is None and self.manifest and self.manifest.get('snapshot'):
+            # The snapshot has no index of its own, but every person in it.
+            self.search_index = search_index(self.courts, self.clerks)
+        if self.search_index is None:
+            try:
+                self.search_index = self.storage.get('search', 'index')
+                if self.search_index is None and self.manifest is not None:
+                    # Stored before there was an index: build one from
+                    # the people stored.
+                    self.search_index = search_index(self.storage.get_all('courts'),
+                                                     self.storage.get_all('clerks'))
+                    metrics.incr(STORE, 'search indexes built')
+            except Exception as e:
+                logmessage(f"Unable to read court directory search index: {str(e)}")
+            if self.search_index is None:
+                return []
+        return self.search_index.search(query, limit)
+
+    def staff_list(self, partition: str, records: dict, field: str):
+        """
+        Return a DAList of the personnel in one court or clerk's office.
+
+        The list is built once per directory version and each caller gets a
+        deep copy of it, so an interview that changes a staff member, or the
+        list, does not change it for any other interview.
+
+        Args:
+            partition (str): 'courts' or 'clerks'.
+            records (dict): self.courts or self.clerks.
+            field (str): Court number or county index.
+        Returns:
+            DAList: List of instances of Individual, or None if not found.
+        """
+        if records.get(field) is None:
+            return None
+        master = self.staff_lists.get((partition, field))
+        if master is None:
+            master = self.dalist_of_individuals(records[field])
+            self.staff_lists[(partition, field)] = master
+            metrics.incr(STORE, 'staff lists built')
+        return copy.deepcopy(master)
 
     def dalist_of_individuals(self, directory: list):
         """
@@ -117,15 +363,51 @@ class UsTxCourtDirectory(object):
         result.init(object_type=Individual, elements=individuals)
         return result
 
-    def retrieve(self) -> dict:
+    def retrieve(self, directory_info: dict = None):
         """
-        Retrieve a list of courts for this state from the statute that
-        authorizes them.
+        Retrieve the personnel directory from txcourts.gov.
+
+        Args:
+            directory_info (dict): Manifest of the directory we already have,
+            if any. Its validators are used to skip unchanged exports.
+        Returns:
+            (tuple): courts, clerks, and the validators of this export, or
+            None if the export has not changed since *directory_info*.
         """
-        page = requests.get(URL)
-        tsv = page.text
-        courts, clerks = self.tsv2dict(tsv)
-        return courts, clerks
+        previous = validators(directory_info)
+        headers = {}
+        if previous.get('etag'):
+            headers['If-None-Match'] = previous['etag']
+        if previous.get('last_modified'):
+            headers['If-Modified-Since'] = previous['last_modified']
+        page = http_client.get(URL, headers=headers, stream=True)
+        if page.status_code == 304:
+            return None
+        page.raise_for_status()
+
+        # Spool the export while hashing it, so an unchanged export is
+        # never parsed and a changed one is never held in memory whole.
+        digest = hashlib.sha256()
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES) as spool:
+            for chunk in page.iter_content(chunk_size=64 * 1024):
+                digest.update(chunk)
+                spool.write(chunk)
+
+            current = {
+                'etag': page.headers.get('ETag'),
+                'last_modified': page.headers.get('Last-Modified'),
+                'sha256': digest.hexdigest()
+            }
+            if previous.get('sha256') == current['sha256']:
+                return None
+
+            spool.seek(0)
+            encoding = page.encoding or 'utf-8'
+            lines = (line.decode(encoding, errors='replace').rstrip('\n')
+                     for line in spool)
+            courts, clerks, rejects = self.lines2dict(lines)
+        current['rejects'] = rejects
+        return courts, clerks, current
 
     def tsv2dict(self, tsv: str):
         """
@@ -136,25 +418,50 @@ class UsTxCourtDirectory(object):
         Returns:
             (dict): courts indexed by court number, clerks indexed by county
         """
+        courts, clerks, rejects = self.lines2dict(tsv.split('\n'))
+        return courts, clerks
+
+    def lines2dict(self, lines):
+        """
+        Build the court and clerk indexes from the lines of the export, one
+        line at a time.
+
+        Args:
+            lines (iterable): Lines of tab-separated data retrieved from *URL*,
+            without their trailing newlines.
+        Returns:
+            (tuple): courts indexed by court number, clerks indexed by county,
+            and the number of malformed rows that were rejected.
+        """
         courts = {}
         clerks = {}
+        rejects = 0
 
-        lines = [l.replace('\r', '') for l in tsv.split('\n') if len(l) > 10]
-        header = lines[0]
-        headers = [h.lower().strip()
-                   for h in header.split('\t') if h.strip() != '']
+        # Lines of 10 characters or fewer are blank or junk, not records.
+        lines = (line.replace('\r', '') for line in lines if len(line) > 10)
+        reader = csv.reader(lines, delimiter='\t', quoting=csv.QUOTE_NONE)
+
+        header = next(reader, None)
+        if header is None:
+            return courts, clerks, rejects
+        headers = [h.lower().strip() for h in header if h.strip() != '']
         len_headers = len(headers)
-        for line in lines[1:]:
-            cols = [c.strip() for c in line.split('\t')]
+
+        while True:
+            try:
+                row = next(reader)
+            except StopIteration:
+                break
+            except csv.Error:
+                rejects += 1
+                continue
 
             # Skip mal-formed records
-            if len(cols) != len_headers:
-                # print(cols)
+            if len(row) != len_headers:
+                rejects += 1
                 continue
 
-            person = {}
-            for idx, header_text in enumerate(headers):
-                person[header_text] = cols[idx]
+            person = dict(zip(headers, (c.strip() for c in row)))
 
             court_idx = court_index(person['court'])
             if court_idx:
@@ -168,22 +475,75 @@ class UsTxCourtDirectory(object):
                 if county_idx not in clerks:
                     clerks[county_idx] = []
                 clerks[county_idx].append(person)
-        return courts, clerks
+
+        if rejects:
+            logmessage(f"Rejected {rejects} malformed rows from the court directory")
+            metrics.incr(STORE, 'rejected rows', rejects)
+        return courts, clerks, rejects
 
     def read(self) -> dict:
         """
-        Read the list of counties from file storage.
+        Read the directory's manifest from local storage.
         """
-        the_redis = DARedis()
-        result = the_redis.get_data(STORE)
+        result = None
+        try:
+            result = self.storage.read_manifest()
+        except Exception as e:
+            logmessage(f"Unable to read cached court directory: {str(e)}")
         return result
 
-    def save(self, courts, clerks):
+    def save(self, courts, clerks, headers: dict = None):
+        """
+        Persist the directory info to local storage. Only the courts and
+        counties whose personnel changed are rewritten, and a summary of the
+        change is added to the change log.
         """
-        Persist the directory info to file storage.
+        partitions = {
+            'courts': courts,
+            'clerks': clerks,
+            'search': {'index': search_index(courts, clerks)}
+        }
+        delta = self.storage.diff(partitions)
+        if delta is None:
+            # Nothing to compare with, so write everything.
+            self.storage.write(partitions, cache_record(headers))
+            return
+        change = self.change_summary(partitions, delta)
+        self.storage.apply(delta, cache_record(headers), change)
+        for partition, records in delta.items():
+            metrics.incr(STORE, f'{partition} rewritten', len(records['changed']))
+            metrics.incr(STORE, f'{partition} removed', len(records['removed']))
+
+    def change_summary(self, partitions: dict, delta: dict) -> dict:
         """
-        the_redis = DARedis()
-        the_redis.set_data(STORE, cache_record(courts, clerks))
+        Count the people added, removed and modified in each court and
+        county that changed.
+
+        Args:
+            partitions (dict): The complete new courts and clerks.
+            delta (dict): What changed, from PartitionedStore.diff().
+        Returns:
+            (dict): Counts indexed by partition, then by court or county.
+        """
+        summary = {'refresh_key': refresh_key(), 'time': time.time()}
+        for partition, records in delta.items():
+            if partition not in ('courts', 'clerks'):
+                continue
+            fields = list(records['changed']) + records['removed']
+            old = dict(zip(fields, self.storage.get_many(partition, fields)))
+            summary[partition] = {
+                field: person_changes(old.get(field) or [],
+                                      partitions[partition].get(field) or [])
+                for field in fields
+            }
+        return summary
+
+    def changes(self, limit: int = 10) -> list:
+        """
+        Returns summaries of the most recent changes to the directory,
+        newest first.
+        """
+        return self.storage.changes(limit)
 
 
 def county_index(county: str) -> str:
@@ -216,12 +576,98 @@ def court_index(court: str) -> str:
     return None
 
 
-def cache_record(courts, clerks):
+def search_index(courts: dict, clerks: dict) -> TokenIndex:
+    """
+    Build the search index over every person in the directory.
+
+    Args:
+        courts (dict): Court personnel indexed by court number.
+        clerks (dict): Clerk personnel indexed by county.
+    Returns:
+        (TokenIndex): Index over *SEARCH_WEIGHTS* fields of each person.
+    """
+    people = [person for staff in courts.values() for person in staff]
+    people.extend(person for staff in clerks.values() for person in staff)
+    people.sort(key=lambda p: (p.get('last name', ''), p.get('first name', '')))
+    return TokenIndex(people, SEARCH_WEIGHTS)
+
+
+def person_changes(old: list, new: list) -> dict:
+    """
+    Count the people added, removed and modified between two lists of
+    personnel. People are matched by name.
+
+    Args:
+        old (list): Person dicts before the change.
+        new (list): Person dicts after the change.
+    Returns:
+        (dict): Counts of people 'added', 'removed' and 'modified'.
+    """
+    def by_name(people):
+        return {(p.get('last name'), p.get('first name'),
+                 p.get('middle name'), p.get('suffix')): p for p in people}
+
+    old_people = by_name(old)
+    new_people = by_name(new)
     return {
-                'courts': courts,
-                'clerks': clerks,
-                'refresh_key': refresh_key()
+        'added': len(new_people.keys() - old_people.keys()),
+        'removed': len(old_people.keys() - new_people.keys()),
+        'modified': sum(1 for name in new_people.keys() & old_people.keys()
+                        if new_people[name] != old_people[name])
+    }
+
+
+def cache_record(headers: dict = None):
+    record = {
+                'refresh_key': refresh_key(),
+                'retrieved': time.time()
     }
+    record.update(headers or {})
+    record['parser_version'] = parser_version()
+    return record
+
+
+def validators(directory_info: dict) -> dict:
+    """
+    Extract what we know about the last export we parsed: its ETag,
+    Last-Modified header and SHA-256. An export parsed by another version
+    of the parser has to be parsed again even if it has not changed, so
+    none of them are returned for it.
+    """
+    directory_info = directory_info or {}
+    if directory_info.get('parser_version') != parser_version():
+        directory_info = {}
+    return {name: directory_info.get(name)
+            for name in ('etag', 'last_modified', 'sha256')}
+
+
+def parser_version() -> str:
+    """
+    Returns the version of the parser and of the shape of the stored
+    directory. Changing *VERSION* or 'court staff version' changes it.
+    """
+    return str(local_config('court staff version', VERSION))
+
+
+def background_refresh() -> bool:
+    """
+    Returns True if an out-of-date directory should be refreshed in the
+    background rather than while the user waits.
+    """
+    return bool(local_config('court staff background refresh', True))
+
+
+def too_stale(directory_info: dict) -> bool:
+    """
+    Returns True if *directory_info* is too old to serve while a new
+    directory is retrieved. Records saved before we tracked their age
+    are always too old.
+    """
+    retrieved = directory_info.get('retrieved')
+    if retrieved is None:
+        return True
+    max_age = float(local_config('court staff max stale days', MAX_STALE_DAYS)) * 86400
+    return time.time() - retrieved > max_age
 
 
 def refresh_key() -> str:
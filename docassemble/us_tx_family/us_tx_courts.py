@@ -3,11 +3,14 @@ us_tx_courts.py - Retrieve a list of Courts in Texas.
 
 Copyright (c) 2019 by Thomas J. Daley, J.D. All Rights Reserved.
 """
+from bisect import bisect_left
+import copy
 from datetime import date
 from lxml import html
 import re
-import requests
 import json
+import threading
+import time
 
 # We can get import errors in the test environment when we're doing very
 # simple unit tests in an environment where the entire DocAssemble package
@@ -19,8 +22,12 @@ except ModuleNotFoundError:
     def logmessage(message: str):
         print(message)
 
+from . import http_client, metrics
 from .ml_stripper import MLStripper
 from .local_config import local_config
+from .partitioned_store import PartitionedStore
+from .refresh_lock import RefreshLock
+from .snapshots import read_snapshot
 
 # Change *VERSION* to force the cached *STORE* file to be refreshed.
 VERSION = 'B'
@@ -28,12 +35,33 @@ VERSION = 'B'
 # The URL where we retrieve the statute that defines all district courts
 URL = 'https://statutes.capitol.texas.gov/Docs/GV/htm/GV.24.htm'
 
-# The file name or redis key where we store the parsed court information.
+# The name of the redis dataset where we store the parsed court information.
+# Courts are stored one per field of the *STORE*:courts hash and the court
+# numbers for each county one per field of the *STORE*:by_county hash.
 STORE = 'us_tx_courts.json'
 
+# Name of the packaged snapshot of the court list.
+SNAPSHOT = 'us_tx_courts'
+
+# Seconds after which an abandoned rebuild lock expires.
+LOCK_SECONDS = 300
+
+# Seconds to wait for another process's rebuild when there is no previous
+# court list to serve in the meantime.
+WAIT_SECONDS = 60
+
 # The highest district court number that we look for.
 MAX_COURT_NUMBER = 1000
 
+# Matches every "NNNth JUDICIAL DISTRICT" heading in the stripped statute.
+COURT_HEADING = re.compile(r'(\d+)(ST|ND|RD|TH) JUDICIAL DISTRICT')
+
+# Marks the end of each section's history note.
+SECTION_END = ', eff. '
+
+# Set while this process is rebuilding the court list in the background.
+_rebuilding = threading.Event()
+
 
 class UsTxCourts(object):
     """
@@ -43,22 +71,139 @@ class UsTxCourts(object):
         """
         Initialize and instance.
         """
+        self.storage = PartitionedStore(STORE)
+        self.manifest = None
+        # Records we have already fetched, including None for ones that
+        # do not exist.
+        self.courts = {}
         self.courts_by_county = {}
-        self.courts = None
         self.load()
 
     def load(self):
         """
         Load courts from a local store.
+
+        Only one process rebuilds an out-of-date court list. The others keep
+        serving the previous month's record until the new one is written or,
+        if there is no previous record, serve the packaged snapshot or wait
+        for the rebuild to finish.
         """
         courts_info = self.read()
-        if courts_info is None or courts_info['refresh_key'] != refresh_key():
-            self.courts = self.retrieve()
-            self.courts_by_county = self.county_list(self.courts)
-            self.save(self.courts, self.courts_by_county)
+        if is_current(courts_info):
+            self.use(courts_info)
+            return
+        if courts_info is None and self.use_snapshot():
+            self.rebuild_in_background()
+            return
+
+        lock = RefreshLock(STORE, ttl=local_config('court list lock seconds', LOCK_SECONDS))
+        if lock.acquire():
+            try:
+                # Another process may have finished a rebuild between our
+                # read and acquiring the lock.
+                stale_info, courts_info = courts_info, self.read()
+                if is_current(courts_info):
+                    self.use(courts_info)
+                else:
+                    self.rebuild(courts_info or stale_info)
+            finally:
+                lock.release()
+            return
+
+        metrics.incr(STORE, 'rebuilds suppressed')
+        if courts_info is not None:
+            self.use(courts_info)
+            return
+
+        started = time.monotonic()
+        lock.wait(lambda: self.read() is not None,
+                  local_config('court list wait seconds', WAIT_SECONDS))
+        metrics.observe(STORE, 'waiter blocked', time.monotonic() - started)
+        courts_info = self.read()
+        if courts_info is not None:
+            self.use(courts_info)
         else:
-            self.courts = courts_info['courts']
-            self.courts_by_county = courts_info['by_county']
+            logmessage("Timed out waiting for the court list; rebuilding it here")
+            self.rebuild()
+
+    def rebuild(self, stale_info: dict = None):
+        """
+        Retrieve, parse and save the court list. If it cannot be retrieved,
+        keep serving *stale_info*, the out-of-date list, if there is one.
+        """
+        started = time.monotonic()
+        try:
+            courts = self.retrieve()
+        except Exception as e:
+            if stale_info is None:
+                raise
+            logmessage(f"Unable to retrieve the court list; serving the old one: {str(e)}")
+            metrics.incr(STORE, 'rebuild failures')
+            self.use(stale_info)
+            return
+        courts_by_county = self.county_list(courts)
+        self.save(courts, courts_by_county)
+        self.use(cache_record(), courts, courts_by_county)
+        metrics.observe(STORE, 'rebuild', time.monotonic() - started)
+
+    def rebuild_in_background(self):
+        """
+        Rebuild the court list in a daemon thread, unless this process or
+        another one is already doing so.
+        """
+        if _rebuilding.is_set():
+            return
+        _rebuilding.set()
+
+        def run():
+            lock = RefreshLock(STORE, ttl=local_config('court list lock seconds', LOCK_SECONDS))
+            try:
+                if not lock.acquire():
+                    metrics.incr(STORE, 'rebuilds suppressed')
+                    return
+                try:
+                    courts_info = self.read()
+                    if is_current(courts_info):
+                        self.use(courts_info)
+                    else:
+                        self.rebuild(courts_info)
+                finally:
+                    lock.release()
+            except Exception as e:
+                logmessage(f"Background court list rebuild failed: {str(e)}")
+            finally:
+                _rebuilding.clear()
+
+        threading.Thread(target=run, name='us_tx_courts rebuild',
+                         daemon=True).start()
+
+    def use_snapshot(self) -> bool:
+        """
+        Serve courts from the packaged snapshot, if there is one.
+
+        Returns:
+            (bool): True if there is a snapshot to serve.
+        """
+        snapshot = read_snapshot(SNAPSHOT)
+        if snapshot is None:
+            return False
+        metrics.incr(STORE, 'snapshot reads')
+        self.use({'refresh_key': None, 'snapshot': snapshot['generated']},
+                 snapshot['courts'], snapshot['by_county'])
+        return True
+
+    def use(self, courts_info: dict, courts: dict = None, courts_by_county: dict = None):
+        """
+        Serve courts from a cached dataset.
+
+        Args:
+            courts_info (dict): The dataset's manifest.
+            courts (dict): Every court, if we already have them in hand.
+            courts_by_county (dict): Every county, if we already have them.
+        """
+        self.manifest = courts_info
+        self.courts = dict(courts or {})
+        self.courts_by_county = dict(courts_by_county or {})
 
     def get_court(self, court_number: str) -> dict:
         """
@@ -70,9 +215,10 @@ class UsTxCourts(object):
             (dict): Fields for this court or None if not found.
         """
         court = str(court_number).upper()
-        if court in self.courts:
-            return self.courts[court]
-        return None
+        if court not in self.courts:
+            self.fetch('courts', self.courts, [court])
+        # A copy, because this instance is shared by every interview.
+        return copy.deepcopy(self.courts.get(court))
 
     def get_courts(self, county: str, show_jurisdiction: bool = True) -> list:
         """
@@ -85,19 +231,46 @@ class UsTxCourts(object):
             not found.
         """
         county_idx = str(county).strip().upper()
-        if county_idx in self.courts_by_county:
-            if not show_jurisdiction:
-                return self.courts_by_county[county_idx]
-            return [(court, "{} - {}".format(ordinal(court), self.courts[court]['focus'].title()))
-                    for court in self.courts_by_county[county_idx]]
-        return None
+        if county_idx not in self.courts_by_county:
+            self.fetch('by_county', self.courts_by_county, [county_idx])
+        county_courts = self.courts_by_county.get(county_idx)
+        if county_courts is None:
+            return None
+        if not show_jurisdiction:
+            # A copy, because this instance is shared by every interview.
+            return list(county_courts)
+        self.fetch('courts', self.courts,
+                   [court for court in county_courts if court not in self.courts])
+        return [(court, "{} - {}".format(ordinal(court), self.courts[court]['focus'].title()))
+                for court in county_courts]
+
+    def fetch(self, partition: str, records: dict, fields: list):
+        """
+        Fetch records we have not seen yet from the store.
+
+        Args:
+            partition (str): 'courts' or 'by_county'.
+            records (dict): Where to put the records we fetch.
+            fields (list): Court numbers or county names to fetch.
+        Returns:
+            None
+        """
+        if not fields:
+            return
+        try:
+            values = self.storage.get_many(partition, fields)
+        except Exception as e:
+            logmessage(f"Unable to read cached {partition} from {STORE}: {str(e)}")
+            return
+        records.update(zip(fields, values))
 
     def retrieve(self) -> dict:
         """
         Retrieve a list of courts for this state from the statute that
         authorizes them.
         """
-        page = requests.get(URL)
+        page = http_client.get(URL)
+        page.raise_for_status()
         html = page.text
         courts = self.html2dict(html)
         return courts
@@ -120,12 +293,11 @@ class UsTxCourts(object):
         # Extract courts
         # There are some gaps in the court numbers and, as of this day,
         # there is a huge gap between the numbers of the last two
-        # courts. That's why I'm using a range.
-        for court_number in range(max_court_number()):
-            court_text = find_court(court_number, text)
-            if court_text is not None:
-                court_dict = parse_court_text(court_number, court_text)
-                result[str(court_number)] = court_dict
+        # courts. That's why we index every heading in one pass rather
+        # than searching for each court number in turn.
+        for court_number, court_text in find_courts(text, max_court_number()):
+            court_dict = parse_court_text(court_number, court_text)
+            result[str(court_number)] = court_dict
 
         # Extract specializations, which can be funky in Harris County
         tree = html.fromstring(page_html)
@@ -149,12 +321,11 @@ class UsTxCourts(object):
 
     def read(self) -> dict:
         """
-        Read the list of counties from local storage.
+        Read the court list's manifest from local storage.
         """
         result = None
         try:
-            the_redis = DARedis()
-            result = the_redis.get_data(STORE)
+            result = self.storage.read_manifest()
         except Exception as e:
             logmessage(f"Unable to read cached list of courts: {str(e)}")
         return result
@@ -170,8 +341,8 @@ class UsTxCourts(object):
             (bool): True if successful, otherwise False
         """
         try:
-            the_redis = DARedis()
-            the_redis.set_data(STORE, cache_record(courts, courts_by_county))
+            self.storage.write({'courts': courts, 'by_county': courts_by_county},
+                               cache_record())
             return True
         except Exception as e:
             logmessage(f"Unable to cache list of courts: {str(e)}")
@@ -197,14 +368,20 @@ class UsTxCourts(object):
         return courts_by_county
 
 
-def cache_record(courts, courts_by_county):
+def cache_record():
     return {
-                'courts': courts,
-                'by_county': courts_by_county,
                 'refresh_key': refresh_key()
     }
 
 
+def is_current(courts_info: dict) -> bool:
+    """
+    Returns True if *courts_info* was cached under the current refresh key.
+    """
+    return courts_info is not None \
+        and courts_info.get('refresh_key') == refresh_key()
+
+
 def ordinal(num: int) -> str:
     """
     Given an integer, return an ordinal, e.g. 1st, 2nd, 3rd, 4th, 5th, etc.
@@ -246,11 +423,53 @@ def find_court(court_number: int, text: str) -> str:
     if start_pos == -1:
         return None
 
-    end_pos = text.find(', eff. ', start_pos)
+    end_pos = text.find(SECTION_END, start_pos)
     end_pos - text.find('\n', end_pos)
     return text[start_pos:end_pos-1]
 
 
+def find_courts(text: str, max_court: int = MAX_COURT_NUMBER) -> list:
+    """
+    Find the statutes that create every judicial district in a single pass
+    over the text of the government code.
+
+    This returns exactly what calling *find_court()* for each court number
+    in ``range(max_court)`` would return, including its quirks: the first
+    occurrence of a heading wins, and a heading such as "21ST JUDICIAL
+    DISTRICT" also counts as an occurrence of "1ST JUDICIAL DISTRICT".
+
+    Args:
+        text (str): Text of government code.
+        max_court (int): Court numbers at or above this are ignored.
+    Returns:
+        (list): Of (court_number, court_text) tuples sorted by court number.
+    """
+    # Offset of the first heading for each court number.
+    starts = {}
+    for match in COURT_HEADING.finditer(text):
+        digits, suffix = match.group(1), match.group(2)
+        # Every trailing run of digits is also a heading as far as
+        # str.find() is concerned, e.g. "421ST" contains "21ST" and "1ST".
+        for offset in range(len(digits)):
+            tail = digits[offset:]
+            court_number = int(tail)
+            if court_number >= max_court or court_number in starts:
+                continue
+            if ordinal(court_number).upper() != tail + suffix:
+                continue
+            starts[court_number] = match.start() + offset
+
+    section_ends = [m.start() for m in re.finditer(re.escape(SECTION_END), text)]
+
+    result = []
+    for court_number in sorted(starts):
+        start_pos = starts[court_number]
+        idx = bisect_left(section_ends, start_pos)
+        end_pos = section_ends[idx] if idx < len(section_ends) else -1
+        result.append((court_number, text[start_pos:end_pos-1]))
+    return result
+
+
 def parse_court_text(court_number: int, text: str) -> dict:
     """
     Parse the statute that creates a court and return a dict
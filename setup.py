@@ -1,6 +1,8 @@
 import os
+import subprocess
 import sys
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
 from fnmatch import fnmatchcase
 from distutils.util import convert_path
 
@@ -17,6 +19,10 @@ standard_exclude_directories = (
 
 VERSION = "0.0.9"
 
+# Set this environment variable to build the package without retrieving the
+# reference data snapshots, e.g. offline.
+SKIP_SNAPSHOTS = 'US_TX_FAMILY_SKIP_SNAPSHOTS'
+
 
 def find_package_data(
     where='.',
@@ -60,6 +66,27 @@ def find_package_data(
     return out
 
 
+class build_py_with_snapshots(build_py):
+    """
+    Build the package with the reference data snapshots written by
+    docassemble.us_tx_family.build_snapshots, so that they ship with it.
+    A snapshot that cannot be retrieved is left out, and the build goes on.
+    """
+    def run(self):
+        super().run()
+        if os.environ.get(SKIP_SNAPSHOTS):
+            return
+        here = os.path.dirname(os.path.abspath(__file__))
+        output = os.path.join(self.build_lib, 'docassemble', 'us_tx_family', 'data', 'sources')
+        path = [here] + ([os.environ['PYTHONPATH']] if os.environ.get('PYTHONPATH') else [])
+        result = subprocess.run(
+            [sys.executable, '-m', 'docassemble.us_tx_family.build_snapshots', '--output', output],
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(path)))
+        if result.returncode != 0:
+            print("warning: some reference data snapshots could not be built; " +
+                  "they will be retrieved while the first user waits", file=sys.stderr)
+
+
 setup(
     name='docassemble.us_tx_family',
     version=VERSION,
@@ -88,6 +115,7 @@ setup(
     namespace_packages=['docassemble'],
     install_requires=[],
     zip_safe=False,
+    cmdclass={'build_py': build_py_with_snapshots},
     package_data=find_package_data(where='docassemble/us_tx_family/',
                                    package='docassemble.us_tx_family'),
 )
@@ -0,0 +1,307 @@
+"""
+fake_redis.py - An in-memory stand-in for the parts of a redis-py client
+that this package uses.
+
+Like redis-py, it stores everything as bytes. With decode_responses=True,
+which is how docassemble connects DARedis, every value read back is
+decoded as UTF-8, so storing binary data fails here the way it fails in
+production.
+"""
+import fnmatch
+import itertools
+
+try:
+    from redis.exceptions import WatchError
+except ModuleNotFoundError:
+    class WatchError(Exception):
+        pass
+
+
+class FakeRedis(object):
+    def __init__(self, decode_responses: bool = True):
+        self.decode_responses = decode_responses
+        self.data = {}
+        self.versions = {}  # Incremented whenever a key changes, for WATCH
+        self.clock = itertools.count(1)
+
+    # Conversions
+
+    def encode(self, value) -> bytes:
+        if isinstance(value, bytes):
+            return value
+        if isinstance(value, (int, float)):
+            value = repr(value)
+        return str(value).encode('utf-8')
+
+    def out(self, value):
+        if value is None or not self.decode_responses:
+            return value
+        return value.decode('utf-8')
+
+    def touch(self, key: str):
+        self.versions[key] = next(self.clock)
+
+    def mutable(self, key: str, kind):
+        value = self.data.get(key)
+        if value is None:
+            value = self.data[key] = kind()
+        self.touch(key)
+        return value
+
+    # Keys
+
+    def exists(self, *keys) -> int:
+        return sum(1 for key in keys if key in self.data)
+
+    def delete(self, *keys) -> int:
+        deleted = 0
+        for key in keys:
+            if self.data.pop(key, None) is not None:
+                self.touch(key)
+                deleted += 1
+        return deleted
+
+    def rename(self, src: str, dst: str):
+        if src not in self.data:
+            raise Exception("ERR no such key")
+        self.data[dst] = self.data.pop(src)
+        self.touch(src)
+        self.touch(dst)
+        return True
+
+    def expire(self, key: str, seconds: int) -> bool:
+        return key in self.data
+
+    def scan_iter(self, match: str = '*', count: int = None):
+        for key in list(self.data):
+            if fnmatch.fnmatchcase(key, match):
+                yield self.out(key.encode())
+
+    # Strings
+
+    def get(self, key: str):
+        return self.out(self.data.get(key))
+
+    def set(self, key: str, value, nx: bool = False, ex: int = None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = self.encode(value)
+        self.touch(key)
+        return True
+
+    def incr(self, key: str, amount: int = 1) -> int:
+        value = int(self.data.get(key, b'0')) + amount
+        self.set(key, value)
+        return value
+
+    def eval(self, script: str, numkeys: int, *args):
+        # Only the compare-and-delete script RefreshLock uses to release.
+        key, token = args[0], self.encode(args[1])
+        if self.data.get(key) == token:
+            return self.delete(key)
+        return 0
+
+    # Hashes
+
+    def hget(self, key: str, field):
+        return self.out(self.data.get(key, {}).get(self.encode(field)))
+
+    def hmget(self, key: str, fields) -> list:
+        return [self.hget(key, field) for field in fields]
+
+    def hset(self, key: str, field=None, value=None, mapping: dict = None) -> int:
+        items = dict(mapping or {})
+        if field is not None:
+            items[field] = value
+        stored = self.mutable(key, dict)
+        added = 0
+        for name, item in items.items():
+            name = self.encode(name)
+            added += name not in stored
+            stored[name] = self.encode(item)
+        return added
+
+    def hsetnx(self, key: str, field, value) -> int:
+        if self.encode(field) in self.data.get(key, {}):
+            return 0
+        return self.hset(key, field, value)
+
+    def hdel(self, key: str, *fields) -> int:
+        stored = self.data.get(key, {})
+        deleted = sum(1 for field in fields
+                      if stored.pop(self.encode(field), None) is not None)
+        if deleted:
+            self.touch(key)
+            if not stored:
+                del self.data[key]
+        return deleted
+
+    def hexists(self, key: str, field) -> bool:
+        return self.encode(field) in self.data.get(key, {})
+
+    def hlen(self, key: str) -> int:
+        return len(self.data.get(key, {}))
+
+    def hkeys(self, key: str) -> list:
+        return [self.out(field) for field in self.data.get(key, {})]
+
+    def hgetall(self, key: str) -> dict:
+        return {self.out(field): self.out(value)
+                for field, value in self.data.get(key, {}).items()}
+
+    def hscan_iter(self, key: str, match: str = '*', count: int = None):
+        for field, value in list(self.data.get(key, {}).items()):
+            if fnmatch.fnmatchcase(field.decode('utf-8', 'replace'), match):
+                yield self.out(field), self.out(value)
+
+    def hincrbyfloat(self, key: str, field, amount: float) -> float:
+        value = float(self.data.get(key, {}).get(self.encode(field), b'0')) + amount
+        self.hset(key, field, value)
+        return value
+
+    # Lists
+
+    def lpush(self, key: str, *values) -> int:
+        stored = self.mutable(key, list)
+        for value in values:
+            stored.insert(0, self.encode(value))
+        return len(stored)
+
+    def ltrim(self, key: str, start: int, end: int):
+        stored = self.data.get(key, [])
+        self.data[key] = stored[start:end + 1 if end != -1 else None]
+        self.touch(key)
+        return True
+
+    def lrange(self, key: str, start: int, end: int) -> list:
+        stored = self.data.get(key, [])
+        return [self.out(value) for value in stored[start:end + 1 if end != -1 else None]]
+
+    # Sets
+
+    def sadd(self, key: str, *members) -> int:
+        stored = self.mutable(key, set)
+        before = len(stored)
+        stored.update(self.encode(member) for member in members)
+        return len(stored) - before
+
+    def srem(self, key: str, *members) -> int:
+        stored = self.data.get(key, set())
+        removed = 0
+        for member in members:
+            member = self.encode(member)
+            if member in stored:
+                stored.discard(member)
+                removed += 1
+        if removed:
+            self.touch(key)
+            if not stored:
+                del self.data[key]
+        return removed
+
+    def sismember(self, key: str, member) -> bool:
+        return self.encode(member) in self.data.get(key, set())
+
+    def smembers(self, key: str) -> set:
+        return {self.out(member) for member in self.data.get(key, set())}
+
+    def sscan_iter(self, key: str, match: str = '*', count: int = None):
+        for member in list(self.data.get(key, set())):
+            yield self.out(member)
+
+    # Sorted sets
+
+    def zadd(self, key: str, mapping: dict) -> int:
+        stored = self.mutable(key, dict)
+        before = len(stored)
+        for member, score in mapping.items():
+            stored[self.encode(member)] = float(score)
+        return len(stored) - before
+
+    def zrem(self, key: str, *members) -> int:
+        stored = self.data.get(key, {})
+        removed = sum(1 for member in members
+                      if stored.pop(self.encode(member), None) is not None)
+        if removed:
+            self.touch(key)
+        return removed
+
+    def zcard(self, key: str) -> int:
+        return len(self.data.get(key, {}))
+
+    def zrange(self, key: str, start: int, end: int) -> list:
+        stored = self.data.get(key, {})
+        members = sorted(stored, key=lambda member: (stored[member], member))
+        return [self.out(member) for member in members[start:end + 1 if end != -1 else None]]
+
+    def zrangebylex(self, key: str, low, high) -> list:
+        def inside(member, bound, is_low):
+            bound = self.encode(bound)
+            if bound in (b'-', b'+'):
+                return (bound == b'-') == is_low
+            limit, inclusive = bound[1:], bound[:1] == b'['
+            if is_low:
+                return member > limit or (inclusive and member == limit)
+            return member < limit or (inclusive and member == limit)
+        return [self.out(member) for member in sorted(self.data.get(key, {}))
+                if inside(member, low, True) and inside(member, high, False)]
+
+    # Transactions
+
+    def pipeline(self, transaction: bool = True):
+        return FakePipeline(self)
+
+    def register_script(self, script: str):
+        raise NotImplementedError("Lua scripts are not supported by FakeRedis")
+
+
+class FakePipeline(object):
+    """
+    A pipeline that queues commands until execute(), except between
+    watch() and multi(), like redis-py's, and raises WatchError from
+    execute() if a watched key has changed.
+    """
+    def __init__(self, client: FakeRedis):
+        self.client = client
+        self.watched = {}
+        self.queue = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.reset()
+
+    def reset(self):
+        self.watched = {}
+        self.queue = []
+
+    def watch(self, *keys):
+        self.queue = None
+        for key in keys:
+            self.watched[key] = self.client.versions.get(key)
+
+    def unwatch(self):
+        self.watched = {}
+
+    def multi(self):
+        self.queue = []
+
+    def execute(self) -> list:
+        queue = self.queue or []
+        changed = any(self.client.versions.get(key) != version
+                      for key, version in self.watched.items())
+        self.reset()
+        if changed:
+            raise WatchError("Watched variable changed.")
+        return [command() for command in queue]
+
+    def __getattr__(self, name: str):
+        method = getattr(self.client, name)
+
+        def command(*args, **kwargs):
+            if self.queue is None:
+                return method(*args, **kwargs)
+            self.queue.append(lambda: method(*args, **kwargs))
+            return self
+        return command
@@ -0,0 +1,101 @@
+"""
+Tests for case_schema.py: each upgrade step, and upgrading all the way.
+"""
+import pytest
+
+pytest.importorskip('docassemble.base.util')
+
+from docassemble.base.core import DAList, DAObject  # noqa: E402
+from docassemble.base.util import Individual  # noqa: E402
+from docassemble.us_tx_family.case_schema import CURRENT_SCHEMA, \
+    SCHEMA_ATTRIBUTE, UPGRADES, schema_version, stamp, upgrade_case  # noqa: E402
+
+
+def version_0_case() -> DAObject:
+    case = DAObject('case')
+    case.footer = 'In re Smith'
+    case.client = 'Jane Smith'
+    return case
+
+
+def test_every_version_has_an_upgrade():
+    assert sorted(UPGRADES) == list(range(CURRENT_SCHEMA))
+
+
+def test_footer_to_description():
+    case = version_0_case()
+    UPGRADES[0](case)
+    assert case.description == 'In re Smith'
+
+    case = version_0_case()
+    case.description = 'Custody modification'
+    UPGRADES[0](case)
+    assert case.description == 'Custody modification'
+
+
+def test_client_name_to_list():
+    case = version_0_case()
+    UPGRADES[1](case)
+    assert isinstance(case.client, DAList)
+    assert case.client.number() == 1
+    assert str(case.client[0].name) == 'Jane Smith'
+    assert case.client.gathered
+
+
+def test_client_person_to_list():
+    case = version_0_case()
+    case.client = Individual('case.client')
+    case.client.name.first = 'Jane'
+    case.client.name.last = 'Smith'
+    UPGRADES[1](case)
+    assert isinstance(case.client, DAList)
+    assert case.client[0].name.last == 'Smith'
+    assert case.client[0].instanceName == 'case.client[0]'
+
+
+def test_client_list_is_unchanged():
+    case = version_0_case()
+    case.client = DAList('case.client')
+    client = case.client
+    UPGRADES[1](case)
+    assert case.client is client
+
+
+def test_add_case_id():
+    case = version_0_case()
+    UPGRADES[2](case)
+    assert case.case_id is None
+
+    case.case_id = '2020-1234-416'
+    UPGRADES[2](case)
+    assert case.case_id == '2020-1234-416'
+
+
+def test_add_closed():
+    case = version_0_case()
+    UPGRADES[3](case)
+    assert case.closed is False
+
+    case.closed = True
+    UPGRADES[3](case)
+    assert case.closed is True
+
+
+def test_upgrade_case_from_version_0():
+    case = version_0_case()
+    assert schema_version(case) == 0
+    assert upgrade_case(case)
+    assert getattr(case, SCHEMA_ATTRIBUTE) == CURRENT_SCHEMA
+    assert case.description == 'In re Smith'
+    assert str(case.client[0].name) == 'Jane Smith'
+    assert case.case_id is None
+    assert case.closed is False
+    # Already current, so nothing changes.
+    assert not upgrade_case(case)
+
+
+def test_stamped_case_is_not_upgraded():
+    case = DAObject('case')
+    stamp(case)
+    assert not upgrade_case(case)
+    assert 'closed' not in vars(case)
@@ -0,0 +1,64 @@
+"""
+Tests for partitioned_store.py.
+"""
+import pickle
+
+from docassemble.us_tx_family.partitioned_store import PartitionedStore
+from fake_redis import FakeRedis
+
+COURTS = {
+    '1': [{'last name': 'Smith', 'title': 'Judge'}],
+    '416': [{'last name': 'Jones', 'title': 'Court Coordinator'}],
+}
+
+
+def test_round_trip_through_decoding_client():
+    the_redis = FakeRedis(decode_responses=True)
+    store = PartitionedStore('test.json', the_redis)
+    store.write({'courts': COURTS, 'clerks': {}}, {'refresh_key': 'today'})
+
+    assert store.read_manifest() == {'refresh_key': 'today'}
+    assert store.get('courts', '416') == COURTS['416']
+    assert store.get('courts', '999') is None
+    assert store.get_many('courts', ['1', '999']) == [COURTS['1'], None]
+    assert store.get_all('courts') == COURTS
+    assert sorted(store.fields('courts')) == ['1', '416']
+
+
+def test_missing_dataset():
+    store = PartitionedStore('test.json', FakeRedis())
+    assert store.read_manifest() is None
+    assert store.diff({'courts': COURTS}) is None
+
+
+def test_diff_and_apply_only_rewrite_changes():
+    the_redis = FakeRedis()
+    store = PartitionedStore('test.json', the_redis)
+    store.write({'courts': COURTS}, {'refresh_key': 'yesterday'})
+    version = the_redis.get('test.json:version')
+
+    new_courts = dict(COURTS, **{'416': [{'last name': 'Brown', 'title': 'Judge'}],
+                                 '417': [{'last name': 'Green', 'title': 'Judge'}]})
+    del new_courts['1']
+    delta = store.diff({'courts': new_courts})
+    assert sorted(delta['courts']['changed']) == ['416', '417']
+    assert delta['courts']['removed'] == ['1']
+
+    store.apply(delta, {'refresh_key': 'today'}, {'courts': {'416': 1}})
+    assert store.get_all('courts') == new_courts
+    assert store.read_manifest() == {'refresh_key': 'today'}
+    assert store.changes() == [{'courts': {'416': 1}}]
+    assert the_redis.get('test.json:version') != version
+    assert store.diff({'courts': new_courts}) == \
+        {'courts': {'changed': {}, 'removed': []}}
+
+
+def test_reads_raw_pickles():
+    # Written by a client that did not decode responses, before values
+    # were base64 encoded.
+    the_redis = FakeRedis(decode_responses=False)
+    the_redis.set('test.json:manifest', pickle.dumps({'refresh_key': 'old'}))
+    the_redis.hset('test.json:courts', '1', pickle.dumps(COURTS['1']))
+    store = PartitionedStore('test.json', the_redis)
+    assert store.read_manifest() == {'refresh_key': 'old'}
+    assert store.get('courts', '1') == COURTS['1']
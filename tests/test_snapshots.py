@@ -0,0 +1,57 @@
+"""
+Tests for snapshots.py.
+"""
+import gzip
+import json
+
+import pytest
+
+from docassemble.us_tx_family import snapshots
+from docassemble.us_tx_family.snapshots import read_snapshot, snapshot_path, \
+    write_snapshot
+
+DATA = {'counties': ['Collin', 'Dallas', 'Denton']}
+
+
+@pytest.fixture(autouse=True)
+def snapshot_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(snapshots, 'SNAPSHOT_DIR', str(tmp_path))
+    monkeypatch.setattr(snapshots, '_snapshots', {})
+    return tmp_path
+
+
+def test_round_trip(snapshot_dir):
+    path = write_snapshot('us_tx_counties', DATA, 'https://example.com/counties')
+    assert path == snapshot_path('us_tx_counties', str(snapshot_dir))
+    snapshot = read_snapshot('us_tx_counties')
+    assert snapshot['counties'] == DATA['counties']
+    assert snapshot['generated']
+    assert not list(snapshot_dir.glob('*.tmp'))
+
+
+def test_read_once(snapshot_dir):
+    write_snapshot('us_tx_counties', DATA, 'https://example.com/counties')
+    first = read_snapshot('us_tx_counties')
+    write_snapshot('us_tx_counties', {'counties': []}, 'https://example.com/counties')
+    assert read_snapshot('us_tx_counties') is first
+
+
+def test_missing_snapshot():
+    assert read_snapshot('us_tx_counties') is None
+
+
+def test_other_format_is_ignored(snapshot_dir):
+    path = write_snapshot('us_tx_counties', DATA, 'https://example.com/counties')
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        record = json.load(f)
+    record['format'] = snapshots.SNAPSHOT_FORMAT + 1
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        json.dump(record, f)
+    assert read_snapshot('us_tx_counties') is None
+
+
+def test_written_to_another_directory(snapshot_dir, tmp_path_factory):
+    directory = tmp_path_factory.mktemp('output')
+    path = write_snapshot('us_tx_counties', DATA, 'https://example.com/counties', str(directory))
+    assert path == snapshot_path('us_tx_counties', str(directory))
+    assert read_snapshot('us_tx_counties') is None
@@ -0,0 +1,74 @@
+"""
+Tests for token_index.py.
+"""
+import pickle
+
+from docassemble.us_tx_family.token_index import TokenIndex, tokenize
+
+WEIGHTS = {'last name': 3, 'email': 3, 'first name': 2, 'title': 1, 'county': 1}
+
+PEOPLE = [
+    {'first name': 'Anna', 'last name': 'Smithers', 'title': 'Judge',
+     'county': 'Collin', 'email': 'anna@collin.example'},
+    {'first name': 'John', 'last name': 'Smith', 'title': 'Court Coordinator',
+     'county': 'Dallas', 'email': 'jsmith@dallas.example'},
+    {'first name': 'Smith', 'last name': 'Jones', 'title': 'Court Reporter',
+     'county': 'Collin', 'email': 'sjones@collin.example'},
+    {'first name': 'Mary', 'last name': 'Brown', 'title': 'Judge',
+     'county': 'Dallas', 'email': None},
+]
+
+
+def names(people: list) -> list:
+    return [person['last name'] for person in people]
+
+
+def test_tokenize():
+    assert tokenize('Jane  O\'Brien-Smith', None, 416) == \
+        ['jane', 'o', 'brien', 'smith', '416']
+    assert tokenize('jsmith@dallas.example') == \
+        ['jsmith@dallas.example', 'jsmith', 'dallas', 'example']
+    assert tokenize('Smith smith') == ['smith']
+
+
+def test_prefix_matches():
+    index = TokenIndex(PEOPLE, WEIGHTS)
+    assert names(index.search('smi')) == ['Smithers', 'Smith', 'Jones']
+    assert names(index.search('bro')) == ['Brown']
+    assert index.search('zzz') == []
+    assert index.search('') == []
+
+
+def test_ranking():
+    index = TokenIndex(PEOPLE, WEIGHTS)
+    # A whole-word match counts double, and a last name counts more than
+    # a first name: Smith (3 x 2) beats Jones, first name Smith (2 x 2),
+    # which beats Smithers (3 x 1).
+    assert names(index.search('smith')) == ['Smith', 'Jones', 'Smithers']
+    # Ties keep the order the items were indexed in.
+    assert names(index.search('judge')) == ['Smithers', 'Brown']
+
+
+def test_every_term_must_match():
+    index = TokenIndex(PEOPLE, WEIGHTS)
+    assert names(index.search('smi coll')) == ['Smithers', 'Jones']
+    assert names(index.search('judge dal')) == ['Brown']
+    assert index.search('brown collin') == []
+
+
+def test_email():
+    index = TokenIndex(PEOPLE, WEIGHTS)
+    assert names(index.search('jsmith@dallas.example')) == ['Smith']
+    assert names(index.search('collin.example')) == ['Smithers', 'Jones']
+
+
+def test_limit():
+    index = TokenIndex(PEOPLE, WEIGHTS)
+    assert names(index.search('smi', limit=2)) == ['Smithers', 'Smith']
+    assert names(index.search('smith', limit=1)) == ['Smith']
+
+
+def test_pickles():
+    index = pickle.loads(pickle.dumps(TokenIndex(PEOPLE, WEIGHTS)))
+    assert len(index) == len(PEOPLE)
+    assert names(index.search('smith')) == ['Smith', 'Jones', 'Smithers']
@@ -0,0 +1,285 @@
+"""
+Tests for us_case_list.py.
+"""
+import base64
+import json
+import pickle
+import zlib
+
+import pytest
+
+pytest.importorskip('docassemble.base.util')
+pytest.importorskip('redis')
+
+from docassemble.base.core import DAList, DAObject  # noqa: E402
+from docassemble.base.util import Individual  # noqa: E402
+from docassemble.us_tx_family import case_archive, us_case_list  # noqa: E402
+from docassemble.us_tx_family.case_schema import CURRENT_SCHEMA, \
+    schema_version  # noqa: E402
+from docassemble.us_tx_family.us_case_list import BINARY_ENVELOPE_MAGIC, \
+    CODECS, UsCaseList, decode, deserialize, encode, envelope_of, \
+    serialize  # noqa: E402
+from fake_redis import FakeRedis  # noqa: E402
+
+
+def make_case(key: str = 'case1', **attributes):
+    case = DAObject('case')
+    case.key = key
+    case.case_id = '2020-1234-416'
+    case.county = 'Collin'
+    case.description = 'In re Smith'
+    case.client = DAList('case.client')
+    client = case.client.appendObject(Individual)
+    client.name.first = 'Jane'
+    client.name.last = 'Smith'
+    for name, value in attributes.items():
+        setattr(case, name, value)
+    return case
+
+
+@pytest.mark.parametrize('codec', ['none', 'zlib'] +
+                         (['zstd'] if us_case_list.zstandard is not None else []))
+def test_envelope_round_trip(codec):
+    pickled = pickle.dumps({'description': 'In re Smith' * 20})
+    stored = encode(pickled, codec)
+    assert isinstance(stored, str)
+    assert envelope_of(stored) == (us_case_list.ENVELOPE_FORMAT, CODECS[codec])
+    assert decode(stored) == pickled
+    # As read by a client that does not decode responses.
+    assert decode(stored.encode()) == pickled
+
+
+def test_binary_envelope():
+    pickled = pickle.dumps({'description': 'In re Smith'})
+    stored = BINARY_ENVELOPE_MAGIC + bytes([1, CODECS['zlib']]) + zlib.compress(pickled)
+    assert envelope_of(stored) == (1, CODECS['zlib'])
+    assert decode(stored) == pickled
+
+
+def test_bare_pickle():
+    pickled = pickle.dumps({'description': 'In re Smith'})
+    assert envelope_of(pickled) is None
+    assert decode(pickled) == pickled
+
+
+def test_unknown_envelope_format():
+    with pytest.raises(ValueError):
+        decode('US:91' + 'AAAA')
+
+
+def test_serialize_round_trip():
+    case = make_case()
+    assert vars(deserialize(serialize(case))) == vars(case)
+    assert deserialize(None) is None
+
+
+def test_cases_round_trip_through_decoding_client():
+    the_redis = FakeRedis(decode_responses=True)
+    case_db = UsCaseList('1', the_redis)
+    assert case_db.save(make_case())
+    case = UsCaseList('1', the_redis).get_case('case1')
+    assert case.description == 'In re Smith'
+    assert UsCaseList('1', the_redis).get_cases() == \
+        [('case1', 'Smith, Jane - In re Smith - (Collin)')]
+
+
+def test_reads_cases_stored_as_bytes():
+    the_redis = FakeRedis(decode_responses=False)
+    case_db = UsCaseList('1', the_redis)
+    the_redis.hset(case_db.cases_key, 'old', pickle.dumps(make_case('old')))
+    the_redis.hset(case_db.cases_key, 'older', BINARY_ENVELOPE_MAGIC +
+                   bytes([1, CODECS['none']]) + pickle.dumps(make_case('older')))
+    assert case_db.get_case('old').key == 'old'
+    assert case_db.get_case('older').key == 'older'
+
+
+def set_legacy_cases(the_redis, user_id: str, cases: dict):
+    """
+    Store a legacy case list the way DARedis.set_data() stored it.
+    """
+    the_redis.set(us_case_list.CASES_KEY_TEMPLATE.format(user_id),
+                  base64.b64encode(pickle.dumps(cases)).decode())
+
+
+def test_migrate_then_get_case():
+    the_redis = FakeRedis(decode_responses=True)
+    set_legacy_cases(the_redis, '1', {'case1': make_case('case1'),
+                                      'case2': make_case('case2', county='Dallas')})
+    case_db = UsCaseList('1', the_redis)
+    assert case_db.migrated == 2
+    assert not the_redis.exists(case_db.user_cases_key)
+    assert the_redis.exists(us_case_list.MIGRATED_KEY_TEMPLATE.format('1'))
+    assert not the_redis.exists(case_db.user_cases_key + ':refresh_lock')
+
+    case_db = UsCaseList('1', the_redis)
+    assert case_db.get_case('case2').county == 'Dallas'
+    assert [key for key, _ in case_db.get_cases()] == ['case1', 'case2']
+
+
+def test_migration_waits_for_another_process(monkeypatch):
+    monkeypatch.setattr(us_case_list, 'MIGRATION_LOCK_SECONDS', 0.5)
+    the_redis = FakeRedis()
+    set_legacy_cases(the_redis, '1', {'case1': make_case('case1')})
+    # Another process is migrating this user's cases.
+    the_redis.set(us_case_list.CASES_KEY_TEMPLATE.format('1') + ':refresh_lock', 'other')
+    case_db = UsCaseList('1', the_redis)
+    assert case_db.migrated == 0
+    assert case_db.keys() == []
+
+
+def test_migration_does_not_bring_back_deleted_cases():
+    the_redis = FakeRedis()
+    set_legacy_cases(the_redis, '1', {'case1': make_case('case1')})
+    case_db = UsCaseList('1', the_redis)
+    case_db.del_case('case1')
+    assert case_db.migrate() == 0
+    assert case_db.get_case('case1') is None
+
+
+def test_archive_and_restore_through_decoding_client(monkeypatch, tmp_path):
+    monkeypatch.setattr(case_archive, 'local_config',
+                        lambda name, default=None: str(tmp_path)
+                        if name == 'case archive directory' else default)
+    the_redis = FakeRedis(decode_responses=True)
+    case_db = UsCaseList('1', the_redis)
+    case_db.save(make_case())
+    assert case_db.archive_case('case1')
+    assert case_db.keys() == []
+
+    case_db = UsCaseList('1', the_redis)
+    assert case_db.get_case('case1').description == 'In re Smith'
+    assert case_db.keys() == ['case1']
+    assert not the_redis.sismember(case_db.archived_key, 'case1')
+
+
+def test_archived_case_on_server_without_archive(monkeypatch, tmp_path):
+    monkeypatch.setattr(case_archive, 'local_config',
+                        lambda name, default=None: str(tmp_path)
+                        if name == 'case archive directory' else default)
+    the_redis = FakeRedis()
+    case_db = UsCaseList('1', the_redis)
+    case_db.save(make_case())
+    assert case_db.archive_case('case1')
+
+    monkeypatch.setattr(case_archive, 'local_config', lambda name, default=None: default)
+    case_db = UsCaseList('1', the_redis)
+    assert case_db.get_case('case1') is None
+    assert the_redis.sismember(case_db.archived_key, 'case1')
+
+
+def test_rebuilt_summary_keeps_modified_time():
+    the_redis = FakeRedis()
+    case_db = UsCaseList('1', the_redis)
+    case_db.save(make_case())
+    summary = json.loads(the_redis.hget(case_db.summaries_key, 'case1'))
+    summary.update(format=us_case_list.SUMMARY_FORMAT - 1, modified=1000.0)
+    the_redis.hset(case_db.summaries_key, 'case1', json.dumps(summary))
+    summaries = case_db.get_summaries()
+    assert summaries['case1']['format'] == us_case_list.SUMMARY_FORMAT
+    assert summaries['case1']['modified'] == 1000.0
+    assert case_db.archive_candidates(months=12) == ['case1']
+
+
+def test_migration_keeps_modified_time():
+    the_redis = FakeRedis()
+    set_legacy_cases(the_redis, '1', {'case1': make_case('case1')})
+    the_redis.hset(us_case_list.SUMMARY_HASH_TEMPLATE.format('1'), 'case1',
+                   json.dumps({'modified': 1000.0}))
+    case_db = UsCaseList('1', the_redis)
+    assert case_db.migrated == 1
+    assert case_db.get_summaries()['case1']['modified'] == 1000.0
+
+
+def test_save_upgrades_old_cases():
+    the_redis = FakeRedis()
+    case_db = UsCaseList('1', the_redis)
+    case = make_case()
+    del case.case_id
+    assert case_db.save(case)
+    assert schema_version(case) == CURRENT_SCHEMA
+    assert case.closed is False
+    stored = case_db.loads(the_redis.hget(case_db.cases_key, 'case1'))
+    assert schema_version(stored) == CURRENT_SCHEMA
+    assert json.loads(the_redis.hget(case_db.summaries_key, 'case1'))['cause_number'] is None
+
+
+def test_clean_save():
+    the_redis = FakeRedis()
+    case_db = UsCaseList('1', the_redis)
+    case = make_case()
+    result = case_db.save(case)
+    assert result and result.written and not result.conflict
+    assert result.version == 1
+    # Unchanged, so nothing is written.
+    result = case_db.save(case)
+    assert result and not result.written
+    case.description = 'In re Jones'
+    result = case_db.save(case)
+    assert result.written and result.version == 2
+    assert case_db.get_case('case1').description == 'In re Jones'
+
+
+def test_concurrent_edits_merge():
+    the_redis = FakeRedis()
+    UsCaseList('1', the_redis).save(make_case())
+    ours = UsCaseList('1', the_redis).get_case('case1')
+    theirs = UsCaseList('1', the_redis).get_case('case1')
+
+    theirs.county = 'Dallas'
+    assert UsCaseList('1', the_redis).save(theirs).written
+    ours.description = 'In re Jones'
+    result = UsCaseList('1', the_redis).save(ours)
+    assert result and result.written
+    assert result.merged == ['county']
+    assert ours.county == 'Dallas'
+
+    stored = UsCaseList('1', the_redis).get_case('case1')
+    assert (stored.county, stored.description) == ('Dallas', 'In re Jones')
+
+
+def test_conflicting_edits():
+    the_redis = FakeRedis()
+    UsCaseList('1', the_redis).save(make_case())
+    ours = UsCaseList('1', the_redis).get_case('case1')
+    theirs = UsCaseList('1', the_redis).get_case('case1')
+
+    theirs.description = 'In re Brown'
+    UsCaseList('1', the_redis).save(theirs)
+    ours.description = 'In re Jones'
+    result = UsCaseList('1', the_redis).save(ours)
+    assert not result
+    assert result.conflict and not result.written
+    assert result.conflicts == ['description']
+    assert UsCaseList('1', the_redis).get_case('case1').description == 'In re Brown'
+
+    result = UsCaseList('1', the_redis).save(ours, force=True)
+    assert result and result.written
+    assert UsCaseList('1', the_redis).get_case('case1').description == 'In re Jones'
+
+
+def test_merge_without_history():
+    # Saved before versioned saves: there is no common ancestor to merge
+    # with, so the whole cases are compared.
+    the_redis = FakeRedis()
+    case_db = UsCaseList('1', the_redis)
+    the_redis.hset(case_db.cases_key, 'case1', serialize(make_case()))
+    the_redis.hset(case_db.versions_key, 'case1', 3)
+    ours = make_case()
+    ours.description = 'In re Jones'
+    result = case_db.save(ours)
+    assert result.conflicts == ['description']
+    assert case_db.save(make_case()).conflicts == []
+
+
+def test_merge_with_seeded_history():
+    # Saved before versioned saves and loaded by two sessions: the first
+    # save records the stored case as their common ancestor.
+    the_redis = FakeRedis()
+    case_db = UsCaseList('1', the_redis)
+    the_redis.hset(case_db.cases_key, 'case1', serialize(make_case()))
+    ours, theirs = make_case(), make_case()
+    theirs.county = 'Dallas'
+    assert case_db.save(theirs).written
+    ours.description = 'In re Jones'
+    result = case_db.save(ours)
+    assert result.written and result.merged == ['county']
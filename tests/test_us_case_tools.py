@@ -0,0 +1,61 @@
+"""
+Tests for us_case_tools.py, on clients that do and do not decode responses.
+"""
+from argparse import Namespace
+
+import pytest
+
+pytest.importorskip('docassemble.base.util')
+pytest.importorskip('redis')
+
+from docassemble.base.core import DAObject  # noqa: E402
+from docassemble.us_tx_family import case_transfer, us_case_tools  # noqa: E402
+from docassemble.us_tx_family.us_case_list import CODECS, ENVELOPE_FORMAT, \
+    UsCaseList, envelope_of  # noqa: E402
+from fake_redis import FakeRedis  # noqa: E402
+
+CLIENTS = [pytest.param(True, id='decoding'), pytest.param(False, id='bytes')]
+
+
+def saved_cases(decode_responses: bool) -> FakeRedis:
+    the_redis = FakeRedis(decode_responses=decode_responses)
+    case_db = UsCaseList('1', the_redis)
+    for key in ['case1', 'case2']:
+        case = DAObject('case')
+        case.key = key
+        case.description = 'In re Smith ' * 20
+        assert case_db.save(case)
+    return the_redis
+
+
+@pytest.mark.parametrize('decode_responses', CLIENTS)
+def test_report(decode_responses, capsys):
+    the_redis = saved_cases(decode_responses)
+    assert us_case_tools.report(the_redis, Namespace(codec='zlib', user=None)) == 0
+    total = capsys.readouterr().out.splitlines()[-1].split()
+    assert total[:3] == ['TOTAL', '2', '0']
+
+
+@pytest.mark.parametrize('decode_responses', CLIENTS)
+def test_compress(decode_responses):
+    the_redis = saved_cases(decode_responses)
+    assert us_case_tools.compress(the_redis, Namespace(codec='zlib', user=None)) == 0
+    case_db = UsCaseList('1', the_redis)
+    for key in ['case1', 'case2']:
+        data = the_redis.hget(case_db.cases_key, key)
+        assert envelope_of(data) == (ENVELOPE_FORMAT, CODECS['zlib'])
+    assert case_db.get_case('case1').description.startswith('In re Smith')
+
+
+@pytest.mark.parametrize('file_format', case_transfer.FORMATS)
+@pytest.mark.parametrize('decode_responses', CLIENTS)
+def test_export(decode_responses, file_format, tmp_path):
+    the_redis = saved_cases(decode_responses)
+    path = str(tmp_path / 'cases')
+    args = Namespace(user=None, file=path, format=file_format, batch=1)
+    assert us_case_tools.export(the_redis, args) == 0
+    with open(path, 'rb') as stream:
+        records = {record['key']: record for record in case_transfer.reader(stream)}
+    cases_key = UsCaseList('1', the_redis).cases_key
+    for key in ['case1', 'case2']:
+        assert records[key]['data'] == the_redis.data[cases_key][key.encode()]
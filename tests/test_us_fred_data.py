@@ -0,0 +1,91 @@
+"""
+Tests for us_fred_data.py: storing rate histories, and serving them while
+they are brought up to date.
+"""
+from array import array
+from datetime import date, timedelta
+from decimal import Decimal
+import json
+
+import pytest
+
+pytest.importorskip('requests')
+
+from docassemble.us_tx_family import us_fred_data  # noqa: E402
+from docassemble.us_tx_family.us_fred_data import HISTORY_KEY_TEMPLATE, \
+    FredUtil, RateHistory  # noqa: E402
+from fake_redis import FakeRedis  # noqa: E402
+
+SERIES = 'MORTGAGE30US'
+
+
+def make_history(refreshed: date) -> RateHistory:
+    history = RateHistory(refreshed=refreshed)
+    history.extend([{'date': '2018-02-01', 'value': '4.22'},
+                    {'date': '2018-02-08', 'value': '.'},
+                    {'date': '2018-02-15', 'value': '4.38'}])
+    return history
+
+
+def store(the_redis, history: RateHistory):
+    the_redis.hset(HISTORY_KEY_TEMPLATE.format(series=SERIES), mapping=history.to_redis())
+
+
+@pytest.fixture(autouse=True)
+def no_shared_histories(monkeypatch):
+    monkeypatch.setattr(us_fred_data, '_histories', {})
+    monkeypatch.setattr(us_fred_data, '_refreshing', set())
+
+
+def test_average():
+    history = make_history(date.today())
+    assert len(history) == 2
+    assert history.average(date(2018, 2, 1), date(2018, 2, 28)) == Decimal('4.3000')
+    assert history.average(date(2018, 3, 1), date(2018, 3, 31)) is None
+
+
+@pytest.mark.parametrize('decode_responses', [True, False])
+def test_redis_round_trip(decode_responses):
+    the_redis = FakeRedis(decode_responses=decode_responses)
+    history = make_history(date(2020, 1, 2))
+    store(the_redis, history)
+    loaded = RateHistory.from_redis(the_redis.hgetall(HISTORY_KEY_TEMPLATE.format(series=SERIES)))
+    assert loaded.dates == history.dates
+    assert loaded.rates == history.rates
+    assert loaded.refreshed == date(2020, 1, 2)
+
+
+def test_reads_raw_arrays():
+    history = make_history(date(2020, 1, 2))
+    fields = {b'dates': history.dates.tobytes(), b'rates': history.rates.tobytes(),
+              b'refreshed': b'2020-01-02'}
+    loaded = RateHistory.from_redis(fields)
+    assert loaded.dates == history.dates
+    assert loaded.rates == history.rates
+
+
+def test_out_of_date_history_is_refreshed_in_background(monkeypatch):
+    the_redis = FakeRedis()
+    store(the_redis, make_history(date.today() - timedelta(days=1)))
+    util = FredUtil(the_redis)
+    refreshes = []
+    monkeypatch.setattr(util, 'refresh_in_background',
+                        lambda series, history: refreshes.append(series))
+    monkeypatch.setattr(util, 'locked_refresh', pytest.fail)
+    history = util.history(SERIES)
+    assert len(history) == 2
+    assert refreshes == [SERIES]
+
+
+def test_missing_history_is_fetched(monkeypatch):
+    the_redis = FakeRedis()
+    util = FredUtil(the_redis)
+    monkeypatch.setattr(us_fred_data, 'snapshot_history', lambda series: None)
+    observations = {'observations': [{'date': '2018-02-01', 'value': '4.22'}]}
+    monkeypatch.setattr(util.fred, 'series_observations',
+                        lambda series, **params: json.dumps(observations))
+    history = util.history(SERIES)
+    assert list(history.dates) == [date(2018, 2, 1).toordinal()]
+    assert history.refreshed == date.today()
+    stored = util.load_history(SERIES)
+    assert stored.rates == array('i', [42200])
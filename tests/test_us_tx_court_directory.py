@@ -0,0 +1,77 @@
+"""
+Tests for us_tx_court_directory.py.
+"""
+import pytest
+
+pytest.importorskip('docassemble.base.util')
+pytest.importorskip('requests')
+
+from docassemble.us_tx_family.partitioned_store import PartitionedStore  # noqa: E402
+from docassemble.us_tx_family.us_tx_court_directory import STORE, \
+    UsTxCourtDirectory  # noqa: E402
+from fake_redis import FakeRedis  # noqa: E402
+
+STAFF = [{'court': '416th District Court', 'county': 'Collin',
+          'title': 'Court Coordinator', 'first name': 'Jane', 'middle name': '',
+          'last name': 'Smith', 'suffix': '', 'address': '2100 Bloomdale Rd',
+          'city': 'McKinney', 'zip code': '75071', 'phone': '(972) 548-4570',
+          'email': 'jsmith@example.com'}]
+
+
+def make_directory() -> UsTxCourtDirectory:
+    """
+    Create a directory holding one court and one clerk's office, without
+    retrieving anything.
+    """
+    directory = UsTxCourtDirectory.__new__(UsTxCourtDirectory)
+    directory.storage = PartitionedStore(STORE, FakeRedis())
+    directory.use({'refresh_key': 'test'}, courts={'416': STAFF},
+                  clerks={'COLLIN': STAFF})
+    return directory
+
+
+def test_staff_lists_are_not_shared():
+    directory = make_directory()
+    first = directory.get_court('416')
+    first[0].name.first = 'Changed'
+    first[0].title = 'Changed'
+    first.append('someone else')
+
+    second = directory.get_court('416')
+    assert len(second.elements) == 1
+    assert second[0].name.first == 'Jane'
+    assert second[0].title == 'Court Coordinator'
+    assert second[0] is not first[0]
+
+
+def test_unknown_court():
+    directory = make_directory()
+    assert directory.get_court('999') is None
+
+
+def test_search_index_is_read_from_redis():
+    the_redis = FakeRedis(decode_responses=True)
+    writer = UsTxCourtDirectory.__new__(UsTxCourtDirectory)
+    writer.storage = PartitionedStore(STORE, the_redis)
+    writer.save({'416': STAFF}, {})
+
+    reader = UsTxCourtDirectory.__new__(UsTxCourtDirectory)
+    reader.storage = PartitionedStore(STORE, the_redis)
+    reader.use(reader.read())
+    assert [person['email'] for person in reader.search('smi coll')] == \
+        ['jsmith@example.com']
+    assert reader.search('nobody') == []
+
+
+def test_search_index_is_built_when_missing():
+    the_redis = FakeRedis(decode_responses=True)
+    writer = UsTxCourtDirectory.__new__(UsTxCourtDirectory)
+    writer.storage = PartitionedStore(STORE, the_redis)
+    writer.save({'416': STAFF}, {})
+    # Saved before there was an index.
+    the_redis.delete(writer.storage.partition_key('search'))
+
+    reader = UsTxCourtDirectory.__new__(UsTxCourtDirectory)
+    reader.storage = PartitionedStore(STORE, the_redis)
+    reader.use(reader.read())
+    assert [person['last name'] for person in reader.search('coordinator')] == ['Smith']
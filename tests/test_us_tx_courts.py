@@ -0,0 +1,89 @@
+"""
+Tests for us_tx_courts.py.
+"""
+import pytest
+
+pytest.importorskip('lxml')
+pytest.importorskip('requests')
+
+from docassemble.us_tx_family.us_tx_courts import court_counties, \
+    find_court, find_courts  # noqa: E402
+
+# An excerpt of Chapter 24 of the Government Code, as MLStripper leaves it.
+# There are no sections for the 6th, 13th and 21st districts, so the 506th,
+# 113th and 421st districts' headings are found for them, as str.find()
+# finds them.
+# The last section has no history note.
+STATUTE = """
+Sec. 24.101.  1ST JUDICIAL DISTRICT (JASPER, NEWTON, SABINE, AND SAN
+AUGUSTINE COUNTIES).  The 1st Judicial District is composed of Jasper,
+Newton, Sabine, and San Augustine counties.
+Acts 1985, 69th Leg., ch. 480, Sec. 1, eff. Sept. 1, 1985.
+
+Sec. 24.112.  11TH JUDICIAL DISTRICT (HARRIS COUNTY).  The 11th Judicial
+District is composed of Harris County.
+Acts 1985, 69th Leg., ch. 480, Sec. 1, eff. Sept. 1, 1985.
+
+Sec. 24.215.  113TH JUDICIAL DISTRICT (HARRIS COUNTY).  The 113th Judicial
+District is composed of Harris County.
+Acts 1985, 69th Leg., ch. 480, Sec. 1, eff. Sept. 1, 1985.
+
+Sec. 24.566.  421ST JUDICIAL DISTRICT (CALDWELL COUNTY).  The 421st Judicial
+District is composed of Caldwell County.
+Added by Acts 2005, 79th Leg., ch. 1094, Sec. 1, eff. Sept. 1, 2005.
+
+Sec. 24.600.  506TH JUDICIAL DISTRICT (GRIMES AND WALLER COUNTIES).  The
+506th Judicial District is composed of Grimes and Waller Counties.
+
+CHAPTER 25.  STATUTORY COUNTY COURTS
+"""
+
+
+def old_parse(text: str, max_court: int) -> list:
+    """
+    The parser find_courts() replaced: one scan of *text* per court number.
+    """
+    result = []
+    for court_number in range(max_court):
+        court_text = find_court(court_number, text)
+        if court_text is not None:
+            result.append((court_number, court_text))
+    return result
+
+
+def county_map(courts: list) -> dict:
+    return {number: court_counties(text.replace('\n', ' ')) for number, text in courts}
+
+
+def test_find_courts_matches_old_parser():
+    assert find_courts(STATUTE, 1000) == old_parse(STATUTE, 1000)
+
+
+def test_find_courts_counties():
+    assert county_map(find_courts(STATUTE, 1000)) == {
+        1: ['Jasper', 'Newton', 'Sabine', 'San Augustine'],
+        6: ['Grimes', 'Waller'],
+        11: ['Harris'],
+        13: ['Harris'],
+        21: ['Caldwell'],
+        113: ['Harris'],
+        421: ['Caldwell'],
+        506: ['Grimes', 'Waller'],
+    }
+
+
+def test_find_courts_trailing_digits():
+    courts = dict(find_courts(STATUTE, 1000))
+    # "421ST" contains "21ST" and "1ST", but the 1st district's own heading
+    # comes first. "113TH" contains "13TH" but not "3TH", which is not an
+    # ordinal.
+    assert courts[21].startswith('21ST JUDICIAL DISTRICT (CALDWELL')
+    assert courts[1].startswith('1ST JUDICIAL DISTRICT (JASPER')
+    assert courts[13] == courts[113][1:]
+    assert courts[6] == courts[506][2:]
+    assert 3 not in courts
+
+
+def test_find_courts_ignores_courts_above_max():
+    assert [number for number, _ in find_courts(STATUTE, 113)] == [1, 6, 11, 13, 21]
+    assert find_courts(STATUTE, 113) == old_parse(STATUTE, 113)